@@ -0,0 +1,402 @@
+""" QEMU Monitor Protocol asyncio class """
+# Copyright (C) 2009, 2010 Red Hat Inc.
+#
+# This work is licensed under the terms of the GNU GPL, version 2.  See
+# the COPYING file in the top-level directory.
+
+import asyncio
+import json
+import logging
+import socket
+from types import TracebackType
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    List,
+    Optional,
+    Type,
+    Union,
+    cast,
+)
+
+from .qmp import (
+    QMPConnectError,
+    QMPEventQueue,
+    QMPMessage,
+    QMPReturnValue,
+    QMPTimeoutError,
+    SocketAddrT,
+    _build_command,
+    _check_capabilities,
+    _check_greeting,
+    _qmp_socket,
+    _return_value,
+)
+
+
+# Maximum size of a single QMP message; query-qmp-schema replies alone are
+# several hundred KiB.
+STREAM_LIMIT = 32 * 1024 * 1024
+
+
+class AsyncQEMUMonitorProtocol:
+    """
+    Provide an asyncio API to connect to QEMU via QEMU Monitor Protocol (QMP)
+    and then allow to handle commands and events.
+
+    This offers the same commands as QEMUMonitorProtocol as coroutines.
+    Several commands can be in flight at the same time: each command is
+    tagged with an id and a single reader task matches replies to commands
+    and queues events, so one event loop can drive many monitors without a
+    thread per connection.
+    """
+
+    #: Logger object for debugging messages
+    logger = logging.getLogger('QMP')
+
+    def __init__(self, address: SocketAddrT,
+                 server: bool = False,
+                 nickname: Optional[str] = None,
+                 event_queue: Optional[QMPEventQueue] = None):
+        """
+        Create an AsyncQEMUMonitorProtocol class.
+
+        @param address: QEMU address, can be either a unix socket path (string)
+                        or a tuple in the form ( address, port ) for a TCP
+                        connection
+        @param server: server mode listens on the socket (bool)
+        @param event_queue: queue for received events, to bound its size
+                            (default: an unbounded QMPEventQueue)
+        @raise OSError on socket connection errors
+        @note No connection is established, this is done by the connect() or
+              accept() coroutines
+        """
+        if event_queue is None:
+            event_queue = QMPEventQueue()
+        self.__events = event_queue
+        # Created once connected, so that it belongs to the running loop
+        self.__event_arrived: Optional[asyncio.Event] = None
+        self.__address = address
+        self.__sock: Optional[socket.socket] = _qmp_socket(address, server)
+        self.__reader: Optional[asyncio.StreamReader] = None
+        self.__writer: Optional[asyncio.StreamWriter] = None
+        self.__reader_task: Optional['asyncio.Future[None]'] = None
+        self.__pending: Dict[str, 'asyncio.Future[QMPMessage]'] = {}
+        self.__next_id = 0
+        self.__closed = False
+        self._nickname = nickname
+        if self._nickname:
+            self.logger = logging.getLogger('QMP').getChild(self._nickname)
+
+    async def __aenter__(self) -> 'AsyncQEMUMonitorProtocol':
+        return self
+
+    async def __aexit__(self,
+                        exc_type: Optional[Type[BaseException]],
+                        exc_val: Optional[BaseException],
+                        exc_tb: Optional[TracebackType]) -> None:
+        await self.aclose()
+
+    async def __json_read(self) -> Optional[QMPMessage]:
+        assert self.__reader is not None
+        data = await self.__reader.readline()
+        if not data:
+            return None
+        # By definition, any JSON received from QMP is a QMPMessage,
+        # and we are asserting only at static analysis time that it
+        # has a particular shape.
+        resp: QMPMessage = json.loads(data)
+        return resp
+
+    async def __open(self, sock: socket.socket) -> QMPMessage:
+        sock.setblocking(False)
+        self.__reader, self.__writer = await asyncio.open_connection(
+            sock=sock, limit=STREAM_LIMIT)
+        self.__event_arrived = asyncio.Event()
+        greeting = _check_greeting(await self.__json_read())
+        self.__reader_task = asyncio.ensure_future(self.__read_loop())
+        return greeting
+
+    async def __read_loop(self) -> None:
+        """
+        Read messages until the connection is closed, completing the
+        futures of the commands they reply to and queueing events.
+        """
+        error: Exception = QMPConnectError(
+            "Unexpected empty reply from server")
+        try:
+            while True:
+                resp = await self.__json_read()
+                if resp is None:
+                    break
+                self.logger.debug("<<< %s", resp)
+                if 'event' in resp:
+                    self.__events.append(resp)
+                    self.__wake_event_waiters()
+                    continue
+                self.__dispatch(resp)
+        except (OSError, ValueError) as err:
+            error = QMPConnectError("Error while reading from socket")
+            error.__cause__ = err
+        finally:
+            self.__closed = True
+            self.__wake_event_waiters()
+            for future in self.__pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self.__pending.clear()
+
+    def __wake_event_waiters(self) -> None:
+        if self.__event_arrived is not None:
+            self.__event_arrived.set()
+
+    def __dispatch(self, resp: QMPMessage) -> None:
+        if 'id' in resp:
+            key = json.dumps(resp['id'], sort_keys=True)
+        elif self.__pending:
+            # Errors for unparsable commands carry no id.  Commands are
+            # answered in order, so it belongs to the oldest one.
+            key = next(iter(self.__pending))
+        else:
+            self.logger.warning("Unexpected reply: %s", resp)
+            return
+        future = self.__pending.pop(key, None)
+        if future is None:
+            self.logger.warning("Reply to unknown command: %s", resp)
+        elif not future.done():
+            future.set_result(resp)
+
+    async def negotiate(self) -> None:
+        """
+        Perform capabilities negotiation.
+
+        @raise QMPCapabilitiesError if fails to negotiate capabilities
+        """
+        _check_capabilities(await self.cmd('qmp_capabilities'))
+
+    async def connect(self, negotiate: bool = True) -> QMPMessage:
+        """
+        Connect to the QMP Monitor and perform capabilities negotiation.
+
+        @return QMP greeting dict
+        @raise OSError on socket connection errors
+        @raise QMPConnectError if the greeting is not received
+        @raise QMPCapabilitiesError if fails to negotiate capabilities
+        """
+        assert self.__sock is not None
+        self.__sock.setblocking(False)
+        loop = asyncio.get_event_loop()
+        await loop.sock_connect(self.__sock, self.__address)
+        greeting = await self.__open(self.__sock)
+        if negotiate:
+            await self.negotiate()
+        return greeting
+
+    async def accept(self, timeout: Optional[float] = 15.0,
+                     negotiate: bool = True) -> QMPMessage:
+        """
+        Await connection from QMP Monitor and perform capabilities negotiation.
+
+        @param timeout: timeout in seconds (nonnegative float number, or
+                        None).  Default value is set to 15.0.
+        @param negotiate: if false, leave negotiation to negotiate()
+        @return QMP greeting dict
+        @raise QMPTimeoutError if no connection is received in time
+        @raise QMPConnectError if the greeting is not received
+        @raise QMPCapabilitiesError if fails to negotiate capabilities
+        """
+        assert self.__sock is not None
+        listener = self.__sock
+        listener.setblocking(False)
+        loop = asyncio.get_event_loop()
+        try:
+            sock, _ = await asyncio.wait_for(loop.sock_accept(listener),
+                                             timeout)
+        except asyncio.TimeoutError as err:
+            raise QMPTimeoutError("Timeout waiting for connection") from err
+        finally:
+            listener.close()
+        self.__sock = sock
+        greeting = await self.__open(sock)
+        if negotiate:
+            await self.negotiate()
+        return greeting
+
+    async def cmd_obj(self, qmp_cmd: QMPMessage) -> QMPMessage:
+        """
+        Send a QMP command to the QMP Monitor.
+
+        Commands without an 'id' key are given a unique id, which is left in
+        the response.  Several coroutines may send commands concurrently.
+
+        @param qmp_cmd: QMP command to be sent as a Python dict
+        @return QMP response as a Python dict
+        @raise QMPConnectError if the connection is closed before the reply
+        """
+        if self.__writer is None or self.__closed:
+            raise QMPConnectError("Not connected")
+        if 'id' not in qmp_cmd:
+            self.__next_id += 1
+            qmp_cmd = dict(qmp_cmd, id='__aqmp#%d' % self.__next_id)
+        key = json.dumps(qmp_cmd['id'], sort_keys=True)
+        if key in self.__pending:
+            raise ValueError("Command id %s is already in flight" % key)
+        future = asyncio.get_event_loop().create_future()
+        self.__pending[key] = future
+
+        self.logger.debug(">>> %s", qmp_cmd)
+        try:
+            self.__writer.write(json.dumps(qmp_cmd).encode('utf-8'))
+            await self.__writer.drain()
+            return cast(QMPMessage, await future)
+        except OSError as err:
+            raise QMPConnectError("Error while writing to socket") from err
+        finally:
+            if self.__pending.get(key) is future:
+                del self.__pending[key]
+            if not future.done():
+                future.cancel()
+            elif not future.cancelled():
+                # The reader may have failed the command too; do not let
+                # asyncio complain about an unretrieved exception
+                future.exception()
+
+    async def cmd(self, name: str,
+                  args: Optional[Dict[str, Any]] = None,
+                  cmd_id: Optional[Any] = None) -> QMPMessage:
+        """
+        Build a QMP command and send it to the QMP Monitor.
+
+        @param name: command name (string)
+        @param args: command arguments (dict)
+        @param cmd_id: command id (dict, list, string or int)
+        """
+        return await self.cmd_obj(_build_command(name, args, cmd_id))
+
+    async def execute(self, cmd: str,
+                      args: Optional[Dict[str, Any]] = None) -> QMPReturnValue:
+        """
+        Build and send a QMP command to the monitor, report errors if any
+
+        @raise QMPResponseError if the command fails
+        """
+        return _return_value(await self.cmd(cmd, args))
+
+    async def command(self, cmd: str, **kwds: Any) -> QMPReturnValue:
+        """
+        Build and send a QMP command to the monitor, report errors if any
+        """
+        return await self.execute(cmd, kwds)
+
+    async def pull_event(self,
+                         wait: Union[bool, float] = False
+                         ) -> Optional[QMPMessage]:
+        """
+        Pulls a single event.
+
+        @param wait (bool): wait until an event is available.
+        @param wait (float): If wait is a float, treat it as a timeout value.
+
+        @raise QMPTimeoutError: If a timeout float is provided and the timeout
+                                period elapses.
+        @raise QMPConnectError: If wait is True but the connection was closed
+                                before an event was received.
+
+        @return The first available QMP event, or None.
+        """
+        while not self.__events and wait:
+            arrived = self.__event_arrived
+            if arrived is None or self.__closed:
+                raise QMPConnectError("Error while reading from socket")
+            arrived.clear()
+            if isinstance(wait, float):
+                try:
+                    await asyncio.wait_for(arrived.wait(), wait)
+                except asyncio.TimeoutError as err:
+                    raise QMPTimeoutError("Timeout waiting for event") \
+                        from err
+            else:
+                await arrived.wait()
+
+        if self.__events:
+            return self.__events.popleft()
+        return None
+
+    async def get_events(self, wait: Union[bool, float] = False
+                         ) -> List[QMPMessage]:
+        """
+        Get a list of available QMP events and remove them from the queue.
+
+        @param wait: as for pull_event()
+        @return The list of available QMP events.
+        """
+        event = await self.pull_event(wait)
+        events = [] if event is None else [event]
+        events.extend(self.__events)
+        self.__events.clear()
+        return events
+
+    def clear_events(self) -> None:
+        """
+        Clear current list of pending events.
+        """
+        self.__events.clear()
+
+    async def events(self) -> AsyncIterator[QMPMessage]:
+        """
+        Iterate over QMP events as they arrive, until the connection is
+        closed::
+
+            async for event in qmp.events():
+                ...
+        """
+        while True:
+            try:
+                event = await self.pull_event(wait=True)
+            except QMPConnectError:
+                return
+            assert event is not None
+            yield event
+
+    def close(self) -> None:
+        """
+        Close the connection.  Commands still in flight fail with
+        QMPConnectError.
+        """
+        if self.__reader_task is not None:
+            self.__reader_task.cancel()
+            self.__reader_task = None
+        if self.__writer is not None:
+            self.__writer.close()
+            self.__writer = None
+        elif self.__sock is not None:
+            self.__sock.close()
+        self.__sock = None
+        self.__closed = True
+        self.__wake_event_waiters()
+        for future in self.__pending.values():
+            if not future.done():
+                future.set_exception(QMPConnectError("Connection closed"))
+        self.__pending.clear()
+
+    async def aclose(self) -> None:
+        """
+        Close the connection and wait for the reader task to finish.
+        """
+        task = self.__reader_task
+        self.close()
+        if task is not None:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def is_scm_available(self) -> bool:
+        """
+        Check if the socket allows for SCM_RIGHTS.
+
+        @return True if SCM_RIGHTS is available, otherwise False.
+        """
+        return (self.__sock is not None and
+                self.__sock.family == socket.AF_UNIX)
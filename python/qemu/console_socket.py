@@ -13,11 +13,102 @@ which can drain a socket and optionally dump the bytes to file.
 # the COPYING file in the top-level directory.
 #
 
-from collections import deque
+import os
+import re
+import selectors
 import socket
 import threading
 import time
-from typing import Deque, Optional
+from typing import (
+    TYPE_CHECKING,
+    BinaryIO,
+    Callable,
+    List,
+    Match,
+    Optional,
+    Pattern,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+
+if TYPE_CHECKING:
+    # pylint: disable=import-error
+    from _typeshed import WriteableBuffer
+
+
+# Size of the buffer used to receive from the socket
+RECV_SIZE = 64 * 1024
+
+# The console log is flushed once no data arrived for this long
+LOG_FLUSH_INTERVAL = 0.1
+
+ConsolePatternT = Union[str, bytes, Pattern[bytes]]
+
+# Terminal escape sequences, removed from logged lines
+_ESCAPE_RE = re.compile(r'\x1b[\[(][0-9;?]*[a-zA-Z]')
+
+# Other control characters are replaced in logged lines
+_CONTROL_CHARS = {char: '.' for char in range(0x20)}
+_CONTROL_CHARS[0x1b] = '<esc>'
+
+
+# Returns the index of the pattern that matched and the match, or None
+_SearchT = Callable[[bytearray, int], Optional[Tuple[int, Match[bytes]]]]
+
+
+def _compile_patterns(patterns: Sequence[ConsolePatternT]) -> _SearchT:
+    """
+    Compile the patterns of ConsoleSocket.expect() into a search
+    function.  Strings and bytes are searched for together, with a single
+    alternation; each regular expression is searched for on its own, so
+    that its groups and flags are not affected by the other patterns.
+    """
+    literals = []
+    regexes: List[Tuple[int, Pattern[bytes]]] = []
+    # Longest literal, minus one
+    overlap = 0
+    for index, pattern in enumerate(patterns):
+        if isinstance(pattern, str):
+            pattern = pattern.encode('utf-8')
+        if isinstance(pattern, bytes):
+            overlap = max(overlap, len(pattern) - 1)
+            literals.append(b'(?P<_p%d>%s)' % (index, re.escape(pattern)))
+        else:
+            regexes.append((index, pattern))
+    alternation = re.compile(b'|'.join(literals)) if literals else None
+
+    def search(buf: bytearray,
+               searched: int) -> Optional[Tuple[int, Match[bytes]]]:
+        # The leftmost match wins, then the first pattern.  Literals are
+        # only searched for where they may start a match, given that
+        # buf[:searched] was already searched.
+        found: Optional[Tuple[int, Match[bytes]]] = None
+        if alternation is not None:
+            match = alternation.search(buf, max(0, searched - overlap))
+            if match:
+                assert match.lastgroup is not None
+                found = (int(match.lastgroup[2:]), match)
+        # Regular expressions are not bounded, search them again in full
+        for index, regex in regexes:
+            match = regex.search(buf)
+            if match and (found is None or
+                          (match.start(), index) <
+                          (found[1].start(), found[0])):
+                found = (index, match)
+        return found
+
+    return search
+
+
+def clean_console_line(line: bytes) -> str:
+    """
+    Return a console line in a form suitable for logs, without terminal
+    escape sequences and with other control characters replaced.
+    """
+    text = line.decode('utf-8', errors='replace').rstrip('\r\n')
+    return _ESCAPE_RE.sub('', text).translate(_CONTROL_CHARS)
 
 
 class ConsoleSocket(socket.socket):
@@ -29,12 +120,17 @@ class ConsoleSocket(socket.socket):
 
     Optionally a file path can be passed in and we will also
     dump the characters to this file for debugging purposes.
+
+    readline() and expect() read the console line by line, in both modes.
     """
     def __init__(self, address: str, file: Optional[str] = None,
                  drain: bool = False):
         self._recv_timeout_sec = 300.0
-        self._sleep_time = 0.5
-        self._buffer: Deque[int] = deque()
+        self._buffer = bytearray()
+        # No line terminator in _buffer[:_scan]
+        self._scan = 0
+        self._eof = False
+        self._cond = threading.Condition()
         socket.socket.__init__(self, socket.AF_UNIX, socket.SOCK_STREAM)
         self.connect(address)
         self._logfile = None
@@ -42,27 +138,53 @@ class ConsoleSocket(socket.socket):
             self._logfile = open(file, "bw")
         self._open = True
         self._drain_thread = None
+        self._wakeup: Optional[Tuple[int, int]] = None
         if drain:
             self._drain_thread = self._thread_start()
 
     def _drain_fn(self) -> None:
-        """Drains the socket and runs while the socket is open."""
-        while self._open:
-            try:
-                self._drain_socket()
-            except socket.timeout:
-                # The socket is expected to timeout since we set a
-                # short timeout to allow the thread to exit when
-                # self._open is set to False.
-                time.sleep(self._sleep_time)
+        """Drains the socket until it is closed or reaches end of file."""
+        assert self._wakeup is not None
+        chunk = memoryview(bytearray(RECV_SIZE))
+        dirty = False
+        with selectors.DefaultSelector() as selector:
+            selector.register(self, selectors.EVENT_READ)
+            selector.register(self._wakeup[0], selectors.EVENT_READ)
+            while True:
+                events = selector.select(LOG_FLUSH_INTERVAL if dirty
+                                         else None)
+                if not events:
+                    # Idle; flush the data logged since the last flush
+                    assert self._logfile is not None
+                    self._logfile.flush()
+                    dirty = False
+                    continue
+                if any(key.fileobj == self._wakeup[0] for key, _ in events):
+                    break
+                try:
+                    size = socket.socket.recv_into(self, chunk)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except OSError:
+                    size = 0
+                if size and self._logfile:
+                    self._logfile.write(chunk[:size])
+                    dirty = True
+                with self._cond:
+                    if size:
+                        self._buffer += chunk[:size]
+                    else:
+                        self._eof = True
+                    self._cond.notify_all()
+                if not size:
+                    break
+        if dirty and self._logfile:
+            self._logfile.flush()
 
     def _thread_start(self) -> threading.Thread:
         """Kick off a thread to drain the socket."""
-        # Configure socket to not block and timeout.
-        # This allows our drain thread to not block
-        # on recieve and exit smoothly.
         socket.socket.setblocking(self, False)
-        socket.socket.settimeout(self, 1)
+        self._wakeup = os.pipe()
         drain_thread = threading.Thread(target=self._drain_fn)
         drain_thread.daemon = True
         drain_thread.start()
@@ -73,20 +195,67 @@ class ConsoleSocket(socket.socket):
         if self._open:
             self._open = False
             if self._drain_thread is not None:
+                assert self._wakeup is not None
+                os.write(self._wakeup[1], b'\0')
                 thread, self._drain_thread = self._drain_thread, None
                 thread.join()
+                for fd in self._wakeup:
+                    os.close(fd)
+                self._wakeup = None
             socket.socket.close(self)
             if self._logfile:
                 self._logfile.close()
                 self._logfile = None
 
-    def _drain_socket(self) -> None:
-        """process arriving characters into in memory _buffer"""
-        data = socket.socket.recv(self, 1)
-        if self._logfile:
-            self._logfile.write(data)
-            self._logfile.flush()
-        self._buffer.extend(data)
+    def _consume(self, size: int) -> bytes:
+        """Remove and return size bytes from the buffer; _cond is held."""
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._scan = max(0, self._scan - size)
+        return data
+
+    def _wait_data(self, deadline: Optional[float]) -> None:
+        """
+        Wait until more data is in the buffer, or end of file is reached.
+        In drained mode _cond must be held.
+
+        @param deadline: time.monotonic() value after which to give up, or
+                         None to wait for at most the socket timeout; as
+                         this returns when data arrives, the socket
+                         timeout is an inactivity timeout
+        @raise socket.timeout if nothing arrives in time
+        """
+        if deadline is not None:
+            timeout: Optional[float] = max(0.0, deadline - time.monotonic())
+        elif self._drain_thread is not None:
+            timeout = self._recv_timeout_sec
+        else:
+            timeout = self.gettimeout()
+        size = len(self._buffer)
+        if self._drain_thread is not None:
+            if not self._cond.wait_for(
+                    lambda: len(self._buffer) > size or self._eof, timeout):
+                raise socket.timeout
+            return
+
+        # Not draining, read from the socket directly
+        with selectors.DefaultSelector() as selector:
+            selector.register(self, selectors.EVENT_READ)
+            if not selector.select(timeout):
+                raise socket.timeout
+        data = socket.socket.recv(self, RECV_SIZE)
+        if data:
+            self._buffer += data
+        else:
+            self._eof = True
+
+    @staticmethod
+    def _deadline(timeout: Optional[float]) -> Optional[float]:
+        # Without an explicit timeout, _wait_data() applies the socket
+        # timeout to each wait
+        if timeout is None:
+            return None
+        return time.monotonic() + timeout
 
     def recv(self, bufsize: int = 1, flags: int = 0) -> bytes:
         """Return chars from in memory buffer.
@@ -94,15 +263,117 @@ class ConsoleSocket(socket.socket):
         """
         if self._drain_thread is None:
             # Not buffering the socket, pass thru to socket.
+            with self._cond:
+                if self._buffer and not flags:
+                    # Left over by readline() or expect()
+                    return self._consume(bufsize)
             return socket.socket.recv(self, bufsize, flags)
         assert not flags, "Cannot pass flags to recv() in drained mode"
-        start_time = time.time()
-        while len(self._buffer) < bufsize:
-            time.sleep(self._sleep_time)
-            elapsed_sec = time.time() - start_time
-            if elapsed_sec > self._recv_timeout_sec:
-                raise socket.timeout
-        return bytes((self._buffer.popleft() for i in range(bufsize)))
+        with self._cond:
+            while len(self._buffer) < bufsize and not self._eof:
+                self._wait_data(None)
+            return self._consume(bufsize)
+
+    def recv_into(self, buffer: 'WriteableBuffer',
+                  nbytes: int = 0, flags: int = 0) -> int:
+        """Like socket.socket.recv_into, which makefile() relies on, but
+           reading from the in memory buffer in drained mode.
+        """
+        if self._drain_thread is None and not self._buffer:
+            return socket.socket.recv_into(self, buffer, nbytes, flags)
+        assert not flags, "Cannot pass flags to recv_into() in drained mode"
+        view = memoryview(buffer).cast('B')
+        nbytes = nbytes or len(view)
+        with self._cond:
+            if not self._buffer and not self._eof:
+                self._wait_data(None)
+            data = self._consume(nbytes)
+        view[:len(data)] = data
+        return len(data)
+
+    def readline(self, timeout: Optional[float] = None) -> bytes:
+        """
+        Return the next line, including its terminator, or what is left
+        at end of file.
+
+        @param timeout: timeout in seconds for the whole line (default:
+                        the socket timeout, for each wait for data)
+        @raise socket.timeout if no complete line arrives in time
+        """
+        deadline = self._deadline(timeout)
+        with self._cond:
+            while True:
+                end = self._buffer.find(b'\n', self._scan)
+                if end >= 0:
+                    return self._consume(end + 1)
+                self._scan = len(self._buffer)
+                if self._eof:
+                    return self._consume(len(self._buffer))
+                self._wait_data(deadline)
+
+    def expect(self, patterns: Sequence[ConsolePatternT],
+               timeout: Optional[float] = None,
+               on_line: Optional[Callable[[bytes], None]] = None
+               ) -> Tuple[int, bytes]:
+        """
+        Consume the console output until one of patterns matches.
+
+        The string patterns are compiled into a single alternation, which
+        is searched once over the data received, and complete lines are
+        consumed in bulk as data arrives.  Only the incomplete last line
+        stays buffered; just the part of it that could be the start of a
+        match is searched again for strings when more data arrives.  This
+        keeps the cost linear however long the output runs, and prompts
+        without a line terminator, such as "login:", are found too.
+
+        @param patterns: strings and bytes to look for, or compiled bytes
+                         regular expressions to search for; if several
+                         patterns match, the one that matches first in the
+                         output wins, then the first one in the list
+        @param timeout: timeout in seconds for the whole call (default:
+                        the socket timeout, for each wait for data, so that
+                        output that keeps coming is waited for indefinitely)
+        @param on_line: called with each consumed line that precedes the
+                        match, e.g. for logging
+        @return (index of the pattern that matched, the matching line; if
+                 the line is incomplete, only up to the end of the match
+                 is consumed and returned)
+        @raise socket.timeout if nothing matches in time
+        @raise EOFError if the console is closed first
+        """
+        search = _compile_patterns(patterns) if patterns else None
+
+        def consume_lines(size: int) -> None:
+            data = self._consume(size)
+            if on_line:
+                for line in data.splitlines(True):
+                    on_line(line)
+
+        deadline = self._deadline(timeout)
+        searched = 0
+        with self._cond:
+            while True:
+                found = search(self._buffer, searched) if search else None
+                if found:
+                    index, match = found
+                    line_start = self._buffer.rfind(b'\n', 0,
+                                                    match.start()) + 1
+                    consume_lines(line_start)
+                    end = match.end() - line_start
+                    if not self._buffer[end - 1:end] == b'\n':
+                        end = self._buffer.find(b'\n', end) + 1 or end
+                    return index, self._consume(end)
+
+                consume_lines(self._buffer.rfind(b'\n') + 1)
+                searched = len(self._buffer)
+                if self._eof:
+                    raise EOFError("Console closed")
+                self._wait_data(deadline)
+
+    def peek(self) -> bytes:
+        """Return the buffered data that was not consumed yet."""
+        with self._cond:
+            return bytes(self._buffer)
 
     def setblocking(self, value: bool) -> None:
         """When not draining we pass thru to the socket,
@@ -119,3 +390,92 @@ class ConsoleSocket(socket.socket):
             self._recv_timeout_sec = value
         if self._drain_thread is None:
             socket.socket.settimeout(self, value)
+
+
+class ConsoleMatcher:
+    """
+    Wait for messages on a console while logging its output line by line.
+
+    This is shared by the acceptance tests and the VM build tests.  It
+    relies on ConsoleSocket.expect(), which looks for all of the messages
+    in a single pass over the output.
+
+    @param console: the console of a VM
+    @param log: called with each line of output, cleaned up with
+                clean_console_line(); empty lines are skipped
+    @param raw_file: receives the output as it is consumed
+    """
+    def __init__(self, console: ConsoleSocket,
+                 log: Optional[Callable[[str], None]] = None,
+                 raw_file: Optional[BinaryIO] = None):
+        self._console = console
+        self._log = log
+        self._raw_file = raw_file
+
+    def _on_line(self, line: bytes) -> None:
+        if self._raw_file:
+            self._raw_file.write(line)
+        if self._log:
+            # Also split lines overwritten with a carriage return
+            for part in line.splitlines():
+                text = clean_console_line(part)
+                if text.strip():
+                    self._log(text)
+
+    def wait(self, patterns: Sequence[ConsolePatternT],
+             timeout: Optional[float] = None,
+             send: Optional[str] = None,
+             resend_interval: Optional[float] = None) -> int:
+        """
+        Wait for one of patterns to appear on the console.
+
+        @param patterns: see ConsoleSocket.expect()
+        @param timeout: timeout in seconds (default: the socket timeout)
+        @param send: string sent to the console before waiting
+        @param resend_interval: keep sending it at this interval, in
+                                seconds, until a pattern matches
+        @return the index of the pattern that matched
+        @raise socket.timeout if nothing matches in time
+        @raise EOFError if the console is closed first
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while True:
+            if send is not None:
+                self._console.sendall(send.encode('utf-8'))
+                if resend_interval is None:
+                    send = None
+            wait = timeout
+            if deadline is not None:
+                wait = max(0.0, deadline - time.monotonic())
+            if send is not None:
+                assert resend_interval is not None
+                wait = resend_interval if wait is None \
+                    else min(wait, resend_interval)
+            try:
+                index, line = self._console.expect(patterns, wait,
+                                                   self._on_line)
+            except socket.timeout:
+                if send is None or \
+                   deadline is not None and time.monotonic() >= deadline:
+                    raise
+                continue
+            self._on_line(line)
+            if self._raw_file:
+                self._raw_file.flush()
+            return index
+
+    def consume(self) -> None:
+        """
+        Consume and log the output received so far, without waiting.
+        """
+        try:
+            self._console.expect([], 0, self._on_line)
+        except socket.timeout:
+            pass
+        tail = self._console.peek()
+        if tail:
+            self._on_line(self._console.recv(len(tail)))
+        if self._raw_file:
+            self._raw_file.flush()
@@ -0,0 +1,172 @@
+"""
+QEMU fleet module:
+
+The fleet module provides the QEMUFleet class, which launches and shuts
+down a group of QEMUMachine instances concurrently.
+"""
+
+# This work is licensed under the terms of the GNU GPL, version 2.  See
+# the COPYING file in the top-level directory.
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import time
+from types import TracebackType
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Type,
+)
+
+from .machine import QEMUMachine, QEMUMachineError
+
+
+LOG = logging.getLogger(__name__)
+
+
+class QEMUFleetError(QEMUMachineError):
+    """
+    Exception raised when some machines of a fleet failed to launch or to
+    shut down.  `errors` maps the index of each failed machine to the
+    exception it raised.
+    """
+    def __init__(self, action: str, errors: Dict[int, Exception]):
+        details = '; '.join('#%d: %s' % (index, err)
+                            for index, err in sorted(errors.items()))
+        super().__init__('%d machine(s) failed to %s: %s' %
+                         (len(errors), action, details))
+        self.errors = errors
+
+
+class QEMUFleet:
+    """
+    A group of QEMUMachine instances, or instances of its subclasses such
+    as QEMUQtestMachine, that are launched and shut down concurrently::
+
+        machines = [QEMUQtestMachine(binary, name='vm%d' % i)
+                    for i in range(50)]
+        with QEMUFleet(machines, max_parallel=8) as fleet:
+            fleet.launch()
+            for vm in fleet:
+                vm.qtest('clock_step 1000')
+
+    Most of a launch is spent waiting for QEMU to start and connect to its
+    sockets, so the machines are launched by a pool of threads.  Give each
+    machine a distinct name, the socket paths are derived from it.
+
+    @param machines: the machines, not launched yet
+    @param max_parallel: maximum number of machines launched or shut down
+                         at the same time (default: number of CPUs)
+    @raise ValueError if two machines would use the same socket paths
+    """
+    def __init__(self, machines: Iterable[QEMUMachine],
+                 max_parallel: Optional[int] = None):
+        self._machines = list(machines)
+        seen: Dict[Tuple[str, str], int] = {}
+        for index, machine in enumerate(self._machines):
+            # pylint: disable=protected-access
+            key = (os.path.realpath(machine._sock_dir), machine._name)
+            if key in seen:
+                raise ValueError(
+                    "Machines #%d and #%d are both named '%s' in %s" %
+                    (seen[key], index, key[1], key[0]))
+            seen[key] = index
+        self._max_parallel = max_parallel or os.cpu_count() or 1
+        self._timings: List[Dict[str, float]] = [{} for _ in self._machines]
+
+    def __enter__(self) -> 'QEMUFleet':
+        return self
+
+    def __exit__(self,
+                 exc_type: Optional[Type[BaseException]],
+                 exc_val: Optional[BaseException],
+                 exc_tb: Optional[TracebackType]) -> None:
+        self.shutdown()
+
+    def __iter__(self) -> Iterator[QEMUMachine]:
+        return iter(self._machines)
+
+    def __len__(self) -> int:
+        return len(self._machines)
+
+    def __getitem__(self, index: int) -> QEMUMachine:
+        return self._machines[index]
+
+    def _run(self, phase: str, machines: List[int],
+             func: Callable[[QEMUMachine], None]) -> Dict[int, Exception]:
+        """
+        Call func on the given machines in the thread pool, recording how
+        long each call took as `phase`.
+
+        @return the exceptions raised, by machine index
+        """
+        def run(index: int) -> None:
+            start = time.monotonic()
+            try:
+                func(self._machines[index])
+            finally:
+                self._timings[index][phase] = time.monotonic() - start
+
+        errors = {}
+        with ThreadPoolExecutor(max_workers=self._max_parallel) as executor:
+            futures = {index: executor.submit(run, index)
+                       for index in machines}
+            for index, future in futures.items():
+                err = future.exception()
+                if isinstance(err, Exception):
+                    errors[index] = err
+                elif err is not None:
+                    raise err
+        return errors
+
+    def launch(self) -> None:
+        """
+        Launch all machines.
+
+        If any machine fails to launch, the others are shut down and
+        QEMUFleetError is raised.
+        """
+        indexes = list(range(len(self._machines)))
+        for index in indexes:
+            self._timings[index] = {}
+        start = time.monotonic()
+        errors = self._run('launch', indexes, lambda vm: vm.launch())
+        LOG.debug('Launched %d machines in %.3f s',
+                  len(self._machines) - len(errors), time.monotonic() - start)
+
+        for index, vm in enumerate(self._machines):
+            self._timings[index].update(vm.launch_timings)
+        if errors:
+            self._run('shutdown', [i for i in indexes if i not in errors],
+                      lambda vm: vm.shutdown(hard=True))
+            raise QEMUFleetError('launch', errors)
+
+    def shutdown(self, hard: bool = False,
+                 timeout: Optional[int] = 30) -> None:
+        """
+        Shut down all machines, see QEMUMachine.shutdown().  All machines
+        are cleaned up even if some of them fail to shut down gracefully.
+
+        @raise QEMUFleetError if some machines failed to shut down
+        """
+        errors = self._run('shutdown', list(range(len(self._machines))),
+                           lambda vm: vm.shutdown(hard=hard, timeout=timeout))
+        for index, vm in enumerate(self._machines):
+            self._timings[index].update(vm.shutdown_timings)
+        if errors:
+            raise QEMUFleetError('shut down', errors)
+
+    @property
+    def timings(self) -> List[Dict[str, float]]:
+        """
+        Returns the timings of each machine, in seconds: 'launch' and
+        'shutdown' for the whole launch() and shutdown() calls, plus the
+        phases of QEMUMachine.launch_timings and shutdown_timings.
+        """
+        return [dict(timing) for timing in self._timings]
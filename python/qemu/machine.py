@@ -17,29 +17,42 @@ which provides facilities for managing the lifetime of a QEMU VM.
 # Based on qmp.py.
 #
 
+import asyncio
+import atexit
 import errno
 from itertools import chain
 import logging
 import os
+import queue
 import shutil
 import signal
 import socket
 import subprocess
 import tempfile
+import threading
+import time
 from types import TracebackType
 from typing import (
     Any,
     BinaryIO,
+    Callable,
     Dict,
     List,
     Optional,
     Sequence,
+    TextIO,
     Tuple,
     Type,
 )
 
-from . import console_socket, qmp
-from .qmp import QMPMessage, QMPReturnValue, SocketAddrT
+from . import aqmp, console_socket, qmp
+from . import qmp_schema
+from .qmp import (
+    QMPMessage,
+    QMPPipeline,
+    QMPReturnValue,
+    SocketAddrT,
+)
 
 
 LOG = logging.getLogger(__name__)
@@ -67,6 +80,48 @@ class AbnormalShutdown(QEMUMachineError):
     """
 
 
+class _Reaper:
+    """
+    Run cleanup functions, such as removing temporary directories, in a
+    background thread.  Whatever is still queued when the interpreter
+    exits is completed by an atexit handler.
+    """
+    def __init__(self) -> None:
+        self._queue: 'queue.Queue[Tuple[Callable[..., Any], Any]]' = \
+            queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, func: Callable[..., Any], *args: Any) -> None:
+        """Queue a call to func(*args)."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='qemu-machine-reaper',
+                                                daemon=True)
+                self._thread.start()
+        self._queue.put((func, args))
+
+    def _run(self) -> None:
+        while True:
+            func, args = self._queue.get()
+            try:
+                func(*args)
+            except Exception as err:  # pylint: disable=broad-except
+                LOG.debug('Deferred cleanup failed: %s', err)
+            finally:
+                self._queue.task_done()
+
+    def join(self) -> None:
+        """Wait until all queued calls have completed."""
+        if self._thread is not None:
+            self._queue.join()
+
+
+_REAPER = _Reaper()
+atexit.register(_REAPER.join)
+
+
 class QEMUMachine:
     """
     A QEMU VM.
@@ -136,10 +191,17 @@ class QEMUMachine:
         self._qemu_log_path: Optional[str] = None
         self._qemu_log_file: Optional[BinaryIO] = None
         self._popen: Optional['subprocess.Popen[bytes]'] = None
-        self._events: List[QMPMessage] = []
+        self._qmp_event_limits: Dict[str, Any] = {}
+        self._qmp_schema: Optional[qmp_schema.QMPSchema] = None
+        self._launch_timings: Dict[str, float] = {}
+        self._shutdown_timings: Dict[str, float] = {}
+        self._fast_teardown = False
         self._iolog: Optional[str] = None
+        self._iolog_file: Optional[TextIO] = None
         self._qmp_set = True   # Enable QMP monitor by default.
         self._qmp_connection: Optional[qmp.QEMUMonitorProtocol] = None
+        self._qmp_async = False
+        self._aqmp_connection: Optional[aqmp.AsyncQEMUMonitorProtocol] = None
         self._qemu_full_args: Tuple[str, ...] = ()
         self._temp_dir: Optional[str] = None
         self._launched = False
@@ -152,6 +214,7 @@ class QEMUMachine:
         )
         self._console_socket: Optional[socket.socket] = None
         self._remove_files: List[str] = []
+        self._extra_monitors: List[str] = []
         self._user_killed = False
 
     def __enter__(self) -> 'QEMUMachine':
@@ -163,6 +226,12 @@ class QEMUMachine:
                  exc_tb: Optional[TracebackType]) -> None:
         self.shutdown()
 
+    def __del__(self) -> None:
+        # The I/O log of a fast teardown may still be open, if get_log()
+        # was not called.  __init__ may also have failed before setting it.
+        if getattr(self, '_iolog_file', None) is not None:
+            self._close_io_log()
+
     def add_monitor_null(self) -> None:
         """
         This can be used to add an unused monitor instance.
@@ -170,6 +239,18 @@ class QEMUMachine:
         self._args.append('-monitor')
         self._args.append('null')
 
+    def add_qmp_monitor(self, name: str) -> str:
+        """
+        Add a QMP monitor that QEMU listens on, for clients other than this
+        class, such as a QMPSampler.  Call this before launch().
+
+        @param name: suffix of the socket name, unique for this machine
+        @return the path of the monitor socket
+        """
+        path = os.path.join(self._sock_dir, f"{self._name}-{name}.sock")
+        self._extra_monitors.append(path)
+        return path
+
     def add_fd(self, fd: int, fdset: int,
                opaque: str, opts: str = '') -> 'QEMUMachine':
         """
@@ -270,9 +351,22 @@ class QEMUMachine:
 
     def _load_io_log(self) -> None:
         if self._qemu_log_path is not None:
+            if self._fast_teardown:
+                # Keep the file open so that it can be read by get_log()
+                # after the temporary directory is gone.  It is closed by
+                # get_log(), the next launch, or when the VM is freed.
+                # pylint: disable=consider-using-with
+                self._iolog_file = open(self._qemu_log_path, "r")
+                return
             with open(self._qemu_log_path, "r") as iolog:
                 self._iolog = iolog.read()
 
+    def _close_io_log(self) -> None:
+        self._iolog = None
+        if self._iolog_file is not None:
+            self._iolog_file.close()
+            self._iolog_file = None
+
     @property
     def _base_args(self) -> List[str]:
         args = ['-display', 'none', '-vga', 'none']
@@ -286,6 +380,11 @@ class QEMUMachine:
                 moncdev = f"socket,id=mon,path={self._monitor_address}"
             args.extend(['-chardev', moncdev, '-mon',
                          'chardev=mon,mode=control'])
+        for index, path in enumerate(self._extra_monitors):
+            args.extend(['-chardev',
+                         'socket,id=mon%d,path=%s,server=on,wait=off' %
+                         (index + 1, path),
+                         '-mon', 'chardev=mon%d,mode=control' % (index + 1)])
 
         if self._machine is not None:
             args.extend(['-machine', self._machine])
@@ -310,20 +409,35 @@ class QEMUMachine:
 
         if self._console_set:
             self._remove_files.append(self._console_address)
+        self._remove_files.extend(self._extra_monitors)
 
         if self._qmp_set:
             if self._remove_monitor_sockfile:
                 assert isinstance(self._monitor_address, str)
                 self._remove_files.append(self._monitor_address)
-            self._qmp_connection = qmp.QEMUMonitorProtocol(
-                self._monitor_address,
-                server=True,
-                nickname=self._name
-            )
+            if self._qmp_async:
+                self._aqmp_connection = aqmp.AsyncQEMUMonitorProtocol(
+                    self._monitor_address,
+                    server=True,
+                    nickname=self._name,
+                    event_queue=qmp.QMPEventQueue(**self._qmp_event_limits)
+                )
+            else:
+                self._qmp_connection = qmp.QEMUMonitorProtocol(
+                    self._monitor_address,
+                    server=True,
+                    nickname=self._name,
+                    event_queue=qmp.QMPEventQueue(**self._qmp_event_limits)
+                )
 
     def _post_launch(self) -> None:
         if self._qmp_connection:
-            self._qmp.accept()
+            start = time.monotonic()
+            self._qmp.accept(negotiate=False)
+            ready = time.monotonic()
+            self._qmp.negotiate()
+            self._launch_timings['monitor'] = ready - start
+            self._launch_timings['negotiate'] = time.monotonic() - ready
 
     def _post_shutdown(self) -> None:
         """
@@ -333,10 +447,18 @@ class QEMUMachine:
         # Comprehensive reset for the failed launch case:
         self._early_cleanup()
 
+        start = time.monotonic()
         if self._qmp_connection:
-            self._qmp.close()
+            if self._fast_teardown:
+                _REAPER.submit(self._qmp_connection.close)
+            else:
+                self._qmp.close()
             self._qmp_connection = None
 
+        # The asynchronous monitor was closed by its event loop
+        assert self._aqmp_connection is None
+
+        log_start = time.monotonic()
         self._load_io_log()
 
         if self._qemu_log_file is not None:
@@ -345,13 +467,24 @@ class QEMUMachine:
 
         self._qemu_log_path = None
 
+        cleanup_start = time.monotonic()
         if self._temp_dir is not None:
-            shutil.rmtree(self._temp_dir)
+            if self._fast_teardown:
+                _REAPER.submit(shutil.rmtree, self._temp_dir, True)
+            else:
+                shutil.rmtree(self._temp_dir)
             self._temp_dir = None
 
+        # Sockets are removed right away, a new instance with the same name
+        # would create them again.
         while len(self._remove_files) > 0:
             self._remove_if_exists(self._remove_files.pop())
 
+        end = time.monotonic()
+        self._shutdown_timings['qmp'] = log_start - start
+        self._shutdown_timings['log'] = cleanup_start - log_start
+        self._shutdown_timings['cleanup'] = end - cleanup_start
+
         exitcode = self.exitcode()
         if (exitcode is not None and exitcode < 0
                 and not (self._user_killed and exitcode == -signal.SIGKILL)):
@@ -374,26 +507,109 @@ class QEMUMachine:
         if self._launched:
             raise QEMUMachineError('VM already launched')
 
-        self._iolog = None
+        self._close_io_log()
         self._qemu_full_args = ()
+        self._launch_timings = {}
+        self._shutdown_timings = {}
+        self._qmp_async = False
         try:
             self._launch()
             self._launched = True
         except:
             self._post_shutdown()
+            self._log_launch_failure()
+            raise
 
-            LOG.debug('Error launching VM')
-            if self._qemu_full_args:
-                LOG.debug('Command: %r', ' '.join(self._qemu_full_args))
-            if self._iolog:
-                LOG.debug('Output: %r', self._iolog)
+    async def launch_async(self) -> None:
+        """
+        Launch the VM and accept the QMP connection without blocking the
+        event loop.
+
+        The QMP monitor is then an AsyncQEMUMonitorProtocol, available as
+        the `async_qmp` property, and the synchronous QMP methods of this class
+        cannot be used.  Use shutdown_async() to stop the VM, from the same
+        event loop; shutdown(), kill() and wait() raise QEMUMachineError.
+        """
+
+        if self._launched:
+            raise QEMUMachineError('VM already launched')
+
+        self._close_io_log()
+        self._qemu_full_args = ()
+        self._launch_timings = {}
+        self._shutdown_timings = {}
+        self._qmp_async = True
+        try:
+            self._launch()
+            if self._aqmp_connection:
+                start = time.monotonic()
+                await self._aqmp_connection.accept(negotiate=False)
+                ready = time.monotonic()
+                await self._aqmp_connection.negotiate()
+                self._launch_timings['monitor'] = ready - start
+                self._launch_timings['negotiate'] = time.monotonic() - ready
+            self._launched = True
+        except BaseException:
+            await self._close_aqmp()
+            self._post_shutdown()
+            self._log_launch_failure()
             raise
 
+    async def _close_aqmp(self) -> None:
+        if self._aqmp_connection:
+            await self._aqmp_connection.aclose()
+            self._aqmp_connection = None
+
+    @property
+    def launch_timings(self) -> Dict[str, float]:
+        """
+        Returns the duration in seconds of each phase of the last launch:
+        'spawn' until the QEMU process is started, 'monitor' until QEMU
+        connects to the QMP socket, and 'negotiate' for the greeting and
+        capabilities negotiation.  QEMUQtestMachine adds 'qtest', until
+        QEMU connects to the qtest socket.
+        """
+        return dict(self._launch_timings)
+
+    @property
+    def shutdown_timings(self) -> Dict[str, float]:
+        """
+        Returns the duration in seconds of each phase of the last shutdown:
+        'stop' until the QEMU process has exited, 'qmp' to close the QMP
+        connection, 'log' to load the I/O log and 'cleanup' to remove the
+        temporary files.
+        """
+        return dict(self._shutdown_timings)
+
+    def set_fast_teardown(self, enabled: bool = True) -> None:
+        """
+        Make shutdown() as cheap as possible, for VMs whose state does not
+        need to be preserved: QEMU is killed with SIGKILL instead of being
+        asked to quit, the QMP connection is closed and the temporary
+        directory is removed by a background thread, and the I/O log is
+        only read when get_log() is first called.
+
+        shutdown(has_quit=True) and wait() still wait for QEMU to exit on
+        its own.
+
+        @param enabled: if False, restore the default graceful teardown
+        """
+        self._fast_teardown = enabled
+
+    def _log_launch_failure(self) -> None:
+        LOG.debug('Error launching VM')
+        if self._qemu_full_args:
+            LOG.debug('Command: %r', ' '.join(self._qemu_full_args))
+        iolog = self.get_log()
+        if iolog:
+            LOG.debug('Output: %r', iolog)
+
     def _launch(self) -> None:
         """
         Launch the VM and establish a QMP connection
         """
         devnull = open(os.path.devnull, 'rb')
+        start = time.monotonic()
         self._pre_launch()
         self._qemu_full_args = tuple(
             chain(self._wrapper,
@@ -408,6 +624,7 @@ class QEMUMachine:
                                        stderr=subprocess.STDOUT,
                                        shell=False,
                                        close_fds=False)
+        self._launch_timings['spawn'] = time.monotonic() - start
         self._post_launch()
 
     def _early_cleanup(self) -> None:
@@ -495,19 +712,77 @@ class QEMUMachine:
                      suppress the SIGKILL warning log message.
         :param timeout: Optional timeout in seconds for graceful shutdown.
                         Default 30 seconds, A `None` value is an infinite wait.
+
+        :raise QEMUMachineError: If the VM was started with launch_async();
+            its monitor can only be closed by its event loop.
         """
         if not self._launched:
             return
+        if self._aqmp_connection is not None:
+            raise QEMUMachineError('VM launched with launch_async(), '
+                                   'use shutdown_async()')
 
+        self._shutdown_timings = {}
+        start = time.monotonic()
         try:
-            if hard:
+            if hard or (self._fast_teardown and not has_quit):
                 self._user_killed = True
                 self._hard_shutdown()
             else:
                 self._do_shutdown(timeout, has_quit)
         finally:
+            self._shutdown_timings['stop'] = time.monotonic() - start
             self._post_shutdown()
 
+    async def shutdown_async(self, has_quit: bool = False,
+                             hard: bool = False,
+                             timeout: Optional[int] = 30) -> None:
+        """
+        Terminate a VM started with launch_async() gracefully, falling back
+        to SIGKILL, and perform cleanup.  Waiting for the QEMU process does
+        not block the event loop.
+
+        :param has_quit: When true, do not attempt to issue 'quit' QMP command.
+        :param hard: When true, do not attempt graceful shutdown, and
+                     suppress the SIGKILL warning log message.
+        :param timeout: Optional timeout in seconds for graceful shutdown.
+                        Default 30 seconds, A `None` value is an infinite wait.
+
+        :raise AbnormalShutdown: When the VM could not be shut down gracefully.
+        """
+        if not self._launched:
+            return
+
+        self._shutdown_timings = {}
+        start = time.monotonic()
+        try:
+            if hard or (self._fast_teardown and not has_quit):
+                self._user_killed = True
+                self._hard_shutdown()
+                return
+            self._early_cleanup()
+            try:
+                if self._aqmp_connection and not has_quit:
+                    await self._aqmp_connection.cmd('quit')
+                deadline = None
+                if timeout is not None:
+                    deadline = time.monotonic() + timeout
+                while self._subp.poll() is None:
+                    if deadline is not None and time.monotonic() > deadline:
+                        raise subprocess.TimeoutExpired(self._qemu_full_args,
+                                                        timeout or 0)
+                    await asyncio.sleep(0.05)
+            except Exception as exc:
+                self._hard_shutdown()
+                raise AbnormalShutdown("Could not perform graceful shutdown") \
+                    from exc
+        finally:
+            try:
+                await self._close_aqmp()
+            finally:
+                self._shutdown_timings['stop'] = time.monotonic() - start
+                self._post_shutdown()
+
     def kill(self) -> None:
         """
         Terminate the VM forcefully, wait for it to exit, and perform cleanup.
@@ -534,14 +809,77 @@ class QEMUMachine:
         """
         self._qmp_set = enabled
 
+    def set_qmp_event_limits(self, maxlen: Optional[int] = None,
+                             max_per_name: Optional[int] = None,
+                             max_age: Optional[float] = None) -> None:
+        """
+        Bound the queue of QMP events that have not been consumed yet.
+
+        @param maxlen: maximum number of queued events
+        @param max_per_name: maximum number of queued events of each name
+        @param max_age: maximum time in seconds an event stays queued
+        @note: call this function before launch().  Dropped events are
+               counted in qmp_event_queue.dropped.
+        """
+        self._qmp_event_limits = {'maxlen': maxlen,
+                                  'max_per_name': max_per_name,
+                                  'max_age': max_age}
+
+    @property
+    def qmp_event_queue(self) -> qmp.QMPEventQueue:
+        """
+        Returns the queue of QMP events that have not been consumed yet.
+        """
+        return self._qmp.event_queue
+
     @property
     def _qmp(self) -> qmp.QEMUMonitorProtocol:
         if self._qmp_connection is None:
             raise QEMUMachineError("Attempt to access QMP with no connection")
         return self._qmp_connection
 
-    @classmethod
-    def _qmp_args(cls, _conv_keys: bool = True, **args: Any) -> Dict[str, Any]:
+    @property
+    def async_qmp(self) -> aqmp.AsyncQEMUMonitorProtocol:
+        """
+        Returns the asynchronous QMP connection of a VM started with
+        launch_async().
+        """
+        if self._aqmp_connection is None:
+            raise QEMUMachineError("Attempt to access QMP with no connection")
+        return self._aqmp_connection
+
+    def load_qmp_schema(self, cache_dir: Optional[str] = None
+                        ) -> qmp_schema.QMPSchema:
+        """
+        Fetch the QMP schema of the running VM and use it to convert and
+        validate the arguments of qmp() and command() locally, without a
+        round trip to QEMU.  The schema stays in use across relaunches.
+
+        @param cache_dir: where to cache schemas across processes, keyed by
+                          QEMU version, target and binary (path, size and
+                          modification time; default: ~/.cache/qemu)
+        @raise QMPArgumentError from qmp() and command() on bad arguments
+        """
+        if cache_dir is None:
+            cache_dir = qmp_schema.default_cache_dir()
+        self._qmp_schema = qmp_schema.QMPSchema.fetch(self._qmp, cache_dir,
+                                                      self._binary)
+        return self._qmp_schema
+
+    @property
+    def qmp_api(self) -> qmp_schema.QMPCommands:
+        """
+        Returns an object with a method for each QMP command, for example
+        vm.qmp_api.query_status().  Requires load_qmp_schema().
+        """
+        if self._qmp_schema is None:
+            raise QEMUMachineError("QMP schema not loaded")
+        return self._qmp_schema.bind(self._qmp)
+
+    def _qmp_args(self, cmd: str, _conv_keys: bool = True,
+                  **args: Any) -> Dict[str, Any]:
+        if self._qmp_schema is not None:
+            return self._qmp_schema.arguments(cmd, args, _conv_keys)
         qmp_args = dict()
         for key, value in args.items():
             if _conv_keys:
@@ -556,7 +894,7 @@ class QEMUMachine:
         """
         Invoke a QMP command and return the response dict
         """
-        qmp_args = self._qmp_args(conv_keys, **args)
+        qmp_args = self._qmp_args(cmd, conv_keys, **args)
         return self._qmp.cmd(cmd, args=qmp_args)
 
     def command(self, cmd: str,
@@ -567,15 +905,20 @@ class QEMUMachine:
         On success return the response dict.
         On failure raise an exception.
         """
-        qmp_args = self._qmp_args(conv_keys, **args)
+        qmp_args = self._qmp_args(cmd, conv_keys, **args)
         return self._qmp.command(cmd, **qmp_args)
 
+    def qmp_pipeline(self) -> QMPPipeline:
+        """
+        Return a pipeline to send several QMP commands with a single write.
+        See QMPPipeline.
+        """
+        return self._qmp.pipeline()
+
     def get_qmp_event(self, wait: bool = False) -> Optional[QMPMessage]:
         """
         Poll for one queued QMP events and return it
         """
-        if self._events:
-            return self._events.pop(0)
         return self._qmp.pull_event(wait=wait)
 
     def get_qmp_events(self, wait: bool = False) -> List[QMPMessage]:
@@ -583,8 +926,6 @@ class QEMUMachine:
         Poll for queued QMP events and return a list of dicts
         """
         events = self._qmp.get_events(wait=wait)
-        events.extend(self._events)
-        del self._events[:]
         self._qmp.clear_events()
         return events
 
@@ -606,20 +947,7 @@ class QEMUMachine:
          - {"foo": {"abc": None}} does not match {"foo": {"bar": 1}}
          - {"foo": {"rab": 2}} matches {"foo": {"bar": 1, "rab": 2}}
         """
-        if match is None:
-            return True
-
-        try:
-            for key in match:
-                if key in event:
-                    if not QEMUMachine.event_match(event[key], match[key]):
-                        return False
-                else:
-                    return False
-            return True
-        except TypeError:
-            # either match or event wasn't iterable (not a dict)
-            return bool(match == event)
+        return qmp.event_match(event, match)
 
     def event_wait(self, name: str,
                    timeout: float = 60.0,
@@ -651,39 +979,24 @@ class QEMUMachine:
                                 were found.
         :return: A QMP event matching the filter criteria.
                  If timeout was 0 and no event matched, None.
-        """
-        def _match(event: QMPMessage) -> bool:
-            for name, match in events:
-                if event['event'] == name and self.event_match(event, match):
-                    return True
-            return False
-
-        event: Optional[QMPMessage]
-
-        # Search cached events
-        for event in self._events:
-            if _match(event):
-                self._events.remove(event)
-                return event
 
-        # Poll for new events
-        while True:
-            event = self._qmp.pull_event(wait=timeout)
-            if event is None:
-                # NB: None is only returned when timeout is false-ish.
-                # Timeouts raise QMPTimeoutError instead!
-                break
-            if _match(event):
-                return event
-            self._events.append(event)
-
-        return None
+        Events that do not match stay queued for later calls.  The queue is
+        indexed by event name, so cached events of other names are not
+        examined.
+        """
+        # NB: None is only returned when timeout is false-ish.
+        # Timeouts raise QMPTimeoutError instead!
+        return self._qmp.pull_matching_event(events, wait=timeout)
 
     def get_log(self) -> Optional[str]:
         """
         After self.shutdown or failed qemu execution, this returns the output
         of the qemu process.
         """
+        if self._iolog_file is not None:
+            self._iolog = self._iolog_file.read()
+            self._iolog_file.close()
+            self._iolog_file = None
         return self._iolog
 
     def add_args(self, *args: str) -> None:
@@ -0,0 +1,278 @@
+"""
+QEMU machine pool module:
+
+The pool module provides the QEMUMachinePool class, which keeps QEMU
+processes started ahead of time so that tests do not wait for QEMU to
+start.
+"""
+
+# This work is licensed under the terms of the GNU GPL, version 2.  See
+# the COPYING file in the top-level directory.
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import logging
+import os
+import queue
+import threading
+from types import TracebackType
+from typing import (
+    Any,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Type,
+    Union,
+)
+
+from .fleet import QEMUFleet
+from .machine import QEMUMachine, QEMUMachineError
+from .qmp import QMPMessage
+from .qtest import QEMUQtestMachine
+
+
+LOG = logging.getLogger(__name__)
+
+
+class QEMUMachinePool:
+    """
+    A pool of QEMU machines launched in advance, paused with -S and with
+    QMP already negotiated::
+
+        with QEMUMachinePool(binary, size=4) as pool:
+            for test in tests:
+                with pool.machine(blockdevs=[{'driver': 'null-co',
+                                              'node-name': 'disk0'}],
+                                  devices=[{'driver': 'virtio-blk',
+                                            'drive': 'disk0'}]) as vm:
+                    test(vm)
+
+    Devices are added after launch with blockdev-add and device_add, so
+    all machines of a pool share the same command line.  Each acquired
+    machine is replaced in the background.  A released machine is shut
+    down, unless the test knows that it left no state behind, in which
+    case it can be recycled: acquire it with recycle=True, so that no
+    replacement is launched, and it goes back to the pool when released.
+
+    @param binary: path to the qemu binary
+    @param size: number of machines kept ready
+    @param args: extra arguments, common to all machines
+    @param machine_class: QEMUQtestMachine or a subclass of it
+    @param name: prefix of the machine names (default: qemu-pool-PID)
+    @param kwargs: passed to the machine_class constructor, e.g. test_dir
+    """
+    def __init__(self, binary: str, size: int = 4,
+                 args: Sequence[str] = (),
+                 machine_class: Type[QEMUQtestMachine] = QEMUQtestMachine,
+                 name: Optional[str] = None,
+                 **kwargs: Any):
+        self._binary = binary
+        self._size = size
+        self._args = ['-S'] + list(args)
+        self._machine_class = machine_class
+        self._name = name or "qemu-pool-%d" % os.getpid()
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._count = 0
+        self._launching = 0
+        self._closed = False
+        # Launched machines, or the exception raised by a failed launch
+        self._ready: 'queue.Queue[Union[QEMUQtestMachine, Exception]]' = \
+            queue.Queue()
+        self._in_use: Set[QEMUQtestMachine] = set()
+        # Machines acquired with recycle=True, which were not replaced
+        self._recyclable: Set[QEMUQtestMachine] = set()
+        #: Number of machines put back in the pool by release()
+        self.recycled = 0
+        self._executor = ThreadPoolExecutor(max_workers=size)
+        for _ in range(size):
+            self._replace()
+
+    def __enter__(self) -> 'QEMUMachinePool':
+        return self
+
+    def __exit__(self,
+                 exc_type: Optional[Type[BaseException]],
+                 exc_val: Optional[BaseException],
+                 exc_tb: Optional[TracebackType]) -> None:
+        self.close()
+
+    def _new_machine(self) -> QEMUQtestMachine:
+        with self._lock:
+            self._count += 1
+            name = '%s-%d' % (self._name, self._count)
+        return self._machine_class(self._binary, self._args, name=name,
+                                   **self._kwargs)
+
+    def _launch(self) -> None:
+        try:
+            if self._closed:
+                return
+            try:
+                vm = self._new_machine()
+                vm.launch()
+            except Exception as err:  # pylint: disable=broad-except
+                LOG.warning('Pool machine failed to launch: %s', err)
+                self._ready.put(err)
+                return
+            if self._closed:
+                vm.shutdown()
+            else:
+                self._ready.put(vm)
+        finally:
+            with self._lock:
+                self._launching -= 1
+
+    def _replace(self) -> None:
+        with self._lock:
+            self._launching += 1
+        self._executor.submit(self._launch)
+
+    def _discard(self, vm: QEMUQtestMachine) -> None:
+        if self._closed:
+            vm.shutdown(hard=True)
+        else:
+            self._executor.submit(vm.shutdown, hard=True)
+
+    def acquire(self, blockdevs: Sequence[QMPMessage] = (),
+                devices: Sequence[QMPMessage] = (),
+                start: bool = False,
+                timeout: Optional[float] = None,
+                recycle: bool = False) -> QEMUQtestMachine:
+        """
+        Take a machine from the pool, and launch a replacement in the
+        background unless recycle is true.
+
+        @param blockdevs: arguments of blockdev-add commands to execute
+        @param devices: arguments of device_add commands to execute
+        @param start: resume the guest once the devices are added
+        @param timeout: how long to wait for a machine to be ready,
+                        None to wait forever
+        @param recycle: the machine will be released with recycle=True,
+                        so do not replace it; if it cannot be recycled,
+                        release() launches the replacement instead
+        @return a launched machine, paused unless start is true
+        @raise ValueError if recycle is true and devices are given
+        @raise QEMUMachineError if no machine is ready within timeout, or
+               the exception raised by the launch of the next machine
+        @raise QMPResponseError if a command fails; the machine is then
+               discarded
+        """
+        if recycle and (blockdevs or devices):
+            raise ValueError('Machines with added devices cannot be recycled')
+        if self._closed:
+            raise QEMUMachineError('Machine pool is closed')
+        try:
+            item = self._ready.get(timeout=timeout)
+        except queue.Empty:
+            raise QEMUMachineError('No pool machine ready after %s s' %
+                                   timeout) from None
+        if isinstance(item, Exception):
+            self._replace()
+            raise item
+        vm = item
+        with self._lock:
+            self._in_use.add(vm)
+            if recycle:
+                self._recyclable.add(vm)
+        if not recycle:
+            self._replace()
+
+        try:
+            self._configure(vm, blockdevs, devices, start)
+        except BaseException:
+            self.release(vm)
+            raise
+        return vm
+
+    @staticmethod
+    def _configure(vm: QEMUMachine, blockdevs: Sequence[QMPMessage],
+                   devices: Sequence[QMPMessage], start: bool) -> None:
+        if not blockdevs and not devices and not start:
+            return
+        # One write and one round trip for all of the commands
+        with vm.qmp_pipeline() as pipe:
+            futures = [pipe.command('blockdev-add', **args)
+                       for args in blockdevs]
+            futures.extend(pipe.command('device_add', **args)
+                           for args in devices)
+            if start:
+                futures.append(pipe.command('cont'))
+        for future in futures:
+            future.result()
+
+    def release(self, vm: QEMUQtestMachine, recycle: bool = False) -> None:
+        """
+        Give back a machine obtained with acquire().  It is shut down in
+        the background.
+
+        @param recycle: put the machine back in the pool instead, if the
+                        pool is not full, which is only the case if it was
+                        acquired with recycle=True.  Only use this if the
+                        test did not add devices or change any state that
+                        a reset does not undo; the guest is paused, reset
+                        and pending events are dropped.
+        """
+        with self._lock:
+            self._in_use.discard(vm)
+            unreplaced = vm in self._recyclable
+            self._recyclable.discard(vm)
+        if (recycle and not self._closed and vm.is_running() and
+                self._ready.qsize() + self._launching < self._size):
+            try:
+                with vm.qmp_pipeline() as pipe:
+                    stop = pipe.command('stop')
+                    reset = pipe.command('system_reset')
+                stop.result()
+                reset.result()
+                vm.get_qmp_events()
+                self._ready.put(vm)
+                with self._lock:
+                    self.recycled += 1
+                return
+            except Exception as err:  # pylint: disable=broad-except
+                LOG.debug('Cannot recycle pool machine: %s', err)
+        self._discard(vm)
+        if unreplaced and not self._closed:
+            self._replace()
+
+    @contextmanager
+    def machine(self, blockdevs: Sequence[QMPMessage] = (),
+                devices: Sequence[QMPMessage] = (),
+                start: bool = False,
+                timeout: Optional[float] = None,
+                recycle: bool = False
+                ) -> Iterator[QEMUQtestMachine]:
+        """
+        Acquire a machine for the duration of a with block, and discard it
+        at the end, or recycle it if recycle is true.  See acquire() for
+        the arguments.
+        """
+        vm = self.acquire(blockdevs, devices, start, timeout, recycle)
+        try:
+            yield vm
+        finally:
+            self.release(vm, recycle)
+
+    def close(self) -> None:
+        """
+        Shut down all machines, including the ones still in use, and wait
+        for the background launches to finish.
+        """
+        self._closed = True
+        self._executor.shutdown(wait=True)
+        machines: List[QEMUQtestMachine] = []
+        with self._lock:
+            machines.extend(self._in_use)
+            self._in_use.clear()
+            self._recyclable.clear()
+        while True:
+            try:
+                item = self._ready.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, QEMUQtestMachine):
+                machines.append(item)
+        QEMUFleet(machines).shutdown(hard=True)
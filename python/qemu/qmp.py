@@ -7,17 +7,23 @@
 # This work is licensed under the terms of the GNU GPL, version 2.  See
 # the COPYING file in the top-level directory.
 
+from collections import OrderedDict
+from concurrent.futures import Future
 import errno
+import importlib
 import json
 import logging
 import socket
+import time
 from types import TracebackType
 from typing import (
     Any,
+    Callable,
     Dict,
+    Iterator,
     List,
     Optional,
-    TextIO,
+    Sequence,
     Tuple,
     Type,
     Union,
@@ -38,6 +44,41 @@ InternetAddrT = Tuple[str, str]
 UnixAddrT = str
 SocketAddrT = Union[InternetAddrT, UnixAddrT]
 
+# Initial size of the receive buffer; it grows to fit the largest message
+RECV_BUFFER_SIZE = 64 * 1024
+
+JSONLoadsT = Callable[[Union[bytes, bytearray]], Any]
+
+
+def _stdlib_json_loads(data: Union[bytes, bytearray]) -> Any:
+    # QMP is always UTF-8; skip json.loads() encoding detection
+    return json.loads(data.decode('utf-8'))
+
+
+_JSON_BACKENDS: Dict[str, JSONLoadsT] = {'json': _stdlib_json_loads}
+try:
+    _JSON_BACKENDS['orjson'] = importlib.import_module('orjson').loads
+except ImportError:
+    pass
+_json_loads = _JSON_BACKENDS.get('orjson', _stdlib_json_loads)
+
+
+def set_json_backend(backend: str) -> None:
+    """
+    Select the JSON decoder used for received QMP messages.
+
+    @param backend: 'json' for the standard library, or 'orjson', which is
+                    used by default if installed and is several times faster
+                    on large replies
+    @raise ValueError if the backend is not available
+    """
+    global _json_loads  # pylint: disable=global-statement
+    try:
+        _json_loads = _JSON_BACKENDS[backend]
+    except KeyError:
+        raise ValueError("JSON backend '%s' is not available" % backend) \
+            from None
+
 
 class QMPError(Exception):
     """
@@ -82,6 +123,216 @@ class QMPResponseError(QMPError):
         self.reply = reply
 
 
+def event_match(event: Any, match: Optional[Any]) -> bool:
+    """
+    Check if an event matches optional match criteria.
+
+    The match criteria takes the form of a matching subdict. The event is
+    checked to be a superset of the subdict, recursively, with matching
+    values whenever the subdict values are not None.
+
+    This has a limitation that you cannot explicitly check for None values.
+
+    Examples, with the subdict queries on the left:
+     - None matches any object.
+     - {"foo": None} matches {"foo": {"bar": 1}}
+     - {"foo": None} matches {"foo": 5}
+     - {"foo": {"abc": None}} does not match {"foo": {"bar": 1}}
+     - {"foo": {"rab": 2}} matches {"foo": {"bar": 1, "rab": 2}}
+    """
+    if match is None:
+        return True
+
+    try:
+        for key in match:
+            if key in event:
+                if not event_match(event[key], match[key]):
+                    return False
+            else:
+                return False
+        return True
+    except TypeError:
+        # either match or event wasn't iterable (not a dict)
+        return bool(match == event)
+
+
+# Helpers shared by QEMUMonitorProtocol and AsyncQEMUMonitorProtocol
+
+def _qmp_socket(address: SocketAddrT, server: bool) -> socket.socket:
+    if isinstance(address, tuple):
+        family = socket.AF_INET
+    else:
+        family = socket.AF_UNIX
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    if server:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(address)
+        sock.listen(1)
+    return sock
+
+
+def _check_greeting(greeting: Optional[QMPMessage]) -> QMPMessage:
+    if greeting is None or "QMP" not in greeting:
+        raise QMPConnectError
+    return greeting
+
+
+def _check_capabilities(resp: Optional[QMPMessage]) -> None:
+    if not resp or "return" not in resp:
+        raise QMPCapabilitiesError
+
+
+def _build_command(name: str,
+                   args: Optional[Dict[str, Any]] = None,
+                   cmd_id: Optional[Any] = None) -> QMPMessage:
+    qmp_cmd: QMPMessage = {'execute': name}
+    if args:
+        qmp_cmd['arguments'] = args
+    if cmd_id:
+        qmp_cmd['id'] = cmd_id
+    return qmp_cmd
+
+
+def _return_value(ret: QMPMessage) -> QMPReturnValue:
+    if 'error' in ret:
+        raise QMPResponseError(ret)
+    if 'return' not in ret:
+        raise QMPProtocolError(
+            "'return' key not found in QMP response '{}'".format(str(ret))
+        )
+    return cast(QMPReturnValue, ret['return'])
+
+
+class QMPEventQueue:
+    """
+    Queue of received QMP events, indexed by event name.
+
+    Events are kept in arrival order, and also per event name so that
+    looking for a given event only looks at events of that name.  The
+    queue can be bounded to avoid unlimited growth when QEMU emits events
+    at a high rate and nobody consumes them:
+
+    - maxlen: keep at most this many events, dropping the oldest ones
+    - max_per_name: keep at most this many events of each name, dropping
+      the oldest events of that name, so that a flood of one event does
+      not evict the others
+    - max_age: drop events that were received more than this many seconds
+      ago
+
+    The number of events dropped is counted per event name in `dropped`.
+    """
+
+    def __init__(self, maxlen: Optional[int] = None,
+                 max_per_name: Optional[int] = None,
+                 max_age: Optional[float] = None):
+        self.maxlen = maxlen
+        self.max_per_name = max_per_name
+        self.max_age = max_age
+        #: Number of events dropped from the queue, per event name
+        self.dropped: Dict[str, int] = {}
+        self._seq = 0
+        # Sequence number -> (arrival time, event), and per event name
+        # sequence number -> event.  OrderedDicts find their oldest entry in
+        # constant time even after many removals, unlike plain dicts.
+        self._events: Dict[int, Tuple[float, QMPMessage]] = OrderedDict()
+        self._by_name: Dict[str, Dict[int, QMPMessage]] = {}
+
+    def __len__(self) -> int:
+        self.expire()
+        return len(self._events)
+
+    def __iter__(self) -> Iterator[QMPMessage]:
+        self.expire()
+        return (event for _, event in self._events.values())
+
+    @property
+    def dropped_total(self) -> int:
+        """Total number of events dropped from the queue."""
+        return sum(self.dropped.values())
+
+    def _remove(self, seq: int, drop: bool = False) -> QMPMessage:
+        _, event = self._events.pop(seq)
+        name = event['event']
+        by_name = self._by_name[name]
+        del by_name[seq]
+        if not by_name:
+            del self._by_name[name]
+        if drop:
+            self.dropped[name] = self.dropped.get(name, 0) + 1
+        return event
+
+    def expire(self) -> None:
+        """Drop the events older than max_age."""
+        if self.max_age is None:
+            return
+        limit = time.monotonic() - self.max_age
+        # Events are in arrival order, stop at the first recent one
+        while self._events:
+            seq, (arrival, _) = next(iter(self._events.items()))
+            if arrival >= limit:
+                break
+            self._remove(seq, drop=True)
+
+    def append(self, event: QMPMessage) -> None:
+        """Add an event, evicting old events as configured."""
+        self._seq += 1
+        name = event['event']
+        self._events[self._seq] = (time.monotonic(), event)
+        by_name = self._by_name.get(name)
+        if by_name is None:
+            by_name = self._by_name[name] = OrderedDict()
+        by_name[self._seq] = event
+        if self.max_per_name is not None:
+            while len(by_name) > self.max_per_name:
+                self._remove(next(iter(by_name)), drop=True)
+        if self.maxlen is not None:
+            while len(self._events) > self.maxlen:
+                self._remove(next(iter(self._events)), drop=True)
+        self.expire()
+
+    def popleft(self) -> Optional[QMPMessage]:
+        """Remove and return the oldest event, or None if empty."""
+        self.expire()
+        if not self._events:
+            return None
+        return self._remove(next(iter(self._events)))
+
+    def pop_last(self) -> Optional[QMPMessage]:
+        """
+        Remove and return the last event added by append(), or None if it
+        is no longer queued.
+        """
+        if self._seq not in self._events:
+            return None
+        return self._remove(self._seq)
+
+    def pop_match(self,
+                  events: Sequence[Tuple[str, Any]]) -> Optional[QMPMessage]:
+        """
+        Remove and return the oldest event matching any of the criteria,
+        or None.  Only events with one of the given names are examined.
+
+        @param events: a sequence of (name, match) tuples, see event_match()
+        """
+        self.expire()
+        found: Optional[int] = None
+        for name, match in events:
+            for seq, event in self._by_name.get(name, {}).items():
+                if found is not None and seq > found:
+                    break
+                if event_match(event, match):
+                    found = seq
+                    break
+        if found is None:
+            return None
+        return self._remove(found)
+
+    def clear(self) -> None:
+        """Remove all the events."""
+        self._events.clear()
+        self._by_name.clear()
+
+
 class QEMUMonitorProtocol:
     """
     Provide an API to connect to QEMU via QEMU Monitor Protocol (QMP) and then
@@ -93,7 +344,8 @@ class QEMUMonitorProtocol:
 
     def __init__(self, address: SocketAddrT,
                  server: bool = False,
-                 nickname: Optional[str] = None):
+                 nickname: Optional[str] = None,
+                 event_queue: Optional[QMPEventQueue] = None):
         """
         Create a QEMUMonitorProtocol class.
 
@@ -101,49 +353,88 @@ class QEMUMonitorProtocol:
                         or a tuple in the form ( address, port ) for a TCP
                         connection
         @param server: server mode listens on the socket (bool)
+        @param event_queue: queue for received events, to bound its size
+                            (default: an unbounded QMPEventQueue)
         @raise OSError on socket connection errors
         @note No connection is established, this is done by the connect() or
               accept() methods
         """
-        self.__events: List[QMPMessage] = []
+        if event_queue is None:
+            event_queue = QMPEventQueue()
+        self.__events = event_queue
+        self.__next_id = 0
         self.__address = address
-        self.__sock = self.__get_sock()
-        self.__sockfile: Optional[TextIO] = None
+        self.__sock = _qmp_socket(address, server)
+        # Received data is self.__rbuf[self.__rstart:self.__rend]; there
+        # is no message boundary before self.__rscan.
+        self.__rbuf = bytearray(RECV_BUFFER_SIZE)
+        self.__rstart = 0
+        self.__rend = 0
+        self.__rscan = 0
         self._nickname = nickname
         if self._nickname:
             self.logger = logging.getLogger('QMP').getChild(self._nickname)
-        if server:
-            self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.__sock.bind(self.__address)
-            self.__sock.listen(1)
-
-    def __get_sock(self) -> socket.socket:
-        if isinstance(self.__address, tuple):
-            family = socket.AF_INET
-        else:
-            family = socket.AF_UNIX
-        return socket.socket(family, socket.SOCK_STREAM)
 
     def __negotiate_capabilities(self) -> QMPMessage:
-        greeting = self.__json_read()
-        if greeting is None or "QMP" not in greeting:
-            raise QMPConnectError
+        greeting = _check_greeting(self.__json_read())
         # Greeting seems ok, negotiate capabilities
-        resp = self.cmd('qmp_capabilities')
-        if resp and "return" in resp:
-            return greeting
-        raise QMPCapabilitiesError
+        _check_capabilities(self.cmd('qmp_capabilities'))
+        return greeting
 
-    def __json_read(self, only_event: bool = False) -> Optional[QMPMessage]:
-        assert self.__sockfile is not None
+    def __recv(self, flags: int = 0) -> bool:
+        """
+        Receive data into the buffer, making room if it is full.
+
+        @return False on end of file
+        """
+        if self.__rend == len(self.__rbuf):
+            if self.__rstart > 0:
+                size = self.__rend - self.__rstart
+                self.__rbuf[:size] = self.__rbuf[self.__rstart:self.__rend]
+                self.__rscan -= self.__rstart
+                self.__rend = size
+                self.__rstart = 0
+            else:
+                self.__rbuf.extend(bytes(len(self.__rbuf)))
+        with memoryview(self.__rbuf) as view:
+            nbytes = self.__sock.recv_into(view[self.__rend:], 0, flags)
+        self.__rend += nbytes
+        return nbytes > 0
+
+    def __read_message(self, flags: int = 0) -> Optional[bytearray]:
+        """
+        Return the next newline-terminated message, reading from the socket
+        only if no complete message is buffered.  Each byte is only scanned
+        once for the message boundary.
+
+        @return the message, or None on end of file
+        """
         while True:
-            data = self.__sockfile.readline()
-            if not data:
+            newline = self.__rbuf.find(b'\n', self.__rscan, self.__rend)
+            if newline < 0:
+                self.__rscan = self.__rend
+                if not self.__recv(flags):
+                    return None
+                continue
+            data = self.__rbuf[self.__rstart:newline]
+            if newline + 1 == self.__rend:
+                # Buffer drained, start over at the beginning
+                self.__rstart = self.__rend = self.__rscan = 0
+            else:
+                self.__rstart = self.__rscan = newline + 1
+            if data and not data.isspace():
+                return data
+
+    def __json_read(self, only_event: bool = False,
+                    flags: int = 0) -> Optional[QMPMessage]:
+        while True:
+            data = self.__read_message(flags)
+            if data is None:
                 return None
             # By definition, any JSON received from QMP is a QMPMessage,
             # and we are asserting only at static analysis time that it
             # has a particular shape.
-            resp: QMPMessage = json.loads(data)
+            resp: QMPMessage = _json_loads(data)
             if 'event' in resp:
                 self.logger.debug("<<< %s", resp)
                 self.__events.append(resp)
@@ -167,16 +458,21 @@ class QEMUMonitorProtocol:
         # Current timeout and blocking status
         current_timeout = self.__sock.gettimeout()
 
-        # Check for new events regardless and pull them into the cache:
-        self.__sock.settimeout(0)  # i.e. setblocking(False)
+        # Check for new events regardless and pull them into the cache.
+        # A blocking socket can be polled with MSG_DONTWAIT, without
+        # switching it to non-blocking mode and back.
+        dontwait = getattr(socket, 'MSG_DONTWAIT', 0)
+        if current_timeout is not None or not dontwait:
+            self.__sock.settimeout(0)  # i.e. setblocking(False)
         try:
-            self.__json_read()
+            self.__json_read(flags=dontwait)
         except OSError as err:
             # EAGAIN: No data available; not critical
             if err.errno != errno.EAGAIN:
                 raise
         finally:
-            self.__sock.settimeout(current_timeout)
+            if current_timeout is not None or not dontwait:
+                self.__sock.settimeout(current_timeout)
 
         # Wait for new events, if needed.
         # if wait is 0.0, this means "no wait" and is also implicitly false.
@@ -219,12 +515,12 @@ class QEMUMonitorProtocol:
         @raise QMPCapabilitiesError if fails to negotiate capabilities
         """
         self.__sock.connect(self.__address)
-        self.__sockfile = self.__sock.makefile(mode='r')
         if negotiate:
             return self.__negotiate_capabilities()
         return None
 
-    def accept(self, timeout: Optional[float] = 15.0) -> QMPMessage:
+    def accept(self, timeout: Optional[float] = 15.0,
+               negotiate: bool = True) -> Optional[QMPMessage]:
         """
         Await connection from QMP Monitor and perform capabilities negotiation.
 
@@ -232,7 +528,8 @@ class QEMUMonitorProtocol:
                         None). The value passed will set the behavior of the
                         underneath QMP socket as described in [1].
                         Default value is set to 15.0.
-        @return QMP greeting dict
+        @param negotiate: if false, leave negotiation to negotiate()
+        @return QMP greeting dict, or None if negotiate is false
         @raise OSError on socket connection errors
         @raise QMPConnectError if the greeting is not received
         @raise QMPCapabilitiesError if fails to negotiate capabilities
@@ -242,7 +539,19 @@ class QEMUMonitorProtocol:
         """
         self.__sock.settimeout(timeout)
         self.__sock, _ = self.__sock.accept()
-        self.__sockfile = self.__sock.makefile(mode='r')
+        if negotiate:
+            return self.__negotiate_capabilities()
+        return None
+
+    def negotiate(self) -> QMPMessage:
+        """
+        Perform capabilities negotiation after connect() or accept() with
+        negotiate=False.
+
+        @return QMP greeting dict
+        @raise QMPConnectError if the greeting is not received
+        @raise QMPCapabilitiesError if fails to negotiate capabilities
+        """
         return self.__negotiate_capabilities()
 
     def cmd_obj(self, qmp_cmd: QMPMessage) -> QMPMessage:
@@ -260,6 +569,65 @@ class QEMUMonitorProtocol:
         self.logger.debug("<<< %s", resp)
         return resp
 
+    def cmd_pipeline(self, qmp_cmds: Sequence[QMPMessage]) -> List[QMPMessage]:
+        """
+        Send several QMP commands with a single write and wait for all of
+        their responses.
+
+        Commands without an 'id' key are given a unique id, which is left in
+        the response.  Responses are matched to commands by id, and events
+        received in between are queued as usual.
+
+        @param qmp_cmds: QMP commands to be sent as Python dicts
+        @return QMP responses as Python dicts, in the order of the commands
+        @raise QMPConnectError if the connection is closed before all the
+                               responses are received
+        @raise QMPProtocolError if a response has an id that is not pending
+        """
+        pending: Dict[str, int] = {}
+        data = []
+        for index, qmp_cmd in enumerate(qmp_cmds):
+            if 'id' not in qmp_cmd:
+                self.__next_id += 1
+                qmp_cmd = dict(qmp_cmd, id='__qmp#%d' % self.__next_id)
+            key = json.dumps(qmp_cmd['id'], sort_keys=True)
+            if key in pending:
+                raise ValueError("Duplicate command id %s" % key)
+            pending[key] = index
+            self.logger.debug(">>> %s", qmp_cmd)
+            data.append(json.dumps(qmp_cmd))
+        if not data:
+            return []
+        self.__sock.sendall(''.join(data).encode('utf-8'))
+
+        resps: List[Optional[QMPMessage]] = [None] * len(data)
+        while pending:
+            resp = self.__json_read()
+            if resp is None:
+                raise QMPConnectError("Unexpected empty reply from server")
+            self.logger.debug("<<< %s", resp)
+            if 'id' in resp:
+                try:
+                    index = pending.pop(json.dumps(resp['id'],
+                                                   sort_keys=True))
+                except KeyError:
+                    raise QMPProtocolError(
+                        "Unexpected id in QMP response '{}'".format(resp)
+                    ) from None
+            else:
+                # Errors for unparsable commands carry no id.  Commands are
+                # answered in order, so it belongs to the oldest one.
+                index = pending.pop(min(pending, key=pending.__getitem__))
+            resps[index] = resp
+        return cast(List[QMPMessage], resps)
+
+    def pipeline(self) -> 'QMPPipeline':
+        """
+        Return a QMPPipeline, which queues commands and sends them with
+        cmd_pipeline() when flushed.
+        """
+        return QMPPipeline(self)
+
     def cmd(self, name: str,
             args: Optional[Dict[str, Any]] = None,
             cmd_id: Optional[Any] = None) -> QMPMessage:
@@ -270,25 +638,13 @@ class QEMUMonitorProtocol:
         @param args: command arguments (dict)
         @param cmd_id: command id (dict, list, string or int)
         """
-        qmp_cmd: QMPMessage = {'execute': name}
-        if args:
-            qmp_cmd['arguments'] = args
-        if cmd_id:
-            qmp_cmd['id'] = cmd_id
-        return self.cmd_obj(qmp_cmd)
+        return self.cmd_obj(_build_command(name, args, cmd_id))
 
     def command(self, cmd: str, **kwds: Any) -> QMPReturnValue:
         """
         Build and send a QMP command to the monitor, report errors if any
         """
-        ret = self.cmd(cmd, kwds)
-        if 'error' in ret:
-            raise QMPResponseError(ret)
-        if 'return' not in ret:
-            raise QMPProtocolError(
-                "'return' key not found in QMP response '{}'".format(str(ret))
-            )
-        return cast(QMPReturnValue, ret['return'])
+        return _return_value(self.cmd(cmd, kwds))
 
     def pull_event(self,
                    wait: Union[bool, float] = False) -> Optional[QMPMessage]:
@@ -305,11 +661,79 @@ class QEMUMonitorProtocol:
 
         @return The first available QMP event, or None.
         """
-        self.__get_events(wait)
+        if not self.__events:
+            self.__get_events(wait)
+        return self.__events.popleft()
 
-        if self.__events:
-            return self.__events.pop(0)
-        return None
+    def pull_matching_event(self, events: Sequence[Tuple[str, Any]],
+                            wait: Union[bool, float] = False
+                            ) -> Optional[QMPMessage]:
+        """
+        Pulls the first event matching any of the given criteria.  Other
+        events stay queued.
+
+        Queued events are looked up by name, and each event received while
+        waiting is only checked against the criteria for its name.
+
+        @param events: a sequence of (name, match) tuples, see event_match()
+        @param wait (bool): block until a matching event is available.
+        @param wait (float): If wait is a number, treat it as a timeout value
+                             for the whole wait.
+
+        @raise QMPTimeoutError: If a timeout is provided and the timeout
+                                period elapses.
+        @raise QMPConnectError: If the connection is closed while waiting.
+
+        @return The first matching QMP event, or None if wait is false.
+        """
+        self.__get_events()
+        event = self.__events.pop_match(events)
+        if event is not None or not wait:
+            return event
+
+        wanted: Dict[str, List[Any]] = {}
+        for name, match in events:
+            wanted.setdefault(name, []).append(match)
+        deadline = None
+        if not isinstance(wait, bool):
+            deadline = time.monotonic() + wait
+
+        current_timeout = self.__sock.gettimeout()
+        try:
+            while True:
+                resp = self.__wait_message(deadline)
+                if 'event' not in resp:
+                    continue
+                for match in wanted.get(resp['event'], ()):
+                    if event_match(resp, match):
+                        self.__events.pop_last()
+                        return resp
+        finally:
+            self.__sock.settimeout(current_timeout)
+
+    def __wait_message(self, deadline: Optional[float]) -> QMPMessage:
+        """
+        Read the next message, queueing it if it is an event.  The caller
+        restores the socket timeout.
+
+        @param deadline: time.monotonic() value after which to give up, or
+                         None to wait with the current socket timeout
+        """
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise QMPTimeoutError("Timeout waiting for event")
+            self.__sock.settimeout(remaining)
+        try:
+            resp = self.__json_read(only_event=True)
+        except socket.timeout as err:
+            raise QMPTimeoutError("Timeout waiting for event") from err
+        except OSError as err:
+            msg = "Error while reading from socket"
+            raise QMPConnectError(msg) from err
+        if resp is None:
+            raise QMPConnectError("Error while reading from socket")
+        return resp
 
     def get_events(self, wait: bool = False) -> List[QMPMessage]:
         """
@@ -323,25 +747,31 @@ class QEMUMonitorProtocol:
         @raise QMPConnectError: If wait is True but no events could be
                                 retrieved or if some other error occurred.
 
-        @return The list of available QMP events.
+        @return The list of available QMP events.  They are not removed
+                from the queue, see clear_events().
         """
         self.__get_events(wait)
-        return self.__events
+        return list(self.__events)
 
     def clear_events(self) -> None:
         """
         Clear current list of pending events.
         """
-        self.__events = []
+        self.__events.clear()
+
+    @property
+    def event_queue(self) -> QMPEventQueue:
+        """
+        The queue of received events, with its limits and drop counters.
+        """
+        return self.__events
 
     def close(self) -> None:
         """
-        Close the socket and socket file.
+        Close the socket.
         """
         if self.__sock:
             self.__sock.close()
-        if self.__sockfile:
-            self.__sockfile.close()
 
     def settimeout(self, timeout: Optional[float]) -> None:
         """
@@ -373,3 +803,127 @@ class QEMUMonitorProtocol:
         @return True if SCM_RIGHTS is available, otherwise False.
         """
         return self.__sock.family == socket.AF_UNIX
+
+
+class QMPPipeline:
+    """
+    Queue QMP commands and send them in a single write, so that polling
+    several commands costs one round trip instead of one per command::
+
+        with qmp.pipeline() as pipe:
+            stats = pipe.command('query-blockstats')
+            migrate = pipe.command('query-migrate', callback=report)
+        print(stats.result())
+
+    Each command returns a concurrent.futures.Future, which is completed
+    when the pipeline is flushed, either explicitly with flush() or when
+    leaving the with block.  Optional callbacks are invoked with the
+    response as it is demultiplexed.  Events received while waiting for the
+    responses are queued in the QEMUMonitorProtocol.
+    """
+
+    def __init__(self, qmp: QEMUMonitorProtocol):
+        self._qmp = qmp
+        self._cmds: List[QMPMessage] = []
+        self._futures: List['Future[Any]'] = []
+        self._callbacks: List[Optional[Callable[[QMPMessage], None]]] = []
+        self._checked: List[bool] = []
+
+    def __enter__(self) -> 'QMPPipeline':
+        return self
+
+    def __exit__(self,
+                 exc_type: Optional[Type[BaseException]],
+                 exc_val: Optional[BaseException],
+                 exc_tb: Optional[TracebackType]) -> None:
+        if exc_type is None:
+            self.flush()
+
+    def _queue(self, qmp_cmd: QMPMessage,
+               callback: Optional[Callable[[QMPMessage], None]],
+               checked: bool) -> 'Future[Any]':
+        future: 'Future[Any]' = Future()
+        self._cmds.append(qmp_cmd)
+        self._futures.append(future)
+        self._callbacks.append(callback)
+        self._checked.append(checked)
+        return future
+
+    def cmd_obj(self, qmp_cmd: QMPMessage,
+                callback: Optional[Callable[[QMPMessage], None]] = None
+                ) -> 'Future[QMPMessage]':
+        """
+        Queue a QMP command.
+
+        @param qmp_cmd: QMP command to be sent as a Python dict
+        @param callback: function called with the QMP response
+        @return Future of the QMP response as a Python dict
+        """
+        return self._queue(qmp_cmd, callback, False)
+
+    def cmd(self, name: str,
+            args: Optional[Dict[str, Any]] = None,
+            callback: Optional[Callable[[QMPMessage], None]] = None
+            ) -> 'Future[QMPMessage]':
+        """
+        Build a QMP command and queue it.
+
+        @param name: command name (string)
+        @param args: command arguments (dict)
+        @param callback: function called with the QMP response
+        @return Future of the QMP response as a Python dict
+        """
+        qmp_cmd: QMPMessage = {'execute': name}
+        if args:
+            qmp_cmd['arguments'] = args
+        return self._queue(qmp_cmd, callback, False)
+
+    def command(self, cmd: str,
+                callback: Optional[Callable[[QMPMessage], None]] = None,
+                **kwds: Any) -> 'Future[QMPReturnValue]':
+        """
+        Build a QMP command and queue it.  The future fails with
+        QMPResponseError or QMPProtocolError like
+        QEMUMonitorProtocol.command().
+
+        @param callback: function called with the QMP response
+        @return Future of the return value of the command
+        """
+        qmp_cmd: QMPMessage = {'execute': cmd}
+        if kwds:
+            qmp_cmd['arguments'] = kwds
+        return self._queue(qmp_cmd, callback, True)
+
+    def flush(self) -> None:
+        """
+        Send the queued commands and complete their futures.
+
+        @raise QMPConnectError if the connection is closed before all the
+                               responses are received; the futures of the
+                               commands fail with the same exception
+        """
+        cmds, futures = self._cmds, self._futures
+        callbacks, checked = self._callbacks, self._checked
+        self._cmds, self._futures, self._callbacks, self._checked = \
+            [], [], [], []
+        try:
+            resps = self._qmp.cmd_pipeline(cmds)
+        except Exception as err:
+            for future in futures:
+                future.set_exception(err)
+            raise
+
+        for resp, future, callback, check in zip(resps, futures, callbacks,
+                                                 checked):
+            if callback is not None:
+                callback(resp)
+            if not check:
+                future.set_result(resp)
+            elif 'error' in resp:
+                future.set_exception(QMPResponseError(resp))
+            elif 'return' not in resp:
+                future.set_exception(QMPProtocolError(
+                    "'return' key not found in QMP response '{}'".format(
+                        str(resp))))
+            else:
+                future.set_result(resp['return'])
@@ -0,0 +1,296 @@
+"""
+QEMU Monitor Protocol proxy:
+
+The qmp_proxy module provides the QMPProxy class, which shares a single
+QMP monitor between several clients, such as a metrics scraper, a backup
+agent and a debugger.
+"""
+
+# This work is licensed under the terms of the GNU GPL, version 2.  See
+# the COPYING file in the top-level directory.
+
+import asyncio
+import codecs
+import json
+import logging
+import math
+import re
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from .aqmp import AsyncQEMUMonitorProtocol
+from .qmp import QMPError, QMPMessage, SocketAddrT
+
+
+LOG = logging.getLogger(__name__)
+
+# A client that sends this much data without a complete JSON object is
+# answered with a parse error
+MAX_REQUEST_SIZE = 1024 * 1024
+
+# Clients that do not read their events are disconnected once this much
+# output is pending
+MAX_PENDING_OUTPUT = 16 * 1024 * 1024
+
+
+def _error(error_class: str, desc: str) -> QMPMessage:
+    return {'error': {'class': error_class, 'desc': desc}}
+
+
+def _incomplete(buf: str, err: json.JSONDecodeError) -> bool:
+    # The decoder ran out of input if it failed at the end of the buffer,
+    # inside a string, or on a number or literal that may still continue
+    rest = buf[err.pos:]
+    return (not rest or err.msg.startswith('Unterminated string') or
+            re.fullmatch(r'[\w.+-]+', rest) is not None)
+
+
+class _Client:
+    """
+    A downstream connection.
+    """
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.negotiated = False
+
+    def send(self, msg: QMPMessage) -> None:
+        """Queue a message for the client."""
+        self.send_raw(json.dumps(msg).encode('utf-8') + b'\r\n')
+
+    def send_raw(self, data: bytes) -> None:
+        """Queue an already encoded message for the client."""
+        self.writer.write(data)
+
+    def pending_output(self) -> int:
+        """Return the number of bytes not yet sent to the client."""
+        return self.writer.transport.get_write_buffer_size()
+
+
+class QMPProxy:
+    """
+    Share one upstream QMP connection between any number of downstream
+    clients.
+
+    Clients see a regular QMP monitor: they receive the greeting of the
+    upstream monitor, negotiate capabilities (answered by the proxy) and
+    then send commands and receive events.  Commands are forwarded with
+    a fresh id, and the client's own id, if any, is restored in the reply.
+    Every event is sent to every client that completed negotiation.
+
+    Identical query-* commands (same name and arguments) issued while one
+    is in flight, or within `window` seconds of its reply, are answered
+    with that reply instead of being forwarded, so that monitor load stays
+    flat as pollers are added.  Set `window` to 0 to only coalesce
+    commands that are in flight at the same time, or to None to disable
+    coalescing.
+
+    Commands of one client are executed in order, as QEMU would.
+    Out-of-band execution is not supported and not advertised.
+    """
+
+    def __init__(self, upstream: SocketAddrT, listen: SocketAddrT,
+                 window: Optional[float] = 0.1,
+                 nickname: Optional[str] = None):
+        """
+        Create a QMPProxy.
+
+        @param upstream: QMP monitor address, a unix socket path (string) or
+                         a tuple in the form ( address, port )
+        @param listen: address clients connect to, in the same form
+        @param window: how long query-* replies are reused, in seconds
+        @note No connection is established, this is done by start()
+        """
+        self._upstream = AsyncQEMUMonitorProtocol(upstream, nickname=nickname)
+        self._listen = listen
+        self._window = window
+        self._greeting: QMPMessage = {}
+        self._clients: Set[_Client] = set()
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._events_task: Optional['asyncio.Future[None]'] = None
+        # (command, arguments) -> (reply future, time of the reply)
+        self._queries: Dict[Tuple[str, str],
+                            Tuple['asyncio.Future[QMPMessage]',
+                                  List[float]]] = {}
+        # Commands received from clients, and commands sent upstream
+        self.commands = 0
+        self.forwarded = 0
+
+    async def start(self) -> None:
+        """
+        Connect to the upstream monitor and start accepting clients.
+
+        @raise OSError on socket connection errors
+        @raise QMPError if the upstream connection cannot be negotiated
+        """
+        greeting = await self._upstream.connect()
+        self._greeting = {'QMP': dict(greeting['QMP'], capabilities=[])}
+        if isinstance(self._listen, tuple):
+            host, port = self._listen
+            self._server = await asyncio.start_server(self._handle_client,
+                                                      host, int(port))
+        else:
+            self._server = await asyncio.start_unix_server(
+                self._handle_client, self._listen)
+        self._events_task = asyncio.ensure_future(self._forward_events())
+
+    async def wait_closed(self) -> None:
+        """
+        Wait until the upstream monitor goes away.
+        """
+        if self._events_task is not None:
+            await self._events_task
+
+    async def close(self) -> None:
+        """
+        Disconnect all clients and the upstream monitor.
+        """
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        for client in list(self._clients):
+            client.writer.close()
+        self._clients.clear()
+        await self._upstream.aclose()
+        if self._events_task is not None:
+            await self._events_task
+            self._events_task = None
+
+    async def _forward_events(self) -> None:
+        async for event in self._upstream.events():
+            data = json.dumps(event).encode('utf-8') + b'\r\n'
+            for client in list(self._clients):
+                if client.pending_output() > MAX_PENDING_OUTPUT:
+                    LOG.warning("Disconnecting client not reading events")
+                    self._clients.discard(client)
+                    client.writer.close()
+                    continue
+                client.send_raw(data)
+        LOG.debug("Upstream monitor closed")
+        if self._server is not None:
+            self._server.close()
+        for client in list(self._clients):
+            client.writer.close()
+
+    async def _handle_client(self, reader: asyncio.StreamReader,
+                             writer: asyncio.StreamWriter) -> None:
+        client = _Client(writer)
+        decoder = json.JSONDecoder()
+        utf8 = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        buf = ''
+        try:
+            client.send(self._greeting)
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                buf += utf8.decode(data)
+                while True:
+                    buf = buf.lstrip()
+                    if not buf:
+                        break
+                    try:
+                        cmd, end = decoder.raw_decode(buf)
+                    except json.JSONDecodeError as err:
+                        if not _incomplete(buf, err):
+                            # Skip the rest of the line and report the
+                            # error, like QEMU does
+                            client.send(_error('GenericError',
+                                               'JSON parse error, %s' %
+                                               err.msg))
+                            newline = buf.find('\n', err.pos)
+                            buf = buf[newline + 1:] if newline >= 0 else ''
+                            continue
+                        # Wait for more input, unless it is too long
+                        if len(buf) > MAX_REQUEST_SIZE:
+                            client.send(_error('GenericError',
+                                               'JSON parse error'))
+                            buf = ''
+                        break
+                    buf = buf[end:]
+                    reply = await self._command(client, cmd)
+                    client.send(reply)
+                    await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._clients.discard(client)
+            writer.close()
+
+    async def _command(self, client: _Client, cmd: Any) -> QMPMessage:
+        if not isinstance(cmd, dict):
+            return _error('GenericError', 'QMP input must be a JSON object')
+        name = cmd.get('execute')
+        if not isinstance(name, str):
+            reply = _error('GenericError', "QMP input lacks member 'execute'")
+        elif name == 'qmp_capabilities':
+            if client.negotiated:
+                reply = _error('CommandNotFound',
+                               'Capabilities negotiation is already '
+                               'complete, command ignored')
+            else:
+                reply = {'return': {}}
+                client.negotiated = True
+                self._clients.add(client)
+        elif not client.negotiated:
+            reply = _error('CommandNotFound',
+                           "Expecting capabilities negotiation with "
+                           "'qmp_capabilities'")
+        else:
+            self.commands += 1
+            try:
+                reply = await self._execute(name, cmd.get('arguments'))
+            except QMPError as err:
+                reply = _error('GenericError',
+                               'Monitor unavailable: %s' % err)
+
+        # Replace the upstream id with the client's, if any
+        reply = dict((key, value) for key, value in reply.items()
+                     if key != 'id')
+        if 'id' in cmd:
+            reply['id'] = cmd['id']
+        return reply
+
+    async def _execute(self, name: str, args: Any) -> QMPMessage:
+        upstream_cmd: QMPMessage = {'execute': name}
+        if args is not None:
+            upstream_cmd['arguments'] = args
+        if self._window is None or not name.startswith('query-'):
+            self.forwarded += 1
+            return await self._upstream.cmd_obj(upstream_cmd)
+
+        loop = asyncio.get_event_loop()
+        key = (name, json.dumps(args, sort_keys=True))
+        entry = self._queries.get(key)
+        if entry is not None:
+            future, replied = entry
+            if not future.done() or loop.time() - replied[0] <= self._window:
+                return await asyncio.shield(future)
+
+        self.forwarded += 1
+        future = asyncio.ensure_future(self._upstream.cmd_obj(upstream_cmd))
+        replied = [math.inf]
+
+        def _replied(_: 'asyncio.Future[QMPMessage]') -> None:
+            replied[0] = loop.time()
+
+        future.add_done_callback(_replied)
+        self._expire_queries(loop.time())
+        self._queries[key] = (future, replied)
+        return await asyncio.shield(future)
+
+    def _expire_queries(self, now: float) -> None:
+        assert self._window is not None
+        for key, (future, replied) in list(self._queries.items()):
+            if future.done() and now - replied[0] > self._window:
+                del self._queries[key]
+                if not future.cancelled():
+                    # Retrieve the exception of failed queries nobody
+                    # awaited, if any
+                    future.exception()
@@ -0,0 +1,449 @@
+"""
+QMP schema support:
+
+The qmp_schema module provides the QMPSchema class, built from the output
+of query-qmp-schema, which converts and validates command arguments
+locally and generates a Python method for each QMP command.
+"""
+
+# This work is licensed under the terms of the GNU GPL, version 2.  See
+# the COPYING file in the top-level directory.
+
+import hashlib
+import inspect
+import json
+import keyword
+import logging
+import os
+import re
+import shutil
+import tempfile
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Type,
+    cast,
+)
+
+from .qmp import QEMUMonitorProtocol, QMPError, QMPProtocolError
+
+
+LOG = logging.getLogger(__name__)
+
+# Python types accepted for each JSON type of a builtin schema type
+_JSON_TYPES: Dict[str, Any] = {
+    'string': str,
+    'int': int,
+    'number': (int, float),
+    'boolean': bool,
+    'null': type(None),
+}
+
+# Parsed schemas, by cache key
+_SCHEMAS: Dict[str, 'QMPSchema'] = {}
+
+
+class QMPArgumentError(QMPError):
+    """
+    QMP command arguments rejected by the schema
+    """
+
+
+def default_cache_dir() -> str:
+    """
+    Return the directory where fetched schemas are cached by default,
+    $XDG_CACHE_HOME/qemu or ~/.cache/qemu.
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME',
+                                os.path.join(os.path.expanduser('~'),
+                                             '.cache'))
+    return os.path.join(cache_home, 'qemu')
+
+
+class QMPCommand:
+    """
+    A command of a QMPSchema.
+
+    The mapping from Python keyword arguments to QMP member names is
+    computed once here: both 'node_name' and 'node-name' map to
+    'node-name', while members whose QMP name contains an underscore,
+    such as 'bps_rd', are kept as they are.
+    """
+    def __init__(self, schema: 'QMPSchema', entity: Dict[str, Any]):
+        self.schema = schema
+        self.name: str = entity['name']
+        self.attr = self.name.replace('-', '_')
+        self.arg_type: str = entity['arg-type']
+        self.ret_type: str = entity['ret-type']
+        members = schema.members(self.arg_type)
+        self.keys: Dict[str, str] = {}
+        for name in members:
+            self.keys[name.replace('-', '_')] = name
+        for name in members:
+            self.keys[name] = name
+
+    def arguments(self, kwargs: Dict[str, Any],
+                  conv_keys: bool = True) -> Dict[str, Any]:
+        """
+        Convert Python keyword arguments to validated QMP arguments.
+
+        @param conv_keys: accept underscores in place of dashes in the
+                          argument names; if False, names are used as is
+        @raise QMPArgumentError if the arguments do not match the schema
+        """
+        args = {}
+        keys = self.keys
+        for key, value in kwargs.items():
+            try:
+                args[keys[key] if conv_keys else key] = value
+            except KeyError:
+                raise QMPArgumentError("%s: unexpected argument '%s'" %
+                                       (self.name, key)) from None
+        self.schema.check(self.arg_type, args, self.name)
+        return args
+
+    def signature(self) -> Optional[inspect.Signature]:
+        """
+        Return the keyword-only signature of the generated method, or None
+        if some member is not a valid Python identifier.
+        """
+        params = []
+        for name, member in self.schema.base_members(self.arg_type).items():
+            attr = name.replace('-', '_')
+            if not attr.isidentifier() or keyword.iskeyword(attr):
+                return None
+            params.append(inspect.Parameter(
+                attr, inspect.Parameter.KEYWORD_ONLY,
+                default=None if 'default' in member else
+                inspect.Parameter.empty,
+                annotation=self.schema.python_type(member['type'])))
+        return inspect.Signature(params)
+
+    def doc(self) -> str:
+        """
+        Return the docstring of the generated method.
+        """
+        lines = ['Execute the QMP command %s.' % self.name, '']
+        for name, member in self.schema.members(self.arg_type).items():
+            lines.append('@param %s: %s%s' % (
+                name.replace('-', '_'), self.schema.type_name(member['type']),
+                ' (optional)' if 'default' in member else ''))
+        lines.append('@return %s' % self.schema.type_name(self.ret_type))
+        return '\n'.join(lines)
+
+
+class QMPCommands:
+    """
+    Base class of the classes generated by QMPSchema.api_class(), which
+    have one method per QMP command, named after the command with dashes
+    replaced by underscores::
+
+        api = schema.bind(monitor)
+        api.block_resize(node_name='disk0', size=1 << 30)
+
+    Arguments are converted and validated without a round trip to QEMU,
+    and the methods return the same as the monitor's command() method:
+    the return value, or a coroutine if the monitor is an
+    AsyncQEMUMonitorProtocol.
+    """
+    # The public methods are added by QMPSchema.api_class()
+    # pylint: disable=too-few-public-methods
+    def __init__(self, monitor: Any):
+        self._monitor = monitor
+
+    def _execute(self, command: QMPCommand, kwargs: Dict[str, Any]) -> Any:
+        return self._monitor.command(command.name,
+                                     **command.arguments(kwargs))
+
+
+def _make_method(command: QMPCommand) -> Any:
+    def method(self: QMPCommands, **kwargs: Any) -> Any:
+        # pylint: disable=protected-access
+        return self._execute(command, kwargs)
+
+    method.__name__ = command.attr
+    method.__qualname__ = 'QMPCommands.' + command.attr
+    method.__doc__ = command.doc()
+    signature = command.signature()
+    if signature is not None:
+        setattr(method, '__signature__', signature.replace(
+            parameters=[inspect.Parameter('self',
+                                          inspect.Parameter.POSITIONAL_ONLY)]
+            + list(signature.parameters.values())))
+    return method
+
+
+class QMPSchema:
+    """
+    The QMP schema of a QEMU binary, as returned by query-qmp-schema.
+
+    Use fetch() to get the schema of a running QEMU; it is cached in
+    memory and on disk, keyed by the QEMU version, the target and the
+    binary, so that it is only transferred and parsed once.
+    """
+    def __init__(self, entities: List[Dict[str, Any]]):
+        self._entities = {entity['name']: entity for entity in entities}
+        self._api_class: Optional[Type[QMPCommands]] = None
+        self.commands = {
+            entity['name']: QMPCommand(self, entity)
+            for entity in entities if entity['meta-type'] == 'command'
+        }
+
+    @staticmethod
+    def _binary_id(binary: str) -> Optional[str]:
+        # Development builds change their schema without changing their
+        # version, so tell binaries apart by path, size and mtime
+        path = shutil.which(binary)
+        if path is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        identity = '%s:%d:%d' % (os.path.realpath(path), stat.st_size,
+                                 stat.st_mtime_ns)
+        return hashlib.sha1(identity.encode('utf-8')).hexdigest()[:16]
+
+    @classmethod
+    def fetch(cls, monitor: QEMUMonitorProtocol,
+              cache_dir: Optional[str] = None,
+              binary: Optional[str] = None) -> 'QMPSchema':
+        """
+        Return the schema of the QEMU behind monitor.
+
+        @param monitor: a connected QEMUMonitorProtocol
+        @param cache_dir: where to cache schemas across processes, or None
+                          to only cache them in memory
+        @param binary: path of the QEMU binary, which is part of the cache
+                       key; without it, the schema is not cached on disk
+        """
+        with monitor.pipeline() as pipe:
+            version = pipe.command('query-version')
+            target = pipe.command('query-target')
+        qemu = version.result()['qemu']
+        key = '%d.%d.%d%s-%s' % (qemu['major'], qemu['minor'], qemu['micro'],
+                                 version.result()['package'],
+                                 target.result()['arch'])
+        binary_id = cls._binary_id(binary) if binary is not None else None
+        if binary_id is not None:
+            key += '-' + binary_id
+        else:
+            cache_dir = None
+        key = re.sub(r'[^\w.+-]', '_', key)
+        schema = _SCHEMAS.get(key)
+        if schema is not None:
+            return schema
+
+        entities = None
+        path = None
+        if cache_dir is not None:
+            path = os.path.join(cache_dir, 'qmp-schema-%s.json' % key)
+            try:
+                with open(path, 'r', encoding='utf-8') as infile:
+                    entities = json.load(infile)
+            except (OSError, ValueError):
+                pass
+        if not isinstance(entities, list):
+            reply = monitor.command('query-qmp-schema')
+            if not isinstance(reply, list):
+                raise QMPProtocolError("query-qmp-schema returned %r" %
+                                       (reply,))
+            entities = cast(List[Dict[str, Any]], reply)
+            if path is not None:
+                cls._store(path, entities)
+
+        schema = cls(entities)
+        _SCHEMAS[key] = schema
+        return schema
+
+    @staticmethod
+    def _store(path: str, entities: List[Dict[str, Any]]) -> None:
+        # Write to a temporary file first, concurrent readers must never
+        # see a partial schema
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path),
+                                             encoding='utf-8',
+                                             delete=False) as outfile:
+                json.dump(entities, outfile)
+            os.replace(outfile.name, path)
+        except OSError as err:
+            LOG.warning("Cannot cache QMP schema in %s: %s", path, err)
+
+    def command(self, name: str) -> QMPCommand:
+        """
+        Return the command called name.
+
+        @raise QMPArgumentError if there is no such command
+        """
+        try:
+            return self.commands[name]
+        except KeyError:
+            raise QMPArgumentError("The command %s has not been found" %
+                                   name) from None
+
+    def arguments(self, name: str, kwargs: Dict[str, Any],
+                  conv_keys: bool = True) -> Dict[str, Any]:
+        """
+        Convert Python keyword arguments of the command name to validated
+        QMP arguments.  See QMPCommand.arguments().
+
+        @raise QMPArgumentError if the arguments do not match the schema
+        """
+        return self.command(name).arguments(kwargs, conv_keys)
+
+    def api_class(self) -> Type[QMPCommands]:
+        """
+        Return a subclass of QMPCommands with a method for each command.
+        """
+        if self._api_class is None:
+            methods = {command.attr: _make_method(command)
+                       for command in self.commands.values()}
+            self._api_class = type('QMPCommands', (QMPCommands,), methods)
+        return self._api_class
+
+    def bind(self, monitor: Any) -> QMPCommands:
+        """
+        Return an object whose methods execute QMP commands on monitor.
+        """
+        return self.api_class()(monitor)
+
+    def base_members(self, type_name: str) -> Dict[str, Dict[str, Any]]:
+        """
+        Return the members of an object type, excluding variants.
+        """
+        entity = self._entities[type_name]
+        return {member['name']: member for member in entity.get('members', [])}
+
+    def members(self, type_name: str) -> Dict[str, Dict[str, Any]]:
+        """
+        Return the members of an object type, including those of all of
+        its variants.
+        """
+        members = self.base_members(type_name)
+        for variant in self._entities[type_name].get('variants', []):
+            for name, member in self.members(variant['type']).items():
+                members.setdefault(name, member)
+        return members
+
+    def type_name(self, type_name: str) -> str:
+        """
+        Return a readable name for a type; QEMU replaces the names of
+        types other than builtins with numbers.
+        """
+        entity = self._entities[type_name]
+        meta: str = entity['meta-type']
+        if meta == 'array':
+            return '[%s]' % self.type_name(entity['element-type'])
+        if type_name.isdigit():
+            return meta
+        return type_name
+
+    def python_type(self, type_name: str) -> Any:
+        """
+        Return the Python type of values of a schema type.
+        """
+        entity = self._entities[type_name]
+        meta = entity['meta-type']
+        if meta == 'builtin':
+            return _JSON_TYPES.get(entity['json-type'], Any)
+        if meta == 'enum':
+            return str
+        if meta == 'array':
+            return list
+        if meta == 'object':
+            return dict
+        return Any
+
+    def check(self, type_name: str, value: Any, path: str) -> None:
+        """
+        Check value against a schema type.
+
+        @param path: where value is, for error messages
+        @raise QMPArgumentError if the value does not match
+        """
+        entity = self._entities[type_name]
+        # One _check_<meta-type> method per kind of type
+        checker = getattr(self, '_check_' + entity['meta-type'], None)
+        if checker is not None:
+            checker(entity, value, path)
+
+    @staticmethod
+    def _check_builtin(entity: Dict[str, Any], value: Any, path: str) -> None:
+        json_type = entity['json-type']
+        expected = _JSON_TYPES.get(json_type)
+        if expected is None:
+            return
+        # bool is a subclass of int, but not a JSON number
+        if isinstance(value, bool) and json_type != 'boolean' or \
+           not isinstance(value, expected):
+            raise QMPArgumentError("%s: expected %s, got %r" %
+                                   (path, json_type, value))
+
+    @staticmethod
+    def _check_enum(entity: Dict[str, Any], value: Any, path: str) -> None:
+        values = entity.get('values')
+        if values is None:
+            values = [member['name'] for member in entity['members']]
+        if value not in values:
+            raise QMPArgumentError("%s: expected one of %s, got %r" %
+                                   (path, ', '.join(values), value))
+
+    def _check_array(self, entity: Dict[str, Any],
+                     value: Any, path: str) -> None:
+        if not isinstance(value, list):
+            raise QMPArgumentError("%s: expected a list, got %r" %
+                                   (path, value))
+        for i, element in enumerate(value):
+            self.check(entity['element-type'], element, '%s[%d]' % (path, i))
+
+    def _check_alternate(self, entity: Dict[str, Any],
+                         value: Any, path: str) -> None:
+        error = None
+        for member in entity['members']:
+            try:
+                self.check(member['type'], value, path)
+                return
+            except QMPArgumentError as err:
+                # Report why the branch of the same JSON type failed
+                expected = self.python_type(member['type'])
+                if expected is not Any and isinstance(value, expected):
+                    error = err
+        if error is not None:
+            raise error
+        raise QMPArgumentError("%s: %r does not match any of %s" % (
+            path, value, ', '.join(self.type_name(member['type'])
+                                   for member in entity['members'])))
+
+    def _variant_members(self, type_name: str,
+                         value: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        members = self.base_members(type_name)
+        entity = self._entities[type_name]
+        tag = entity.get('tag')
+        if tag is not None and tag in value:
+            for variant in entity['variants']:
+                if variant['case'] == value[tag]:
+                    members.update(self._variant_members(variant['type'],
+                                                         value))
+                    break
+        return members
+
+    def _check_object(self, entity: Dict[str, Any],
+                      value: Any, path: str) -> None:
+        type_name = entity['name']
+        if not isinstance(value, dict):
+            raise QMPArgumentError("%s: expected an object, got %r" %
+                                   (path, value))
+        members = self._variant_members(type_name, value)
+        for name, member in members.items():
+            if name in value:
+                self.check(member['type'], value[name], path + '.' + name)
+            elif 'default' not in member:
+                raise QMPArgumentError("%s: missing argument '%s'" %
+                                       (path, name))
+        for name in value:
+            if name not in members:
+                raise QMPArgumentError("%s: unexpected argument '%s'" %
+                                       (path, name))
@@ -17,19 +17,41 @@ subclass of QEMUMachine, respectively.
 # Based on qmp.py.
 #
 
+import base64
+from concurrent.futures import Future
 import os
 import socket
+import time
+from types import TracebackType
 from typing import (
+    Callable,
     List,
     Optional,
     Sequence,
     TextIO,
+    Type,
 )
 
 from .machine import QEMUMachine
 from .qmp import SocketAddrT
 
 
+# Size of the memory accesses issued by the memory helpers; QEMU
+# allocates a buffer of this size for each of them.
+QTEST_CHUNK_SIZE = 1024 * 1024
+
+# Maximum number of bytes of memory data sent or expected back in a
+# single batch.  Bounding it keeps QEMU from blocking on a full socket
+# while we are still writing commands.
+QTEST_BATCH_SIZE = 16 * 1024 * 1024
+
+
+class QEMUQtestError(Exception):
+    """
+    Exception raised when a qtest command fails.
+    """
+
+
 class QEMUQtestProtocol:
     """
     QEMUQtestProtocol implements a connection to a qtest socket.
@@ -86,8 +108,158 @@ class QEMUQtestProtocol:
         """
         assert self._sockfile is not None
         self._sock.sendall((qtest_cmd + "\n").encode('utf-8'))
-        resp = self._sockfile.readline()
-        return resp
+        return self._read_response()
+
+    def _read_response(self) -> str:
+        """
+        Read the next response, skipping the asynchronous IRQ
+        notifications that QEMU sends when interrupts are intercepted,
+        like libqtest does.  Returns '' if the connection is closed.
+        """
+        assert self._sockfile is not None
+        while True:
+            resp = self._sockfile.readline()
+            if not resp.startswith('IRQ '):
+                return resp
+
+    def cmd_batch(self, qtest_cmds: Sequence[str]) -> List[str]:
+        """
+        Send several qtest commands with a single write and wait for all
+        of their responses.
+
+        Keep the memory data of a batch to a few megabytes; QEMU stops
+        reading commands while the responses fill the socket buffer.
+
+        @param qtest_cmds: qtest command texts to be sent
+        @return qtest server responses, in the order of the commands
+        @raise QEMUQtestError if the connection is closed before all the
+                              responses are received
+        """
+        assert self._sockfile is not None
+        if not qtest_cmds:
+            return []
+        self._sock.sendall(''.join(cmd + "\n"
+                                   for cmd in qtest_cmds).encode('utf-8'))
+        resps: List[str] = []
+        while len(resps) < len(qtest_cmds):
+            resp = self._read_response()
+            if not resp:
+                raise QEMUQtestError("Connection closed after %d of %d "
+                                     "responses" %
+                                     (len(resps), len(qtest_cmds)))
+            resps.append(resp)
+        return resps
+
+    def batch(self) -> 'QEMUQtestBatch':
+        """
+        Return a QEMUQtestBatch, which queues commands and sends them with
+        cmd_batch() when flushed.
+        """
+        return QEMUQtestBatch(self)
+
+    @staticmethod
+    def check_response(qtest_cmd: str, resp: str) -> str:
+        """
+        Check that a qtest command succeeded.
+
+        @return the response without the OK prefix
+        @raise QEMUQtestError if the response is not OK
+        """
+        if resp != 'OK\n' and not resp.startswith('OK '):
+            raise QEMUQtestError("'%s' failed: %s" %
+                                 (qtest_cmd.split(' ', 1)[0], resp.strip()))
+        return resp[3:].rstrip('\n')
+
+    def read_memory(self, addr: int, size: int) -> bytes:
+        """
+        Read guest memory with b64read, in chunks of QTEST_CHUNK_SIZE
+        sent in batches.
+
+        @raise QEMUQtestError if a command fails
+        """
+        futures = []
+        pending = 0
+        with self.batch() as batch:
+            for offset in range(0, size, QTEST_CHUNK_SIZE):
+                length = min(QTEST_CHUNK_SIZE, size - offset)
+                futures.append(batch.cmd('b64read 0x%x 0x%x' %
+                                         (addr + offset, length), check=True))
+                pending += length
+                if pending >= QTEST_BATCH_SIZE:
+                    batch.flush()
+                    pending = 0
+        return b''.join(base64.b64decode(future.result())
+                        for future in futures)
+
+    def _write_chunks(self, addr: int, size: int, chunk_size: int,
+                      encode: Callable[[int, int], str]) -> None:
+        # encode(offset, length) returns the base64 data of a chunk
+        futures = []
+        pending = 0
+        with self.batch() as batch:
+            for offset in range(0, size, chunk_size):
+                length = min(chunk_size, size - offset)
+                futures.append(batch.cmd(
+                    'b64write 0x%x 0x%x %s' %
+                    (addr + offset, length, encode(offset, length)),
+                    check=True))
+                pending += length
+                if pending >= QTEST_BATCH_SIZE:
+                    batch.flush()
+                    pending = 0
+        for future in futures:
+            future.result()
+
+    def write_memory(self, addr: int, data: bytes) -> None:
+        """
+        Write guest memory with b64write, in chunks of QTEST_CHUNK_SIZE
+        sent in batches.
+
+        @raise QEMUQtestError if a command fails
+        """
+        view = memoryview(data)
+
+        def encode(offset: int, length: int) -> str:
+            return base64.b64encode(view[offset:offset + length]).decode()
+
+        self._write_chunks(addr, len(view), QTEST_CHUNK_SIZE, encode)
+
+    def fill_memory(self, addr: int, size: int,
+                    pattern: bytes = b'\0') -> None:
+        """
+        Fill guest memory with a repeated pattern.  A single byte pattern
+        is written with memset, which sends no data at all; longer ones
+        are written with b64write, encoding each distinct chunk once.
+
+        @raise QEMUQtestError if a command fails
+        """
+        if not pattern:
+            raise ValueError("Empty fill pattern")
+        if len(pattern) == 1:
+            with self.batch() as batch:
+                futures = [batch.cmd('memset 0x%x 0x%x 0x%02x' %
+                                     (addr + offset,
+                                      min(QTEST_CHUNK_SIZE, size - offset),
+                                      pattern[0]), check=True)
+                           for offset in range(0, size, QTEST_CHUNK_SIZE)]
+            for future in futures:
+                future.result()
+            return
+
+        # Chunks are a multiple of the pattern so that they all start
+        # with it; only the last one can be shorter.
+        chunk_size = max(len(pattern),
+                         QTEST_CHUNK_SIZE - QTEST_CHUNK_SIZE % len(pattern))
+        block = pattern * (min(chunk_size, size) // len(pattern) + 1)
+        full = base64.b64encode(block[:chunk_size]).decode()
+
+        def encode(_offset: int, length: int) -> str:
+            # Every chunk starts with the pattern, wherever it is
+            if length == chunk_size:
+                return full
+            return base64.b64encode(block[:length]).decode()
+
+        self._write_chunks(addr, size, chunk_size, encode)
 
     def close(self) -> None:
         """
@@ -103,6 +275,86 @@ class QEMUQtestProtocol:
         self._sock.settimeout(timeout)
 
 
+class QEMUQtestBatch:
+    """
+    Queue qtest commands and send them in a single write, so that many
+    accesses cost one round trip instead of one each::
+
+        with vm.qtest_batch() as batch:
+            for reg in range(0, 0x100, 4):
+                batch.cmd('writel 0x%x 0' % (base + reg))
+            status = batch.cmd('readl 0x%x' % (base + 0x100), check=True)
+        print(int(status.result(), 16))
+
+    Each command returns a concurrent.futures.Future of its response,
+    which is completed when the batch is flushed, either explicitly with
+    flush() or when leaving the with block.
+    """
+
+    def __init__(self, qtest: QEMUQtestProtocol):
+        self._qtest = qtest
+        self._cmds: List[str] = []
+        self._futures: List['Future[str]'] = []
+        self._checked: List[bool] = []
+
+    def __enter__(self) -> 'QEMUQtestBatch':
+        return self
+
+    def __exit__(self,
+                 exc_type: Optional[Type[BaseException]],
+                 exc_val: Optional[BaseException],
+                 exc_tb: Optional[TracebackType]) -> None:
+        if exc_type is None:
+            self.flush()
+
+    def __len__(self) -> int:
+        return len(self._cmds)
+
+    def cmd(self, qtest_cmd: str, check: bool = False) -> 'Future[str]':
+        """
+        Queue a qtest command.
+
+        @param qtest_cmd: qtest command text to be sent
+        @param check: if true, the future fails with QEMUQtestError unless
+                      the response is OK, and its result is the response
+                      without the OK prefix, e.g. the value read by readl
+        @return Future of the qtest server response
+        """
+        future: 'Future[str]' = Future()
+        self._cmds.append(qtest_cmd)
+        self._futures.append(future)
+        self._checked.append(check)
+        return future
+
+    def flush(self) -> None:
+        """
+        Send the queued commands and complete their futures.
+
+        @raise QEMUQtestError if the connection is closed before all the
+                              responses are received; the futures of the
+                              commands fail with the same exception
+        """
+        cmds, futures, checked = self._cmds, self._futures, self._checked
+        self._cmds, self._futures, self._checked = [], [], []
+        try:
+            resps = self._qtest.cmd_batch(cmds)
+        except Exception as err:
+            for future in futures:
+                future.set_exception(err)
+            raise
+
+        for qtest_cmd, resp, future, check in zip(cmds, resps, futures,
+                                                  checked):
+            if not check:
+                future.set_result(resp)
+                continue
+            try:
+                future.set_result(QEMUQtestProtocol.check_response(qtest_cmd,
+                                                                   resp))
+            except QEMUQtestError as err:
+                future.set_exception(err)
+
+
 class QEMUQtestMachine(QEMUMachine):
     """
     A QEMU VM, with a qtest socket available.
@@ -111,6 +363,7 @@ class QEMUQtestMachine(QEMUMachine):
     def __init__(self,
                  binary: str,
                  args: Sequence[str] = (),
+                 *,
                  name: Optional[str] = None,
                  test_dir: str = "/var/tmp",
                  socket_scm_helper: Optional[str] = None,
@@ -141,7 +394,9 @@ class QEMUQtestMachine(QEMUMachine):
     def _post_launch(self) -> None:
         assert self._qtest is not None
         super()._post_launch()
+        start = time.monotonic()
         self._qtest.accept()
+        self._launch_timings['qtest'] = time.monotonic() - start
 
     def _post_shutdown(self) -> None:
         super()._post_shutdown()
@@ -157,3 +412,37 @@ class QEMUQtestMachine(QEMUMachine):
         if self._qtest is None:
             raise RuntimeError("qtest socket not available")
         return self._qtest.cmd(cmd)
+
+    def qtest_batch(self) -> QEMUQtestBatch:
+        """
+        Return a batch to send several qtest commands with a single write.
+        See QEMUQtestBatch.
+        """
+        if self._qtest is None:
+            raise RuntimeError("qtest socket not available")
+        return self._qtest.batch()
+
+    def qtest_read_memory(self, addr: int, size: int) -> bytes:
+        """
+        Read guest memory, see QEMUQtestProtocol.read_memory().
+        """
+        if self._qtest is None:
+            raise RuntimeError("qtest socket not available")
+        return self._qtest.read_memory(addr, size)
+
+    def qtest_write_memory(self, addr: int, data: bytes) -> None:
+        """
+        Write guest memory, see QEMUQtestProtocol.write_memory().
+        """
+        if self._qtest is None:
+            raise RuntimeError("qtest socket not available")
+        self._qtest.write_memory(addr, data)
+
+    def qtest_fill_memory(self, addr: int, size: int,
+                          pattern: bytes = b'\0') -> None:
+        """
+        Fill guest memory, see QEMUQtestProtocol.fill_memory().
+        """
+        if self._qtest is None:
+            raise RuntimeError("qtest socket not available")
+        self._qtest.fill_memory(addr, size, pattern)
@@ -0,0 +1,339 @@
+"""
+QMP sampler module:
+
+The sampler module provides the QMPSampler class, which polls query-*
+commands of a running QEMU at a fixed rate and records the numeric
+values and their rates to a compact binary time-series file, and
+read_samples() to read such a file back.
+"""
+
+# This work is licensed under the terms of the GNU GPL, version 2.  See
+# the COPYING file in the top-level directory.
+
+import logging
+import struct
+import threading
+import time
+from types import TracebackType
+from typing import (
+    Any,
+    BinaryIO,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+)
+
+from .qmp import (
+    QEMUMonitorProtocol,
+    QMPError,
+    QMPEventQueue,
+    SocketAddrT,
+)
+
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_COMMANDS = (
+    'query-blockstats',
+    'query-migrate',
+    'query-jobs',
+    'query-memory-size-summary',
+)
+
+# File format: MAGIC, then records starting with a type byte:
+#   'C' column: index (u32), name length (u16), UTF-8 name
+#   'S' sample: wall clock time, jitter and overhead in seconds (f64),
+#       number of values (u32), then (column, value, rate) triplets
+MAGIC = b'QMPSAMP1'
+_COLUMN = struct.Struct('<cIH')
+_SAMPLE = struct.Struct('<cdddI')
+_VALUE = struct.Struct('<Idd')
+
+# Keys that identify the elements of a list, in order of preference
+_ID_KEYS = ('id', 'device', 'node-name', 'qdev')
+
+
+class Sample(NamedTuple):
+    """
+    A sample read back by read_samples().
+
+    `values` maps each metric to its value and its rate, in units per
+    second since the previous sample (0.0 for the first one).
+    """
+    timestamp: float
+    jitter: float
+    overhead: float
+    values: Dict[str, Tuple[float, float]]
+
+
+def escape(name: str) -> str:
+    """
+    Escape '%' and '/' in a component of a metric name, such as a device
+    id, as '%25' and '%2F'.
+    """
+    return name.replace('%', '%25').replace('/', '%2F')
+
+
+def flatten(prefix: str, value: Any, out: Dict[str, float]) -> None:
+    """
+    Add the numeric leaves of a QMP return value to out, named after
+    their path joined with '/'.  List elements are named after their
+    'id', 'device', 'node-name' or 'qdev' member, or their index.  Each
+    component of the path is escaped with escape(), so that ids such as
+    '/machine/peripheral/net0' cannot be confused with nested members.
+    """
+    if isinstance(value, bool):
+        out[prefix] = float(value)
+    elif isinstance(value, (int, float)):
+        out[prefix] = float(value)
+    elif isinstance(value, dict):
+        for key, member in value.items():
+            flatten(prefix + '/' + escape(key), member, out)
+    elif isinstance(value, list):
+        for index, element in enumerate(value):
+            name = str(index)
+            if isinstance(element, dict):
+                for key in _ID_KEYS:
+                    if element.get(key):
+                        name = str(element[key])
+                        break
+            flatten(prefix + '/' + escape(name), element, out)
+
+
+class QMPSampler:
+    """
+    Poll query-* commands of a running QEMU at a fixed rate, in a
+    background thread::
+
+        path = vm.add_qmp_monitor('sampler')
+        vm.launch()
+        with QMPSampler(path, output='metrics.bin', interval=0.5):
+            run_workload(vm)
+        for sample in read_samples('metrics.bin'):
+            print(sample.values['query-blockstats/disk0/stats/rd_bytes'])
+
+    The sampler uses its own QMP connection, normally a monitor added with
+    QEMUMachine.add_qmp_monitor(), so it never competes with the test for
+    the main monitor or steals its events.  All commands of a sample are
+    sent as one pipelined write.  Commands that QEMU does not know are
+    dropped after the first sample.
+
+    Each sample records its wall clock time, its jitter (how late it
+    started relative to the fixed schedule) and its overhead (how long it
+    took), along with the value and the rate of every metric.  Ticks that
+    are missed because a sample took too long are skipped, not queued.
+
+    @param address: QMP monitor address, as for QEMUMonitorProtocol
+    @param commands: query commands to poll, without arguments
+    @param interval: time between samples, in seconds
+    @param output: time-series file, created or truncated by start();
+                   if None, samples are only kept as `last`
+    """
+    def __init__(self, address: SocketAddrT,
+                 commands: Sequence[str] = DEFAULT_COMMANDS,
+                 interval: float = 1.0,
+                 output: Optional[str] = None):
+        self._address = address
+        self._commands = list(commands)
+        self._interval = interval
+        self._output = output
+        self._qmp: Optional[QEMUMonitorProtocol] = None
+        self._file: Optional[BinaryIO] = None
+        self._columns: Dict[str, int] = {}
+        self._previous: Dict[str, float] = {}
+        self._previous_time: Optional[float] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        #: The values of the last sample, by metric
+        self.last: Dict[str, float] = {}
+        #: Number of samples taken
+        self.samples = 0
+
+    def __enter__(self) -> 'QMPSampler':
+        self.start()
+        return self
+
+    def __exit__(self,
+                 exc_type: Optional[Type[BaseException]],
+                 exc_val: Optional[BaseException],
+                 exc_tb: Optional[TracebackType]) -> None:
+        self.stop()
+
+    def connect(self) -> None:
+        """
+        Connect to the monitor and create the output file, without
+        starting the background thread; see sample().
+
+        @raise OSError on socket connection errors
+        @raise QMPError if the connection cannot be negotiated
+        """
+        # The sampler never reads events, so do not let them pile up
+        self._qmp = QEMUMonitorProtocol(self._address,
+                                        event_queue=QMPEventQueue(maxlen=0))
+        self._qmp.connect()
+        if self._output is not None:
+            # Closed by stop()
+            # pylint: disable=consider-using-with
+            self._file = open(self._output, 'wb')
+            self._file.write(MAGIC)
+
+    def start(self) -> None:
+        """
+        Connect to the monitor and start sampling in the background.
+
+        @raise OSError on socket connection errors
+        @raise QMPError if the connection cannot be negotiated
+        """
+        self.connect()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop sampling, and close the connection and the output file.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._qmp is not None:
+            self._qmp.close()
+            self._qmp = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _run(self) -> None:
+        start = time.monotonic()
+        tick = 0
+        while True:
+            scheduled = start + tick * self._interval
+            if self._stop.wait(max(0.0, scheduled - time.monotonic())):
+                break
+            now = time.monotonic()
+            try:
+                self.sample(jitter=now - scheduled)
+            except (OSError, QMPError) as err:
+                # Most likely QEMU has exited
+                LOG.debug('Sampling stopped: %s', err)
+                break
+            # Skip the ticks that were missed
+            tick = max(tick + 1,
+                       int((time.monotonic() - start) / self._interval) + 1)
+
+    def sample(self, jitter: float = 0.0) -> Dict[str, float]:
+        """
+        Take one sample now and record it.  This is called by the
+        background thread; call it directly only after connect(), to
+        sample at times of your choosing instead.
+
+        @param jitter: how late the sample is, for the record
+        @return the values of the sample, by metric
+        """
+        assert self._qmp is not None
+        begin = time.monotonic()
+        timestamp = time.time()
+        with self._qmp.pipeline() as pipe:
+            futures = [pipe.cmd(name) for name in self._commands]
+        values: Dict[str, float] = {}
+        for name, future in zip(list(self._commands), futures):
+            resp = future.result()
+            if 'return' in resp:
+                flatten(name, resp['return'], values)
+            else:
+                LOG.info('Not sampling %s: %s', name, resp.get('error'))
+                self._commands.remove(name)
+
+        rates = self._rates(values, begin)
+        self.last = values
+        self.samples += 1
+
+        if self._file is not None:
+            self._write(timestamp, jitter, time.monotonic() - begin, rates)
+        return values
+
+    def _rates(self, values: Dict[str, float],
+               now: float) -> List[Tuple[str, float, float]]:
+        """
+        Return (metric, value, rate) triplets, with the rates since the
+        previous call, and remember values for the next one.
+        """
+        elapsed = 0.0
+        if self._previous_time is not None:
+            elapsed = now - self._previous_time
+        rates = []
+        for key, value in values.items():
+            rate = 0.0
+            previous = self._previous.get(key)
+            if previous is not None and elapsed > 0:
+                rate = (value - previous) / elapsed
+            rates.append((key, value, rate))
+        self._previous = values
+        self._previous_time = now
+        return rates
+
+    def _write(self, timestamp: float, jitter: float, overhead: float,
+               rates: List[Tuple[str, float, float]]) -> None:
+        assert self._file is not None
+        chunks = []
+        for key, _, _ in rates:
+            if key not in self._columns:
+                index = len(self._columns)
+                self._columns[key] = index
+                name = key.encode('utf-8')
+                chunks.append(_COLUMN.pack(b'C', index, len(name)) + name)
+        chunks.append(_SAMPLE.pack(b'S', timestamp, jitter, overhead,
+                                   len(rates)))
+        chunks.extend(_VALUE.pack(self._columns[key], value, rate)
+                      for key, value, rate in rates)
+        self._file.write(b''.join(chunks))
+        # Readers may follow the file while sampling goes on
+        self._file.flush()
+
+
+def read_samples(path: str) -> Iterator[Sample]:
+    """
+    Read back a file written by QMPSampler.
+
+    @raise ValueError if the file is not a QMPSampler file
+    """
+    with open(path, 'rb') as infile:
+        data = infile.read()
+    if not data.startswith(MAGIC):
+        raise ValueError('%s is not a QMP sample file' % path)
+    names: List[str] = []
+    offset = len(MAGIC)
+    # A sample may be incomplete if the sampler is still running
+    while offset + 1 <= len(data):
+        kind = data[offset:offset + 1]
+        if kind == b'C':
+            if offset + _COLUMN.size > len(data):
+                break
+            _, index, length = _COLUMN.unpack_from(data, offset)
+            if offset + _COLUMN.size + length > len(data):
+                break
+            offset += _COLUMN.size
+            names[len(names):index + 1] = [''] * (index + 1 - len(names))
+            names[index] = data[offset:offset + length].decode('utf-8')
+            offset += length
+        elif kind == b'S':
+            if offset + _SAMPLE.size > len(data):
+                break
+            _, timestamp, jitter, overhead, count = \
+                _SAMPLE.unpack_from(data, offset)
+            end = offset + _SAMPLE.size + count * _VALUE.size
+            if end > len(data):
+                break
+            values = {names[index]: (value, rate)
+                      for index, value, rate in _VALUE.iter_unpack(
+                          data[offset + _SAMPLE.size:end])}
+            offset = end
+            yield Sample(timestamp, jitter, overhead, values)
+        else:
+            raise ValueError('%s: bad record at offset %d' % (path, offset))
@@ -0,0 +1,155 @@
+"""
+Unit tests for qemu.console_socket, with a Unix socket standing in for
+the console chardev.
+
+Run with "python3 -m pytest python/tests" from the top of the tree.
+"""
+
+# This work is licensed under the terms of the GNU GPL, version 2.  See
+# the COPYING file in the top-level directory.
+
+import os
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from typing import List, Optional, Sequence, Tuple
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+# pylint: disable=wrong-import-position
+from qemu.console_socket import ConsoleSocket
+
+
+class ConsoleTestCase(unittest.TestCase):
+    """Send chunks to a ConsoleSocket, with delays in between."""
+
+    drain = False
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'console.sock')
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen(1)
+        self.thread: Optional[threading.Thread] = None
+
+    def tearDown(self) -> None:
+        if self.thread is not None:
+            self.thread.join()
+        self.server.close()
+        shutil.rmtree(self.tmpdir)
+
+    def console(self, chunks: Sequence[bytes], delay: float = 0.01,
+                timeout: float = 5.0) -> ConsoleSocket:
+        def send() -> None:
+            conn, _ = self.server.accept()
+            with conn:
+                for chunk in chunks:
+                    conn.sendall(chunk)
+                    time.sleep(delay)
+
+        thread = threading.Thread(target=send)
+        thread.start()
+        self.thread = thread
+        console = ConsoleSocket(self.path, drain=self.drain)
+        console.settimeout(timeout)
+        self.addCleanup(console.close)
+        return console
+
+    def split(self, data: bytes, size: int) -> List[bytes]:
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    def test_chunk_boundaries(self) -> None:
+        data = b'booting\r\n' * 50 + b'Welcome to the guest\r\nlogin: '
+        for size in (1, 3, 7, 64):
+            with self.subTest(size=size):
+                console = self.console(self.split(data, size), delay=0)
+                lines: List[bytes] = []
+                index, line = console.expect(['panic', 'login:'],
+                                             on_line=lines.append)
+                self.assertEqual((index, line), (1, b'login:'))
+                self.assertEqual(len(lines), 51)
+                self.assertEqual(lines[-1], b'Welcome to the guest\r\n')
+                console.close()
+                assert self.thread is not None
+                self.thread.join()
+                self.thread = None
+
+    def test_match_spanning_chunks(self) -> None:
+        console = self.console([b'Kernel pa', b'nic - not syncing', b'\n'])
+        index, line = console.expect([b'login:',
+                                      re.compile(b'panic - (not) syncing')])
+        self.assertEqual(index, 1)
+        # The line was not complete yet, the rest is left for later
+        self.assertEqual(line, b'Kernel panic - not syncing')
+        self.assertEqual(console.readline(), b'\n')
+
+    def test_leftmost_match_wins(self) -> None:
+        console = self.console([b'second first\n'])
+        self.assertEqual(console.expect(['first', 'second'])[0], 1)
+
+    def test_first_pattern_wins_on_tie(self) -> None:
+        console = self.console([b'abcd\n'])
+        self.assertEqual(console.expect([re.compile(b'ab'), 'abc'])[0], 0)
+
+    def test_regex_groups(self) -> None:
+        # Numbered backreferences refer to the pattern's own groups
+        console = self.console([b'aa xyzxyz\n'])
+        pattern = re.compile(rb'(xyz)\1')
+        index, line = console.expect([re.compile(b'(q)'), pattern])
+        self.assertEqual((index, line), (1, b'aa xyzxyz\n'))
+
+    def test_regex_flags(self) -> None:
+        console = self.console([b'LOGIN: '])
+        index, _ = console.expect(['login', re.compile(b'login',
+                                                       re.IGNORECASE)])
+        self.assertEqual(index, 1)
+
+    def test_incomplete_line(self) -> None:
+        console = self.console([b'Password: ', b'rest\n'])
+        self.assertEqual(console.expect(['Password:']), (0, b'Password:'))
+        self.assertEqual(console.readline(), b' rest\n')
+
+    def test_eof(self) -> None:
+        console = self.console([b'some output\n'])
+        with self.assertRaises(EOFError):
+            console.expect(['never'])
+
+    def test_idle_timeout(self) -> None:
+        # Output keeps coming for longer than the socket timeout
+        chunks = [b'.'] * 12 + [b'done']
+        console = self.console(chunks, delay=0.05, timeout=0.3)
+        self.assertEqual(console.expect(['done']), (0, b'............done'))
+
+    def test_idle_timeout_expires(self) -> None:
+        console = self.console([b'x', b'y'], delay=1.0, timeout=0.2)
+        start = time.monotonic()
+        with self.assertRaises(socket.timeout):
+            console.expect(['never'])
+        self.assertLess(time.monotonic() - start, 0.9)
+
+    def test_explicit_timeout(self) -> None:
+        # An explicit timeout bounds the whole call
+        chunks = [b'.'] * 20
+        console = self.console(chunks, delay=0.05)
+        start = time.monotonic()
+        with self.assertRaises(socket.timeout):
+            console.expect(['never'], timeout=0.3)
+        self.assertLess(time.monotonic() - start, 0.8)
+
+
+class DrainedConsoleTestCase(ConsoleTestCase):
+    drain = True
+
+    def test_recv(self) -> None:
+        console = self.console([b'abc', b'def\n'])
+        data: Tuple[bytes, ...] = (console.recv(2), console.recv(4))
+        self.assertEqual(data, (b'ab', b'cdef'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+"""
+Unit tests for the background cleanup of qemu.machine, which removes the
+temporary directories of VMs shut down with fast teardown.
+
+Run with "python3 -m pytest python/tests" from the top of the tree.
+"""
+
+# This work is licensed under the terms of the GNU GPL, version 2.  See
+# the COPYING file in the top-level directory.
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+from typing import List
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+# pylint: disable=wrong-import-position
+from qemu.machine import _Reaper
+
+
+class TestReaper(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def make_dirs(self, count: int) -> List[str]:
+        dirs: List[str] = []
+        for i in range(count):
+            path = os.path.join(self.tmpdir, 'qemu-machine-%d' % i)
+            os.makedirs(os.path.join(path, 'sub'))
+            with open(os.path.join(path, 'vm.log'), 'w') as log:
+                log.write('output\n')
+            dirs.append(path)
+        return dirs
+
+    def test_rmtree(self) -> None:
+        reaper = _Reaper()
+        dirs = self.make_dirs(3)
+        for path in dirs:
+            reaper.submit(shutil.rmtree, path, True)
+        reaper.join()
+        self.assertEqual([p for p in dirs if os.path.exists(p)], [])
+
+    def test_failure(self) -> None:
+        # A failing call does not stop the calls queued after it
+        reaper = _Reaper()
+        dirs = self.make_dirs(1)
+        reaper.submit(shutil.rmtree, os.path.join(self.tmpdir, 'missing'))
+        reaper.submit(shutil.rmtree, dirs[0], True)
+        reaper.join()
+        self.assertFalse(os.path.exists(dirs[0]))
+
+    def test_join_unused(self) -> None:
+        _Reaper().join()
+
+    def test_atexit(self) -> None:
+        # The reaper thread is a daemon; the atexit handler completes the
+        # queued calls when the interpreter exits
+        dirs = self.make_dirs(2)
+        script = textwrap.dedent('''
+            import shutil, sys, time
+            sys.path.insert(0, sys.argv[1])
+            from qemu.machine import _REAPER
+            _REAPER.submit(time.sleep, 0.5)
+            for path in sys.argv[2:]:
+                _REAPER.submit(shutil.rmtree, path, True)
+            ''')
+        python_dir = os.path.join(os.path.dirname(__file__), '..')
+        subprocess.run([sys.executable, '-c', script, python_dir] + dirs,
+                       check=True, timeout=60)
+        self.assertEqual([p for p in dirs if os.path.exists(p)], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+"""
+Unit tests for qemu.qmp.QMPEventQueue.
+
+Run with "python3 -m pytest python/tests" from the top of the tree.
+"""
+
+# This work is licensed under the terms of the GNU GPL, version 2.  See
+# the COPYING file in the top-level directory.
+
+import os
+import sys
+from typing import List
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+# pylint: disable=wrong-import-position
+from qemu.qmp import QMPEventQueue, QMPMessage
+
+
+def event(name: str, **data: object) -> QMPMessage:
+    return {'event': name, 'data': data}
+
+
+class TestBounds(unittest.TestCase):
+    def test_unbounded(self) -> None:
+        queue = QMPEventQueue()
+        for i in range(100):
+            queue.append(event('A', i=i))
+        self.assertEqual(len(queue), 100)
+        self.assertEqual(queue.dropped_total, 0)
+
+    def test_maxlen(self) -> None:
+        queue = QMPEventQueue(maxlen=3)
+        for i in range(5):
+            queue.append(event('A' if i % 2 else 'B', i=i))
+        self.assertEqual([e['data']['i'] for e in queue], [2, 3, 4])
+        self.assertEqual(queue.dropped, {'B': 1, 'A': 1})
+
+    def test_max_per_name(self) -> None:
+        queue = QMPEventQueue(max_per_name=2)
+        queue.append(event('STOP'))
+        for i in range(10):
+            queue.append(event('BLOCK_IO_ERROR', i=i))
+        # The flood does not evict the other events
+        self.assertEqual([e['event'] for e in queue],
+                         ['STOP', 'BLOCK_IO_ERROR', 'BLOCK_IO_ERROR'])
+        self.assertEqual(queue.dropped, {'BLOCK_IO_ERROR': 8})
+        self.assertEqual(queue.dropped_total, 8)
+
+    def test_order(self) -> None:
+        queue = QMPEventQueue()
+        names = ['A', 'B', 'A', 'C']
+        for name in names:
+            queue.append(event(name))
+        popped: List[str] = []
+        while True:
+            item = queue.popleft()
+            if item is None:
+                break
+            popped.append(item['event'])
+        self.assertEqual(popped, names)
+        self.assertEqual(len(queue), 0)
+
+
+@mock.patch('qemu.qmp.time.monotonic')
+class TestExpiry(unittest.TestCase):
+    def test_expire(self, monotonic: mock.Mock) -> None:
+        queue = QMPEventQueue(max_age=10)
+        for now in (0, 5, 8):
+            monotonic.return_value = now
+            queue.append(event('A', t=now))
+        monotonic.return_value = 14
+        queue.expire()
+        self.assertEqual([e['data']['t'] for e in queue], [5, 8])
+        self.assertEqual(queue.dropped, {'A': 1})
+
+    def test_len_expires(self, monotonic: mock.Mock) -> None:
+        queue = QMPEventQueue(max_age=10)
+        monotonic.return_value = 0
+        queue.append(event('A'))
+        monotonic.return_value = 11
+        # Nothing left for popleft() once len() said the queue was not empty
+        self.assertEqual(len(queue), 0)
+        self.assertIsNone(queue.popleft())
+
+    def test_pop_match_expires(self, monotonic: mock.Mock) -> None:
+        queue = QMPEventQueue(max_age=10)
+        monotonic.return_value = 0
+        queue.append(event('JOB', id='a'))
+        monotonic.return_value = 5
+        queue.append(event('JOB', id='b'))
+        monotonic.return_value = 12
+        self.assertIsNone(queue.pop_match([('JOB', {'data': {'id': 'a'}})]))
+        self.assertEqual(queue.pop_match([('JOB', None)]),
+                         event('JOB', id='b'))
+
+
+class TestMatch(unittest.TestCase):
+    def test_pop_match(self) -> None:
+        queue = QMPEventQueue()
+        queue.append(event('JOB', id='a'))
+        queue.append(event('STOP'))
+        queue.append(event('JOB', id='b'))
+        # The oldest match of any of the criteria wins
+        found = queue.pop_match([('JOB', {'data': {'id': 'b'}}),
+                                 ('STOP', None)])
+        self.assertEqual(found, event('STOP'))
+        self.assertIsNone(queue.pop_match([('JOB', {'data': {'id': 'c'}})]))
+        self.assertEqual([e['data']['id'] for e in queue], ['a', 'b'])
+
+    def test_pop_last(self) -> None:
+        queue = QMPEventQueue(maxlen=1)
+        queue.append(event('A'))
+        self.assertEqual(queue.pop_last(), event('A'))
+        self.assertIsNone(queue.pop_last())
+        self.assertEqual(len(queue), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+"""
+Unit tests for qemu.qmp_schema, using a hand-written schema in the
+format returned by query-qmp-schema.
+
+Run with "python3 -m pytest python/tests" from the top of the tree.
+"""
+
+# This work is licensed under the terms of the GNU GPL, version 2.  See
+# the COPYING file in the top-level directory.
+
+import os
+import sys
+import unittest
+from typing import Any, Dict, List
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+# pylint: disable=wrong-import-position
+from qemu.qmp_schema import QMPArgumentError, QMPSchema
+
+
+ENTITIES: List[Dict[str, Any]] = [
+    {'name': 'int', 'meta-type': 'builtin', 'json-type': 'int'},
+    {'name': 'str', 'meta-type': 'builtin', 'json-type': 'string'},
+    {'name': 'bool', 'meta-type': 'builtin', 'json-type': 'boolean'},
+    {'name': 'any', 'meta-type': 'builtin', 'json-type': 'value'},
+    {'name': '0', 'meta-type': 'object', 'members': []},
+    {'name': '1', 'meta-type': 'enum', 'values': ['file', 'qcow2']},
+    {'name': '2', 'meta-type': 'array', 'element-type': 'int'},
+    {'name': '3', 'meta-type': 'object', 'tag': 'driver',
+     'members': [{'name': 'driver', 'type': '1'},
+                 {'name': 'node-name', 'type': 'str', 'default': None}],
+     'variants': [{'case': 'file', 'type': '4'},
+                  {'case': 'qcow2', 'type': '5'}]},
+    {'name': '4', 'meta-type': 'object',
+     'members': [{'name': 'filename', 'type': 'str'}]},
+    {'name': '5', 'meta-type': 'object',
+     'members': [{'name': 'file', 'type': '6'},
+                 {'name': 'lazy-refcounts', 'type': 'bool',
+                  'default': None}]},
+    {'name': '6', 'meta-type': 'alternate',
+     'members': [{'type': '3'}, {'type': 'str'}]},
+    {'name': '7', 'meta-type': 'object',
+     'members': [{'name': 'node-name', 'type': 'str'},
+                 {'name': 'size', 'type': 'int'},
+                 {'name': 'sizes', 'type': '2', 'default': None},
+                 {'name': 'data', 'type': 'any', 'default': None}]},
+    {'name': 'block_resize', 'meta-type': 'command', 'arg-type': '7',
+     'ret-type': '0'},
+    {'name': 'blockdev-add', 'meta-type': 'command', 'arg-type': '3',
+     'ret-type': '0'},
+]
+
+
+class TestCheck(unittest.TestCase):
+    def setUp(self) -> None:
+        self.schema = QMPSchema(ENTITIES)
+
+    def assertRejected(self, type_name: str, value: object,
+                       message: str) -> None:
+        with self.assertRaises(QMPArgumentError) as context:
+            self.schema.check(type_name, value, 'x')
+        self.assertEqual(str(context.exception), message)
+
+    def test_builtin(self) -> None:
+        self.schema.check('int', 3, 'x')
+        self.schema.check('bool', True, 'x')
+        self.schema.check('any', {'whatever': [1]}, 'x')
+        self.assertRejected('int', '3', "x: expected int, got '3'")
+        # bool is a subclass of int, but not a JSON number
+        self.assertRejected('int', True, "x: expected int, got True")
+        self.assertRejected('str', 3, "x: expected string, got 3")
+
+    def test_enum(self) -> None:
+        self.schema.check('1', 'qcow2', 'x')
+        self.assertRejected('1', 'qcow3',
+                            "x: expected one of file, qcow2, got 'qcow3'")
+
+    def test_array(self) -> None:
+        self.schema.check('2', [1, 2], 'x')
+        self.assertRejected('2', 1, "x: expected a list, got 1")
+        self.assertRejected('2', [1, 'a'], "x[1]: expected int, got 'a'")
+
+    def test_object(self) -> None:
+        self.schema.check('7', {'node-name': 'a', 'size': 1}, 'x')
+        self.assertRejected('7', [], "x: expected an object, got []")
+        self.assertRejected('7', {'node-name': 'a'},
+                            "x: missing argument 'size'")
+        self.assertRejected('7', {'node-name': 'a', 'size': 1, 'sise': 2},
+                            "x: unexpected argument 'sise'")
+        self.assertRejected('7', {'node-name': 'a', 'size': 1,
+                                  'sizes': [True]},
+                            "x.sizes[0]: expected int, got True")
+
+    def test_variants(self) -> None:
+        self.schema.check('3', {'driver': 'file', 'filename': 'a'}, 'x')
+        self.assertRejected('3', {'driver': 'file'},
+                            "x: missing argument 'filename'")
+        # Members of the other variant are unexpected
+        self.assertRejected('3', {'driver': 'file', 'filename': 'a',
+                                  'lazy-refcounts': True},
+                            "x: unexpected argument 'lazy-refcounts'")
+
+    def test_alternate(self) -> None:
+        self.schema.check('6', 'node0', 'x')
+        self.schema.check('6', {'driver': 'file', 'filename': 'a'}, 'x')
+        # The error of the branch with the same JSON type is reported
+        self.assertRejected('6', {'driver': 'file'},
+                            "x: missing argument 'filename'")
+        self.assertRejected('6', 3, "x: 3 does not match any of object, str")
+
+
+class TestArguments(unittest.TestCase):
+    def setUp(self) -> None:
+        self.schema = QMPSchema(ENTITIES)
+
+    def test_conv_keys(self) -> None:
+        self.assertEqual(self.schema.arguments('block_resize',
+                                               {'node_name': 'a', 'size': 1}),
+                         {'node-name': 'a', 'size': 1})
+        self.assertEqual(self.schema.arguments('block_resize',
+                                               {'node-name': 'a', 'size': 1},
+                                               conv_keys=False),
+                         {'node-name': 'a', 'size': 1})
+        with self.assertRaises(QMPArgumentError):
+            self.schema.arguments('block_resize',
+                                  {'node_name': 'a', 'size': 1},
+                                  conv_keys=False)
+
+    def test_unknown_command(self) -> None:
+        with self.assertRaises(QMPArgumentError):
+            self.schema.arguments('block-resize', {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
-# Pretty print 9p simpletrace log
-# Usage: ./analyse-9p-simpletrace <trace-events> <trace-pid>
+# Pretty print 9p simpletrace log, or report request latencies
+# Usage: ./analyse-9p-simpletrace [--jobs N] <trace-events> <trace-pid>
+#        ./analyse-9p-simpletrace --latency [--format text|csv|json]
+#                                 <trace-events> <trace-pid>
 #
 # Author: Harsh Prateek Bora
 import os
+import sys
+import csv
+import json
 import simpletrace
 
 symbol_9p = {
@@ -78,9 +83,15 @@ symbol_9p = {
 }
 
 class VirtFSRequestTracker(simpletrace.Analyzer):
+        mergeable = True
+
         def begin(self):
                 print("Pretty printing 9p simpletrace log ...")
 
+        def merge(self, other):
+                # Stateless; the output of each chunk is replayed in order
+                pass
+
         def v9fs_rerror(self, tag, id, err):
                 print("RERROR (tag =", tag, ", id =", symbol_9p[id], ", err = \"", os.strerror(err), "\")")
 
@@ -210,4 +221,241 @@ class VirtFSRequestTracker(simpletrace.Analyzer):
         def v9fs_readlink_return(self, tag, id, target):
                 print("RREADLINK (tag =", tag, ", target =", target, ")")
 
-simpletrace.run(VirtFSRequestTracker())
+
+# Return arguments holding the number of bytes transferred
+bytes_arg = {
+    'v9fs_read_return'    : ('read', 'count'),
+    'v9fs_readdir_return' : ('read', 'count'),
+    'v9fs_write_return'   : ('write', 'total'),
+}
+
+def signed(value):
+        "Reinterpret a trace argument as a signed 64-bit integer"
+        if value >= 1 << 63:
+                value -= 1 << 64
+        return value
+
+class TimeBucket(object):
+        def __init__(self):
+                self.requests = 0
+                self.completions = 0
+                self.max_depth = 0
+                # Integral of the in-flight depth over time, in ns
+                self.depth_ns = 0
+                self.bytes = {'read': 0, 'write': 0}
+
+class VirtFSLatencyTracker(simpletrace.Analyzer):
+        """Pair each 9p request with its reply by tag and collect per
+        operation latency histograms, in-flight depth and throughput over
+        time.
+
+        A request is completed by the matching v9fs_*_return event, or by
+        v9fs_rerror/v9fs_rcancel.  Operations that have no return event
+        in `events` (clunk, fsync, flush...) are only counted as requests:
+        they do not contribute a latency or an in-flight depth.  Tracked
+        requests whose tag is reused before they complete are counted as
+        unmatched."""
+
+        def __init__(self, events, bucket_ns=1000 * 1000 * 1000):
+                self.bucket_ns = bucket_ns
+                names = set(e.name for e in events)
+                # Operations that have a v9fs_<op>_return event
+                self.tracked = set(name[len('v9fs_'):] for name in names
+                                   if name + '_return' in names)
+                # (pid, tag) -> (op, timestamp)
+                self.pending = {}
+                self.requests = {}
+                self.latency = {}
+                self.errors = {}
+                self.unmatched = {}
+                self.bytes = {'read': 0, 'write': 0}
+                self.buckets = {}
+                self.first_timestamp = None
+                self.last_timestamp = None
+                self._arg_indexes = {}
+
+        def _bucket(self, index):
+                bucket = self.buckets.get(index)
+                if bucket is None:
+                        bucket = self.buckets[index] = TimeBucket()
+                return bucket
+
+        def _advance(self, timestamp):
+                """Account for the in-flight depth since the last event"""
+                if self.first_timestamp is None:
+                        self.first_timestamp = self.last_timestamp = timestamp
+                        return
+                depth = len(self.pending)
+                start = self.last_timestamp
+                while depth and start < timestamp:
+                        index = start // self.bucket_ns
+                        end = min(timestamp, (index + 1) * self.bucket_ns)
+                        self._bucket(index).depth_ns += depth * (end - start)
+                        start = end
+                self.last_timestamp = max(timestamp, self.last_timestamp)
+
+        def _arg_index(self, event, arg):
+                index = self._arg_indexes.get(event.name)
+                if index is None:
+                        index = event.args.names().index(arg)
+                        self._arg_indexes[event.name] = index
+                return index
+
+        def _count(self, counters, op):
+                counters[op] = counters.get(op, 0) + 1
+
+        def _complete(self, key, timestamp, error=False):
+                op, start = self.pending.pop(key)
+                hist = self.latency.get(op)
+                if hist is None:
+                        hist = self.latency[op] = simpletrace.Histogram()
+                hist.add(timestamp - start)
+                if error:
+                        self._count(self.errors, op)
+                self._bucket(timestamp // self.bucket_ns).completions += 1
+                return op
+
+        def catchall(self, event, rec):
+                name, timestamp, pid, tag = rec[:4]
+                self._advance(timestamp)
+                key = (pid, tag)
+                bucket = self._bucket(timestamp // self.bucket_ns)
+
+                if name in ('v9fs_rerror', 'v9fs_rcancel'):
+                        if key in self.pending:
+                                self._complete(key, timestamp, error=True)
+                elif name.endswith('_return'):
+                        if key in self.pending:
+                                self._complete(key, timestamp)
+                        if name in bytes_arg:
+                                direction, arg = bytes_arg[name]
+                                count = signed(rec[3 + self._arg_index(event, arg)])
+                                if count > 0:
+                                        self.bytes[direction] += count
+                                        bucket.bytes[direction] += count
+                else:
+                        op = name[len('v9fs_'):]
+                        if key in self.pending:
+                                self._count(self.unmatched, self.pending.pop(key)[0])
+                        if op in self.tracked:
+                                self.pending[key] = (op, timestamp)
+                        self._count(self.requests, op)
+                        bucket.requests += 1
+                bucket.max_depth = max(bucket.max_depth, len(self.pending))
+
+        def ops(self):
+                "Return per-operation rows, sorted by operation name"
+                rows = []
+                for op in sorted(set(self.requests) | set(self.latency) |
+                                 set(self.unmatched)):
+                        hist = self.latency.get(op, simpletrace.Histogram())
+                        row = {'op': op,
+                               'requests': self.requests.get(op, 0),
+                               'count': hist.count,
+                               'errors': self.errors.get(op, 0),
+                               'unmatched': self.unmatched.get(op, 0)}
+                        for label, pct in (('min_ns', 0), ('p50_ns', 50),
+                                           ('p90_ns', 90), ('p99_ns', 99),
+                                           ('p999_ns', 99.9)):
+                                row[label] = hist.min if pct == 0 else hist.percentile(pct)
+                        row['max_ns'] = hist.max
+                        row['mean_ns'] = None if not hist.count else round(hist.mean())
+                        rows.append(row)
+                return rows
+
+        def timeline(self):
+                "Return per-bucket rows in time order"
+                rows = []
+                seconds = self.bucket_ns / 1e9
+                for index in sorted(self.buckets):
+                        bucket = self.buckets[index]
+                        rows.append({'start_ns': index * self.bucket_ns,
+                                     'requests': bucket.requests,
+                                     'completions': bucket.completions,
+                                     'max_depth': bucket.max_depth,
+                                     'mean_depth': round(bucket.depth_ns / self.bucket_ns, 3),
+                                     'read_bytes_per_s': round(bucket.bytes['read'] / seconds),
+                                     'write_bytes_per_s': round(bucket.bytes['write'] / seconds)})
+                return rows
+
+        def summary(self):
+                duration = 0
+                if self.first_timestamp is not None:
+                        duration = self.last_timestamp - self.first_timestamp
+                seconds = duration / 1e9
+                return {'duration_ns': duration,
+                        'read_bytes': self.bytes['read'],
+                        'write_bytes': self.bytes['write'],
+                        'read_bytes_per_s': round(self.bytes['read'] / seconds) if seconds else None,
+                        'write_bytes_per_s': round(self.bytes['write'] / seconds) if seconds else None,
+                        'in_flight_at_end': len(self.pending)}
+
+def write_csv(rows, fobj):
+        if not rows:
+                return
+        writer = csv.DictWriter(fobj, fieldnames=list(rows[0]),
+                                lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+
+def report_latency(tracker, fmt, timeline_csv=None):
+        if timeline_csv:
+                with open(timeline_csv, 'w') as f:
+                        write_csv(tracker.timeline(), f)
+        if fmt == 'json':
+                json.dump({'summary': tracker.summary(),
+                           'ops': tracker.ops(),
+                           'timeline': tracker.timeline()},
+                          sys.stdout, indent=2, sort_keys=True)
+                print()
+        elif fmt == 'csv':
+                write_csv(tracker.ops(), sys.stdout)
+        else:
+                summary = tracker.summary()
+                print("Duration: %d ns, read: %d bytes (%s bytes/s), written: %d bytes (%s bytes/s), in flight at end: %d" %
+                      (summary['duration_ns'], summary['read_bytes'], summary['read_bytes_per_s'],
+                       summary['write_bytes'], summary['write_bytes_per_s'], summary['in_flight_at_end']))
+                print("%-12s %9s %9s %7s %9s %12s %12s %12s %12s %12s %12s" %
+                      ('op', 'requests', 'count', 'errors', 'unmatched', 'p50_ns',
+                       'p90_ns', 'p99_ns', 'p999_ns', 'max_ns', 'mean_ns'))
+                for row in tracker.ops():
+                        times = tuple('-' if row[k] is None else row[k]
+                                      for k in ('p50_ns', 'p90_ns', 'p99_ns',
+                                                'p999_ns', 'max_ns', 'mean_ns'))
+                        print("%-12s %9d %9d %7d %9d %12s %12s %12s %12s %12s %12s" %
+                              ((row['op'], row['requests'], row['count'],
+                                row['errors'], row['unmatched']) + times))
+
+if __name__ == '__main__':
+        # The pretty-printer streams its output unless --jobs is given
+        parser = simpletrace.get_args('Pretty print 9p simpletrace logs or '
+                                      'report 9p request latencies.', jobs=1)
+        parser.add_argument('--latency', action='store_true',
+                            help='report per-operation latency percentiles, '
+                                 'in-flight depth and throughput instead of '
+                                 'printing each request')
+        parser.add_argument('--format', choices=('text', 'csv', 'json'),
+                            default='text', help='latency report format')
+        parser.add_argument('--bucket-ms', type=simpletrace.positive_int,
+                            default=1000,
+                            help='time bucket width for the timeline, in ms')
+        parser.add_argument('--timeline-csv', metavar='FILE',
+                            help='also write the per-bucket timeline as CSV')
+        args = parser.parse_args()
+
+        if not args.latency:
+                simpletrace.run(VirtFSRequestTracker(), args)
+                sys.exit(0)
+
+        events = simpletrace.read_events(open(args.events, 'r'), args.events)
+        names = set(e.name for e in events if e.name.startswith('v9fs_'))
+        if args.filter_events is not None:
+                names &= args.filter_events
+        tracker = VirtFSLatencyTracker(events,
+                                       bucket_ns=args.bucket_ms * 1000 * 1000)
+        simpletrace.process(events, args.tracefile, tracker,
+                            read_header=not args.no_header,
+                            follow=args.follow,
+                            start_ns=args.start_ns, end_ns=args.end_ns,
+                            filter_events=names, events_file=args.events)
+        report_latency(tracker, args.format, args.timeline_csv)
@@ -8,58 +8,227 @@
 
 import simpletrace
 import argparse
-import numpy as np
+from collections import deque
 
-class MutexAnalyser(simpletrace.Analyzer):
-    "A simpletrace Analyser for checking locks."
+class LockStats(object):
+    "Wait and hold time distributions for a group of lock operations."
 
     def __init__(self):
+        self.wait = simpletrace.Histogram()
+        self.hold = simpletrace.Histogram()
+
+    def merge(self, other):
+        self.wait.merge(other.wait)
+        self.hold.merge(other.hold)
+
+class MutexStats(LockStats):
+    "Per-mutex counters and state."
+
+    def __init__(self):
+        super(MutexStats, self).__init__()
+        self.locks = 0
+        self.locked = 0
+        self.unlocked = 0
+        # (timestamp, filename, line) of the current owner, if any
+        self.holder = None
+        # True once a locked or unlock event has defined the owner
+        self.holder_known = False
+        self.lock_loc = None
+        self.locked_loc = None
+        self.unlock_loc = None
+
+class MutexAnalyser(simpletrace.Analyzer):
+    """A simpletrace Analyser for checking locks.
+
+    simpletrace records the process ID, not the thread ID, so lock and
+    locked events are paired first in, first out for each mutex and call
+    site, and the per-pid statistics are per process.
+    """
+
+    mergeable = True
+
+    # Above this many contention time buckets, their width is doubled
+    MAX_BUCKETS = 4096
+
+    def __init__(self, bucket_ns=100 * 1000 * 1000):
+        self.bucket_ns = bucket_ns
         self.locks = 0
         self.locked = 0
         self.unlocks = 0
         self.mutex_records = {}
+        self.pid_records = {}
+        self.site_records = {}
+        # bucket number -> [acquisitions, total wait time]
+        self.time_buckets = {}
+        # (mutex, pid, filename, line) -> timestamps of pending lock events
+        self.waiters = {}
+        # Keys that had a lock or locked event in this trace (or chunk)
+        self.seen_keys = set()
+        # Events whose lock/locked event may precede the trace (or chunk).
+        # Only the first locked event of each key can be the end of a
+        # wait that started earlier; later unmatched ones come from
+        # trylock or from re-acquiring the mutex in a condition wait.
+        self.orphan_locked = {}
+        self.orphan_unlocks = []
 
     def _get_mutex(self, mutex):
         if not mutex in self.mutex_records:
-            self.mutex_records[mutex] = {"locks": 0,
-                                         "lock_time": 0,
-                                         "acquire_times": [],
-                                         "locked": 0,
-                                         "locked_time": 0,
-                                         "held_times": [],
-                                         "unlocked": 0}
-
+            self.mutex_records[mutex] = MutexStats()
         return self.mutex_records[mutex]
 
-    def qemu_mutex_lock(self, timestamp, mutex, filename, line):
+    def _get_stats(self, records, key):
+        if not key in records:
+            records[key] = LockStats()
+        return records[key]
+
+    def _acquired(self, mutex, pid, filename, line, wait_time, timestamp):
+        self._get_mutex(mutex).wait.add(wait_time)
+        self._get_stats(self.pid_records, pid).wait.add(wait_time)
+        site = (filename, line)
+        self._get_stats(self.site_records, site).wait.add(wait_time)
+        bucket = self.time_buckets.setdefault(timestamp // self.bucket_ns,
+                                              [0, 0])
+        bucket[0] += 1
+        bucket[1] += wait_time
+        if len(self.time_buckets) > self.MAX_BUCKETS:
+            self._coarsen()
+
+    def _coarsen(self):
+        "Double the width of the contention time buckets"
+        buckets = {}
+        for index, (count, wait) in self.time_buckets.items():
+            bucket = buckets.setdefault(index // 2, [0, 0])
+            bucket[0] += count
+            bucket[1] += wait
+        self.time_buckets = buckets
+        self.bucket_ns *= 2
+
+    def _released(self, mutex, pid, holder, timestamp):
+        held_since, filename, line = holder
+        held_time = timestamp - held_since
+        self._get_mutex(mutex).hold.add(held_time)
+        self._get_stats(self.pid_records, pid).hold.add(held_time)
+        self._get_stats(self.site_records, (filename, line)).hold.add(held_time)
+
+    def qemu_mutex_lock(self, timestamp, pid, mutex, filename, line):
         self.locks += 1
         rec = self._get_mutex(mutex)
-        rec["locks"] += 1
-        rec["lock_time"] = timestamp[0]
-        rec["lock_loc"] = (filename, line)
+        rec.locks += 1
+        rec.lock_loc = (filename, line)
+        key = (mutex, pid, filename, line)
+        self.waiters.setdefault(key, deque()).append(timestamp)
+        self.seen_keys.add(key)
 
-    def qemu_mutex_locked(self, timestamp, mutex, filename, line):
+    def qemu_mutex_locked(self, timestamp, pid, mutex, filename, line):
         self.locked += 1
         rec = self._get_mutex(mutex)
-        rec["locked"] += 1
-        rec["locked_time"] = timestamp[0]
-        acquire_time = rec["locked_time"] - rec["lock_time"]
-        rec["locked_loc"] = (filename, line)
-        rec["acquire_times"].append(acquire_time)
+        rec.locked += 1
+        rec.locked_loc = (filename, line)
+        rec.holder = (timestamp, filename, line)
+        rec.holder_known = True
+        key = (mutex, pid, filename, line)
+        pending = self.waiters.get(key)
+        if pending:
+            self._acquired(mutex, pid, filename, line,
+                           timestamp - pending.popleft(), timestamp)
+            if not pending:
+                del self.waiters[key]
+        elif key not in self.seen_keys:
+            self.orphan_locked[key] = timestamp
+        self.seen_keys.add(key)
 
-    def qemu_mutex_unlock(self, timestamp, mutex, filename, line):
+    def qemu_mutex_unlock(self, timestamp, pid, mutex, filename, line):
         self.unlocks += 1
         rec = self._get_mutex(mutex)
-        rec["unlocked"] += 1
-        held_time = timestamp[0] - rec["locked_time"]
-        rec["held_times"].append(held_time)
-        rec["unlock_loc"] = (filename, line)
+        rec.unlocked += 1
+        rec.unlock_loc = (filename, line)
+        if rec.holder is not None:
+            self._released(mutex, pid, rec.holder, timestamp)
+        elif not rec.holder_known:
+            self.orphan_unlocks.append((mutex, pid, timestamp))
+        rec.holder = None
+        rec.holder_known = True
+
+    def merge(self, other):
+        self.locks += other.locks
+        self.locked += other.locked
+        self.unlocks += other.unlocks
+
+        # Pair up events that straddle the chunk boundary; the others
+        # precede the whole trace and are ignored, as in a serial run
+        for key, timestamp in other.orphan_locked.items():
+            pending = self.waiters.get(key)
+            if pending:
+                mutex, pid, filename, line = key
+                self._acquired(mutex, pid, filename, line,
+                               timestamp - pending.popleft(), timestamp)
+                if not pending:
+                    del self.waiters[key]
+        for mutex, pid, timestamp in other.orphan_unlocks:
+            rec = self.mutex_records.get(mutex)
+            if rec is not None and rec.holder is not None:
+                self._released(mutex, pid, rec.holder, timestamp)
+                rec.holder = None
+
+        for key, pending in other.waiters.items():
+            self.waiters.setdefault(key, deque()).extend(pending)
+        for key, timestamp in other.orphan_locked.items():
+            if key not in self.seen_keys:
+                self.orphan_locked[key] = timestamp
+        self.seen_keys |= other.seen_keys
 
+        for mutex, orec in other.mutex_records.items():
+            rec = self._get_mutex(mutex)
+            rec.merge(orec)
+            rec.locks += orec.locks
+            rec.locked += orec.locked
+            rec.unlocked += orec.unlocked
+            if orec.holder_known:
+                rec.holder = orec.holder
+                rec.holder_known = True
+            for loc in ("lock_loc", "locked_loc", "unlock_loc"):
+                if getattr(orec, loc) is not None:
+                    setattr(rec, loc, getattr(orec, loc))
+        for pid, stats in other.pid_records.items():
+            self._get_stats(self.pid_records, pid).merge(stats)
+        for site, stats in other.site_records.items():
+            self._get_stats(self.site_records, site).merge(stats)
+        # Both widths are the initial one times a power of two
+        while self.bucket_ns < other.bucket_ns:
+            self._coarsen()
+        factor = self.bucket_ns // other.bucket_ns
+        for index, (count, wait) in other.time_buckets.items():
+            bucket = self.time_buckets.setdefault(index // factor, [0, 0])
+            bucket[0] += count
+            bucket[1] += wait
+        while len(self.time_buckets) > self.MAX_BUCKETS:
+            self._coarsen()
+
+
+def format_hist(hist):
+    "Format a summary of a histogram of times"
+    return ("count:%d min:%d p50:%d p99:%d p999:%d avg:%.2f max:%d" %
+            (hist.count, hist.min, hist.percentile(50), hist.percentile(99),
+             hist.percentile(99.9), hist.mean(), hist.max))
+
+def format_site(site):
+    filename, line = site
+    if isinstance(filename, bytes):
+        filename = filename.decode(errors="replace")
+    return "%s:%d" % (filename, line)
 
 def get_args():
     "Grab options"
     parser = argparse.ArgumentParser()
     parser.add_argument("--output", "-o", type=str, help="Render plot to file")
+    parser.add_argument("--jobs", "-j", type=int, default=None,
+                        help="Number of worker processes (default: one per CPU)")
+    parser.add_argument("--top", type=int, default=10,
+                        help="Number of call sites and time buckets to show")
+    parser.add_argument("--bucket-ms", type=int, default=100,
+                        help="Initial width of the contention time buckets "
+                        "in ms; they are widened to keep at most %d" %
+                        MutexAnalyser.MAX_BUCKETS)
     parser.add_argument("events", type=str, help='trace file read from')
     parser.add_argument("tracefile", type=str, help='trace file read from')
     return parser.parse_args()
@@ -68,31 +237,63 @@ if __name__ == '__main__':
     args = get_args()
 
     # Gather data from the trace
-    analyser = MutexAnalyser()
-    simpletrace.process(args.events, args.tracefile, analyser)
+    analyser = MutexAnalyser(bucket_ns=args.bucket_ms * 1000 * 1000)
+    simpletrace.process_parallel(args.events, args.tracefile, analyser,
+                                 jobs=args.jobs)
 
     print ("Total locks: %d, locked: %d, unlocked: %d" %
            (analyser.locks, analyser.locked, analyser.unlocks))
 
-    # Now dump the individual lock stats
-    for key, val in sorted(analyser.mutex_records.iteritems(),
-                           key=lambda k_v: k_v[1]["locks"]):
+    # Now dump the individual lock stats, most contended first
+    for key, val in sorted(analyser.mutex_records.items(),
+                           key=lambda k_v: k_v[1].wait.total, reverse=True):
         print ("Lock: %#x locks: %d, locked: %d, unlocked: %d" %
-               (key, val["locks"], val["locked"], val["unlocked"]))
+               (key, val.locks, val.locked, val.unlocked))
 
-        acquire_times = np.array(val["acquire_times"])
-        if len(acquire_times) > 0:
-            print ("  Acquire Time: min:%d median:%d avg:%.2f max:%d" %
-                   (acquire_times.min(), np.median(acquire_times),
-                    acquire_times.mean(), acquire_times.max()))
+        if val.wait.count > 0:
+            print ("  Acquire Time: %s" % format_hist(val.wait))
 
-        held_times = np.array(val["held_times"])
-        if len(held_times) > 0:
-            print ("  Held Time: min:%d median:%d avg:%.2f max:%d" %
-                   (held_times.min(), np.median(held_times),
-                    held_times.mean(), held_times.max()))
+        if val.hold.count > 0:
+            print ("  Held Time: %s" % format_hist(val.hold))
 
         # Check if any locks still held
-        if val["locks"] > val["locked"]:
-            print ("  LOCK HELD (%s:%s)" % (val["locked_loc"]))
-            print ("  BLOCKED   (%s:%s)" % (val["lock_loc"]))
+        if val.holder is not None:
+            print ("  LOCK HELD (%s)" % format_site(val.holder[1:]))
+    for (mutex, pid, filename, line), pending in analyser.waiters.items():
+        print ("Lock: %#x BLOCKED (%s) pid: %d waiters: %d" %
+               (mutex, format_site((filename, line)), pid, len(pending)))
+
+    # simpletrace records the process ID, not the thread ID
+    print ("\nPer process:")
+    for pid, val in sorted(analyser.pid_records.items()):
+        print ("  pid %d" % pid)
+        if val.wait.count > 0:
+            print ("    Acquire Time: %s" % format_hist(val.wait))
+        if val.hold.count > 0:
+            print ("    Held Time: %s" % format_hist(val.hold))
+
+    print ("\nTop call sites by acquire time:")
+    sites = sorted(analyser.site_records.items(),
+                   key=lambda k_v: k_v[1].wait.total, reverse=True)
+    for site, val in sites[:args.top]:
+        if val.wait.count > 0:
+            print ("  %s total:%d %s" %
+                   (format_site(site), val.wait.total, format_hist(val.wait)))
+
+    print ("\nTop call sites by held time:")
+    sites = sorted(analyser.site_records.items(),
+                   key=lambda k_v: k_v[1].hold.total, reverse=True)
+    for site, val in sites[:args.top]:
+        if val.hold.count > 0:
+            print ("  %s total:%d %s" %
+                   (format_site(site), val.hold.total, format_hist(val.hold)))
+
+    # Buckets get wider on long traces
+    print ("\nContention spikes (%d ms buckets):" %
+           (analyser.bucket_ns // (1000 * 1000)))
+    buckets = sorted(analyser.time_buckets.items(),
+                     key=lambda k_v: k_v[1][1], reverse=True)
+    for index, (count, wait) in buckets[:args.top]:
+        print ("  %d-%d ns: acquisitions:%d total acquire time:%d" %
+               (index * analyser.bucket_ns, (index + 1) * analyser.bucket_ns,
+                count, wait))
@@ -17,7 +17,9 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with this library; if not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import json
+import mmap
 import os
 import argparse
 import collections
@@ -25,6 +27,9 @@ import struct
 import sys
 
 
+HEX_BYTES = ['%02x' % i for i in range(256)]
+
+
 def mkdir_p(path):
     try:
         os.makedirs(path)
@@ -33,21 +38,75 @@ def mkdir_p(path):
 
 
 class MigrationFile(object):
+    # Big endian integers, as found in the migration stream
+    S64 = struct.Struct('>q')
+    S32 = struct.Struct('>i')
+    S16 = struct.Struct('>h')
+    S8 = struct.Struct('>b')
+    U8 = struct.Struct('>B')
+
     def __init__(self, filename):
         self.filename = filename
         self.file = open(self.filename, "rb")
-
+        # Map the whole file rather than reading it field by field; RAM
+        # pages can then be handed out as memoryviews without copies.
+        # Fall back to reading it in one go if it cannot be mapped.
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            self.data = self.file.read()
+        self.view = memoryview(self.data)
+        self.size = len(self.data)
+        self.pos = 0
+
+    def unexpected_end(self):
+        return Exception("Unexpected end of %s at 0x%x" % (self.filename, self.pos))
+
+    # These are called for every RAM page, keep them short
     def read64(self):
-        return int.from_bytes(self.file.read(8), byteorder='big', signed=True)
+        try:
+            value, = self.S64.unpack_from(self.data, self.pos)
+        except struct.error:
+            raise self.unexpected_end() from None
+        self.pos += 8
+        return value
 
     def read32(self):
-        return int.from_bytes(self.file.read(4), byteorder='big', signed=True)
+        try:
+            value, = self.S32.unpack_from(self.data, self.pos)
+        except struct.error:
+            raise self.unexpected_end() from None
+        self.pos += 4
+        return value
 
     def read16(self):
-        return int.from_bytes(self.file.read(2), byteorder='big', signed=True)
+        try:
+            value, = self.S16.unpack_from(self.data, self.pos)
+        except struct.error:
+            raise self.unexpected_end() from None
+        self.pos += 2
+        return value
 
     def read8(self):
-        return int.from_bytes(self.file.read(1), byteorder='big', signed=True)
+        try:
+            value, = self.S8.unpack_from(self.data, self.pos)
+        except struct.error:
+            raise self.unexpected_end() from None
+        self.pos += 1
+        return value
+
+    def readu8(self):
+        try:
+            value, = self.U8.unpack_from(self.data, self.pos)
+        except struct.error:
+            raise self.unexpected_end() from None
+        self.pos += 1
+        return value
+
+    def peek8(self):
+        if self.pos >= self.size:
+            raise self.unexpected_end()
+        return self.S8.unpack_from(self.data, self.pos)[0]
 
     def readstr(self, len = None):
         return self.readvar(len).decode('utf-8')
@@ -57,52 +116,192 @@ class MigrationFile(object):
             size = self.read8()
         if size == 0:
             return ""
-        value = self.file.read(size)
-        if len(value) != size:
-            raise Exception("Unexpected end of %s at 0x%x" % (self.filename, self.file.tell()))
+        return bytes(self.readview(size))
+
+    # Returns the next size bytes without copying them.  The view is only
+    # valid until close() is called.
+    def readview(self, size):
+        end = self.pos + size
+        if end > self.size:
+            raise self.unexpected_end()
+        value = self.view[self.pos:end]
+        self.pos = end
         return value
 
+    def skip(self, size):
+        if self.pos + size > self.size:
+            raise self.unexpected_end()
+        self.pos += size
+
     def tell(self):
-        return self.file.tell()
+        return self.pos
 
     # The VMSD description is at the end of the file, after EOF. Look for
     # the last NULL byte, then for the beginning brace of JSON.
     def read_migration_debug_json(self):
         QEMU_VM_VMDESCRIPTION = 0x06
 
-        # Remember the offset in the file when we started
-        entrypos = self.file.tell()
-
-        # Read the last 10MB
-        self.file.seek(0, os.SEEK_END)
-        endpos = self.file.tell()
-        self.file.seek(max(-endpos, -10 * 1024 * 1024), os.SEEK_END)
-        datapos = self.file.tell()
-        data = self.file.read()
-        # The full file read closed the file as well, reopen it
-        self.file = open(self.filename, "rb")
+        # Look in the last 10MB
+        datapos = max(0, self.size - 10 * 1024 * 1024)
 
         # Find the last NULL byte, then the first brace after that. This should
         # be the beginning of our JSON data.
-        nulpos = data.rfind(b'\0')
-        jsonpos = data.find(b'{', nulpos)
+        nulpos = self.data.rfind(b'\0', datapos)
+        jsonpos = self.data.find(b'{', max(nulpos, datapos))
 
         # Check backwards from there and see whether we guessed right
-        self.file.seek(datapos + jsonpos - 5, 0)
-        if self.read8() != QEMU_VM_VMDESCRIPTION:
+        if jsonpos < 5 or self.data[jsonpos - 5] != QEMU_VM_VMDESCRIPTION:
             raise Exception("No Debug Migration device found")
 
-        jsonlen = self.read32()
-
-        # Seek back to where we were at the beginning
-        self.file.seek(entrypos, 0)
+        jsonlen, = self.S32.unpack_from(self.data, jsonpos - 4)
 
         # explicit decode() needed for Python 3.5 compatibility
-        return data[jsonpos:jsonpos + jsonlen].decode("utf-8")
+        return bytes(self.view[jsonpos:jsonpos + jsonlen]).decode("utf-8")
 
     def close(self):
+        self.view.release()
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
         self.file.close()
 
+# Writes each RAM block to a file of the same name.  The files are sparse:
+# they are created with their final size and zero pages are left as holes,
+# unless they overwrite data sent earlier in the stream.  Consecutive pages
+# are coalesced into large pwrite() calls.
+class RamBlockFiles(object):
+    MAX_WRITE = 8 * 1024 * 1024
+
+    def __init__(self, page_size):
+        self.page_size = page_size
+        self.fds = {}
+        # Pages of each block that hold data, which zero pages must clear
+        self.written = {}
+        # Pending write: file descriptor, offset and buffers
+        self.fd = None
+        self.start = 0
+        self.end = 0
+        self.buffers = []
+
+    def add_block(self, name, size):
+        print(name)
+        mkdir_p('./' + os.path.dirname(name))
+        if name in self.fds:
+            self.flush()
+            os.close(self.fds[name])
+        fd = os.open('./' + name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        os.ftruncate(fd, size)
+        self.fds[name] = fd
+        self.written[name] = bytearray((size + self.page_size - 1) // self.page_size)
+
+    def write(self, name, addr, data):
+        fd = self.fds[name]
+        if fd != self.fd or addr != self.end or \
+           self.end - self.start >= self.MAX_WRITE:
+            self.flush()
+            self.fd = fd
+            self.start = self.end = addr
+        self.buffers.append(data)
+        self.end += len(data)
+
+    def page(self, name, addr, data):
+        self.written[name][addr // self.page_size] = 1
+        self.write(name, addr, data)
+
+    def fill(self, name, addr, fill_char):
+        index = addr // self.page_size
+        if fill_char == 0:
+            if not self.written[name][index]:
+                return
+            self.written[name][index] = 0
+        else:
+            self.written[name][index] = 1
+        self.write(name, addr, bytes((fill_char,)) * self.page_size)
+
+    def flush(self):
+        if self.buffers:
+            data = b''.join(self.buffers)
+            done = 0
+            while done < len(data):
+                done += os.pwrite(self.fd, data[done:], self.start + done)
+            self.buffers = []
+        self.fd = None
+
+    def close(self):
+        self.flush()
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
+
+
+# Instead of the RAM blocks, writes a page map and a store of the distinct
+# data pages, keyed by their hash.  Each line of the map describes a run of
+# pages of a block:
+#   <block> <offset> <pages> zero
+#   <block> <offset> <pages> fill <byte>
+#   <block> <offset> <pages> page <index>
+# where the data of "page" runs is found at consecutive indexes of the
+# store, a file of page sized records.  As in the stream, later lines
+# supersede earlier ones for the same pages.
+class RamPageMap(object):
+    def __init__(self, page_size, map_name = 'ram-map.txt',
+                 store_name = 'ram-pages.bin'):
+        self.page_size = page_size
+        print(map_name)
+        self.map = open(map_name, 'w')
+        print(store_name)
+        self.store = open(store_name, 'wb')
+        self.hashes = {}
+        # Current run: block, offset, number of pages, type and argument
+        self.run = None
+
+    def add_block(self, name, size):
+        self.flush()
+        self.map.write('# %s 0x%x\n' % (name, size))
+
+    def add(self, name, addr, kind, arg):
+        run = self.run
+        if run is not None and run[0] == name and run[3] == kind and \
+           run[1] + run[2] * self.page_size == addr and \
+           (kind != 'page' and run[4] == arg or
+            kind == 'page' and run[4] + run[2] == arg):
+            run[2] += 1
+            return
+        self.flush()
+        self.run = [name, addr, 1, kind, arg]
+
+    def page(self, name, addr, data):
+        digest = hashlib.sha1(data).digest()
+        index = self.hashes.get(digest)
+        if index is None:
+            index = len(self.hashes)
+            self.hashes[digest] = index
+            self.store.write(data)
+        self.add(name, addr, 'page', index)
+
+    def fill(self, name, addr, fill_char):
+        if fill_char == 0:
+            self.add(name, addr, 'zero', None)
+        else:
+            self.add(name, addr, 'fill', fill_char)
+
+    def flush(self):
+        if self.run is None:
+            return
+        name, addr, count, kind, arg = self.run
+        if kind == 'zero':
+            self.map.write('%s 0x%x %d zero\n' % (name, addr, count))
+        elif kind == 'fill':
+            self.map.write('%s 0x%x %d fill 0x%02x\n' % (name, addr, count, arg))
+        else:
+            self.map.write('%s 0x%x %d page %d\n' % (name, addr, count, arg))
+        self.run = None
+
+    def close(self):
+        self.flush()
+        self.map.close()
+        self.store.close()
+
+
 class RamSection(object):
     RAM_SAVE_FLAG_COMPRESS = 0x02
     RAM_SAVE_FLAG_MEM_SIZE = 0x04
@@ -121,12 +320,11 @@ class RamSection(object):
         self.TARGET_PAGE_SIZE = ramargs['page_size']
         self.dump_memory = ramargs['dump_memory']
         self.write_memory = ramargs['write_memory']
+        self.extractor = ramargs['extractor']
         self.sizeinfo = collections.OrderedDict()
         self.data = collections.OrderedDict()
         self.data['section sizes'] = self.sizeinfo
         self.name = ''
-        if self.write_memory:
-            self.files = { }
         if self.dump_memory:
             self.memory = collections.OrderedDict()
             self.data['memory'] = self.memory
@@ -141,32 +339,34 @@ class RamSection(object):
         return self.data
 
     def read(self):
+        # This loop runs for every page of the guest, look up what it
+        # needs only once
+        read64 = self.file.read64
+        readu8 = self.file.readu8
+        page_size = self.TARGET_PAGE_SIZE
+        flags_mask = page_size - 1
+        addr_mask = ~flags_mask
+
         # Read all RAM sections
         while True:
-            addr = self.file.read64()
-            flags = addr & (self.TARGET_PAGE_SIZE - 1)
-            addr &= ~(self.TARGET_PAGE_SIZE - 1)
+            addr = read64()
+            flags = addr & flags_mask
+            addr &= addr_mask
 
             if flags & self.RAM_SAVE_FLAG_MEM_SIZE:
                 while True:
-                    namelen = self.file.read8()
                     # We assume that no RAM chunk is big enough to ever
                     # hit the first byte of the address, so when we see
                     # a zero here we know it has to be an address, not the
                     # length of the next block.
-                    if namelen == 0:
-                        self.file.file.seek(-1, 1)
+                    if self.file.peek8() == 0:
                         break
+                    namelen = self.file.read8()
                     self.name = self.file.readstr(len = namelen)
                     len = self.file.read64()
                     self.sizeinfo[self.name] = '0x%016x' % len
                     if self.write_memory:
-                        print(self.name)
-                        mkdir_p('./' + os.path.dirname(self.name))
-                        f = open('./' + self.name, "wb")
-                        f.truncate(0)
-                        f.truncate(len)
-                        self.files[self.name] = f
+                        self.extractor.add_block(self.name, len)
                 flags &= ~self.RAM_SAVE_FLAG_MEM_SIZE
 
             if flags & self.RAM_SAVE_FLAG_COMPRESS:
@@ -174,11 +374,10 @@ class RamSection(object):
                     flags &= ~self.RAM_SAVE_FLAG_CONTINUE
                 else:
                     self.name = self.file.readstr()
-                fill_char = self.file.read8()
+                fill_char = readu8()
                 # The page in question is filled with fill_char now
-                if self.write_memory and fill_char != 0:
-                    self.files[self.name].seek(addr, os.SEEK_SET)
-                    self.files[self.name].write(chr(fill_char) * self.TARGET_PAGE_SIZE)
+                if self.write_memory:
+                    self.extractor.fill(self.name, addr, fill_char)
                 if self.dump_memory:
                     self.memory['%s (0x%016x)' % (self.name, addr)] = 'Filled with 0x%02x' % fill_char
                 flags &= ~self.RAM_SAVE_FLAG_COMPRESS
@@ -189,15 +388,14 @@ class RamSection(object):
                     self.name = self.file.readstr()
 
                 if self.write_memory or self.dump_memory:
-                    data = self.file.readvar(size = self.TARGET_PAGE_SIZE)
+                    data = self.file.readview(page_size)
                 else: # Just skip RAM data
-                    self.file.file.seek(self.TARGET_PAGE_SIZE, 1)
+                    self.file.skip(page_size)
 
                 if self.write_memory:
-                    self.files[self.name].seek(addr, os.SEEK_SET)
-                    self.files[self.name].write(data)
+                    self.extractor.page(self.name, addr, data)
                 if self.dump_memory:
-                    hexdata = " ".join("{0:02x}".format(ord(c)) for c in data)
+                    hexdata = " ".join(map(HEX_BYTES.__getitem__, data))
                     self.memory['%s (0x%016x)' % (self.name, addr)] = hexdata
 
                 flags &= ~self.RAM_SAVE_FLAG_PAGE
@@ -213,11 +411,6 @@ class RamSection(object):
             if flags != 0:
                 raise Exception("Unknown RAM flags: %x" % flags)
 
-    def __del__(self):
-        if self.write_memory:
-            for key in self.files:
-                self.files[key].close()
-
 
 class HTABSection(object):
     HASH_PTE_SIZE_64       = 16
@@ -495,7 +688,8 @@ class MigrationDump(object):
         self.filename = filename
         self.vmsd_desc = None
 
-    def read(self, desc_only = False, dump_memory = False, write_memory = False):
+    def read(self, desc_only = False, dump_memory = False, write_memory = False,
+             page_map = False):
         # Read in the whole file
         file = MigrationFile(self.filename)
 
@@ -521,6 +715,12 @@ class MigrationDump(object):
         ramargs['page_size'] = self.vmsd_desc['page_size']
         ramargs['dump_memory'] = dump_memory
         ramargs['write_memory'] = write_memory
+        ramargs['extractor'] = None
+        if write_memory:
+            if page_map:
+                ramargs['extractor'] = RamPageMap(ramargs['page_size'])
+            else:
+                ramargs['extractor'] = RamBlockFiles(ramargs['page_size'])
         self.section_classes[('ram',0)][1] = ramargs
 
         while True:
@@ -549,6 +749,9 @@ class MigrationDump(object):
                     raise Exception("Mismatched section footer: %x vs %x" % (read_section_id, section_id))
             else:
                 raise Exception("Unknown section type: %d" % section_type)
+        # Pending writes may still refer to the file
+        if ramargs['extractor'] is not None:
+            ramargs['extractor'].close()
         file.close()
 
     def load_vmsd_json(self, file):
@@ -579,6 +782,7 @@ parser.add_argument("-f", "--file", help='migration dump to read from', required
 parser.add_argument("-m", "--memory", help='dump RAM contents as well', action='store_true')
 parser.add_argument("-d", "--dump", help='what to dump ("state" or "desc")', default='state')
 parser.add_argument("-x", "--extract", help='extract contents into individual files', action='store_true')
+parser.add_argument("-p", "--page-map", help='with -x, write a RAM page map and a store of distinct pages instead of RAM block files', action='store_true')
 args = parser.parse_args()
 
 jsonenc = JSONEncoder(indent=4, separators=(',', ': '))
@@ -588,15 +792,15 @@ if args.extract:
 
     dump.read(desc_only = True)
     print("desc.json")
-    f = open("desc.json", "wb")
+    f = open("desc.json", "w")
     f.truncate()
     f.write(jsonenc.encode(dump.vmsd_desc))
     f.close()
 
-    dump.read(write_memory = True)
+    dump.read(write_memory = True, page_map = args.page_map)
     dict = dump.getDict()
     print("state.json")
-    f = open("state.json", "wb")
+    f = open("state.json", "w")
     f.truncate()
     f.write(jsonenc.encode(dict))
     f.close()
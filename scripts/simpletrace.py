@@ -10,7 +10,16 @@
 # For help see docs/devel/tracing.txt
 
 import struct
+import bisect
+import collections
 import inspect
+import itertools
+import mmap
+import json
+import operator
+import os
+import sys
+import time
 from tracetool import read_events, Event
 from tracetool.backend.simple import is_string
 
@@ -24,6 +33,30 @@ record_type_event = 1
 log_header_fmt = '=QQQ'
 rec_header_fmt = '=QQII'
 
+# Precompiled layouts used by the bulk decoder.  An event record on disk is
+# the record type followed by the record header and the arguments, so the
+# first struct covers everything up to the arguments in one go.
+event_header_struct = struct.Struct('=Q' + rec_header_fmt[1:])
+mapping_header_struct = struct.Struct('=QQL')
+rectype_struct = struct.Struct('=Q')
+strlen_struct = struct.Struct('=L')
+
+# sizeof(TraceRecord) in trace/simple.c
+rec_header_len = struct.calcsize(rec_header_fmt)
+
+# Number of records handed out by the bulk decoder at a time
+batch_size = 4096
+
+# Default amount of trace data handled by one process_parallel() worker task
+chunk_size = 64 * 1024 * 1024
+
+# How often a followed trace file is checked for new data, in seconds
+poll_interval = 0.1
+
+# Spacing of the checkpoints in trace index files
+index_interval = 4 * 1024 * 1024
+index_version = 1
+
 def read_header(fobj, hfmt):
     '''Read a trace record header'''
     hlen = struct.calcsize(hfmt)
@@ -96,7 +129,7 @@ def read_trace_header(fobj):
         raise ValueError('Log format %d not supported with this QEMU release!'
                          % log_version)
 
-def read_trace_records(edict, idtoname, fobj):
+def read_trace_records(edict, idtoname, fobj, names=None):
     """Deserialize trace records from a file, yielding record tuples (event_num, timestamp, pid, arg1, ..., arg6).
 
     Note that `idtoname` is modified if the file contains mapping records.
@@ -105,6 +138,8 @@ def read_trace_records(edict, idtoname, fobj):
         edict (str -> Event): events dict, indexed by name
         idtoname (int -> str): event names dict, indexed by event ID
         fobj (file): input file
+        names (set of str): if not None, skip records of other events
+                            without decoding them
 
     """
     while True:
@@ -117,10 +152,287 @@ def read_trace_records(edict, idtoname, fobj):
             event_id, name = get_mapping(fobj)
             idtoname[event_id] = name
         else:
-            rec = read_record(edict, idtoname, fobj)
+            rechdr = read_header(fobj, rec_header_fmt)
+            if (names is not None and rechdr is not None and
+                    idtoname.get(rechdr[0]) not in names):
+                fobj.read(rechdr[2] - rec_header_len)
+                continue
+            rec = get_record(edict, idtoname, rechdr, fobj)
 
             yield rec
 
+def build_args_decoder(event):
+    """Build a function decoding the arguments of an event.
+
+    The returned function takes a buffer and the offset of the first argument
+    and returns a tuple with the argument values.  Runs of integer arguments
+    are decoded with a single precompiled struct; string arguments are
+    returned as slices of the buffer, i.e. bytes for bytes and mmap objects
+    and zero-copy views for memoryview objects.
+    """
+    segments = []
+    nints = 0
+    for type, name in event.args:
+        if is_string(type):
+            if nints:
+                segments.append(struct.Struct('=%dQ' % nints))
+                nints = 0
+            segments.append(None)
+        else:
+            nints += 1
+    if nints:
+        segments.append(struct.Struct('=%dQ' % nints))
+
+    if not segments:
+        return lambda buf, offset: ()
+    if len(segments) == 1 and segments[0] is not None:
+        # Fixed-width event, the common case
+        return segments[0].unpack_from
+
+    unpack_strlen = strlen_struct.unpack_from
+    def decode(buf, offset):
+        args = ()
+        for seg in segments:
+            if seg is None:
+                (length,) = unpack_strlen(buf, offset)
+                offset += 4
+                args += (buf[offset:offset + length],)
+                offset += length
+            else:
+                args += seg.unpack_from(buf, offset)
+                offset += seg.size
+        return args
+    return decode
+
+class RecordDecoder(object):
+    """Decode trace records in bulk from an in-memory buffer.
+
+    The buffer can be any object supporting the buffer protocol, typically a
+    memory-mapped trace file.  Records are returned as the same tuples
+    produced by read_trace_records().
+
+    Note that `idtoname` is modified if the buffer contains mapping records.
+
+    Args:
+        edict (str -> Event): events dict, indexed by name
+        idtoname (int -> str): event names dict, indexed by event ID
+        names (set of str): if not None, skip records of other events; only
+                            their header is looked at
+    """
+
+    def __init__(self, edict, idtoname, names=None):
+        self.edict = edict
+        self.idtoname = idtoname
+        self.names = names
+        # event ID -> (name, argument decoder or None to skip the record)
+        self._layouts = {}
+
+    def _layout(self, event_id):
+        name = self.idtoname[event_id]
+        if self.names is not None and name not in self.names:
+            layout = self._layouts[event_id] = (name, None)
+            return layout
+        try:
+            event = self.edict[name]
+        except KeyError as e:
+            sys.stderr.write('%s event is logged but is not declared ' \
+                             'in the trace events file, try using ' \
+                             'trace-events-all instead.\n' % str(e))
+            sys.exit(1)
+        layout = (name, build_args_decoder(event))
+        self._layouts[event_id] = layout
+        return layout
+
+    def decode(self, buf, offset=0, end=None, count=batch_size):
+        """Decode up to `count` records starting at `offset`.
+
+        Decoding stops early at `end` (default: end of buffer) or at a
+        record that is only partially contained in the buffer.  Skipped
+        records do not count towards `count`.
+
+        Returns a (records, offset) tuple, where offset points just past
+        the last record consumed.
+        """
+        if end is None:
+            end = len(buf)
+        records = []
+        append = records.append
+        layouts = self._layouts
+        idtoname = self.idtoname
+        unpack_header = event_header_struct.unpack_from
+        unpack_mapping = mapping_header_struct.unpack_from
+        unpack_rectype = rectype_struct.unpack_from
+        header_size = event_header_struct.size
+        mapping_size = mapping_header_struct.size
+        while count > 0 and offset + 8 <= end:
+            if offset + header_size <= end:
+                rectype, event_id, timestamp, length, pid = \
+                    unpack_header(buf, offset)
+            else:
+                (rectype,) = unpack_rectype(buf, offset)
+                if rectype != record_type_mapping:
+                    break
+
+            if rectype == record_type_mapping:
+                if offset + mapping_size > end:
+                    break
+                _, event_id, length = unpack_mapping(buf, offset)
+                name_offset = offset + mapping_size
+                if name_offset + length > end:
+                    break
+                name = bytes(buf[name_offset:name_offset + length]).decode()
+                idtoname[event_id] = name
+                layouts.pop(event_id, None)
+                offset = name_offset + length
+                continue
+
+            if length < rec_header_len:
+                raise ValueError('Invalid record length %d at offset %d' %
+                                 (length, offset))
+            next_offset = offset + 8 + length
+            if next_offset > end:
+                break
+            try:
+                name, decode_args = layouts[event_id]
+            except KeyError:
+                name, decode_args = self._layout(event_id)
+            if decode_args is None:
+                offset = next_offset
+                continue
+            append((name, timestamp, pid) +
+                   decode_args(buf, offset + header_size))
+            offset = next_offset
+            count -= 1
+        return records, offset
+
+def map_trace_file(fobj):
+    """Memory-map a trace file for reading, or return None if the file
+    cannot be mapped (pipes, empty files, in-memory streams, ...)."""
+    try:
+        return mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, OverflowError):
+        return None
+
+def read_trace_records_batched(edict, idtoname, fobj, names=None):
+    """Deserialize trace records from a file, yielding lists of record tuples.
+
+    This is the bulk counterpart of read_trace_records(): the file is
+    memory-mapped from its current position and records are decoded in
+    batches by a RecordDecoder.  Files that cannot be mapped are read with
+    read_trace_records() instead.  If `names` is not None, records of other
+    events are skipped.
+
+    Note that `idtoname` is modified if the file contains mapping records.
+    """
+    buf = map_trace_file(fobj)
+    if buf is None:
+        batch = []
+        for rec in read_trace_records(edict, idtoname, fobj, names):
+            batch.append(rec)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+        return
+
+    try:
+        decoder = RecordDecoder(edict, idtoname, names)
+        offset = fobj.tell()
+        while True:
+            records, offset = decoder.decode(buf, offset)
+            if not records:
+                break
+            yield records
+        fobj.seek(offset)
+    finally:
+        buf.close()
+
+def follow_trace_records(edict, idtoname, fobj, poll_interval=poll_interval,
+                         read_size=1024 * 1024, names=None):
+    """Deserialize trace records as they are appended to a trace file,
+    yielding lists of record tuples.
+
+    The file is polled every `poll_interval` seconds once all its data has
+    been decoded.  Data is read `read_size` bytes at a time and only a
+    trailing partially written record is kept between reads, so memory use
+    does not depend on the size of the trace.  If `names` is not None,
+    records of other events are skipped.  This generator never returns.
+
+    Note that `idtoname` is modified if the file contains mapping records.
+    """
+    decoder = RecordDecoder(edict, idtoname, names)
+    pending = b''
+    while True:
+        data = fobj.read(read_size)
+        if not data:
+            time.sleep(poll_interval)
+            continue
+        if pending:
+            data = pending + data
+        offset = 0
+        while True:
+            records, offset = decoder.decode(data, offset)
+            if not records:
+                break
+            yield records
+        pending = data[offset:]
+
+def index_trace_records(buf, idtoname, offset=0, end=None,
+                        interval=chunk_size):
+    """Build a sparse index of the trace records in a buffer.
+
+    Only record headers are decoded, so this is much cheaper than decoding
+    the records themselves.  Returns a (checkpoints, end) tuple: checkpoints
+    is a list of (offset, timestamp, idtoname) tuples for event records at
+    least `interval` bytes apart, starting with the first one, where
+    idtoname is the event ID mapping in effect at that record; end is the
+    offset just past the last complete record.
+
+    Note that `idtoname` is modified if the buffer contains mapping records.
+    Checkpoints share their idtoname dict as long as no mapping record is
+    found between them.
+    """
+    if end is None:
+        end = len(buf)
+    checkpoints = []
+    next_checkpoint = offset
+    snapshot = None
+    unpack_header = event_header_struct.unpack_from
+    unpack_mapping = mapping_header_struct.unpack_from
+    header_size = event_header_struct.size
+    mapping_size = mapping_header_struct.size
+    while offset + 8 <= end:
+        (rectype,) = rectype_struct.unpack_from(buf, offset)
+        if rectype == record_type_mapping:
+            if offset + mapping_size > end:
+                break
+            _, event_id, length = unpack_mapping(buf, offset)
+            name_offset = offset + mapping_size
+            if name_offset + length > end:
+                break
+            idtoname[event_id] = \
+                bytes(buf[name_offset:name_offset + length]).decode()
+            snapshot = None
+            offset = name_offset + length
+            continue
+
+        if offset + header_size > end:
+            break
+        _, _, timestamp, length, _ = unpack_header(buf, offset)
+        if length < rec_header_len:
+            raise ValueError('Invalid record length %d at offset %d' %
+                             (length, offset))
+        if offset + 8 + length > end:
+            break
+        if offset >= next_checkpoint:
+            if snapshot is None:
+                snapshot = dict(idtoname)
+            checkpoints.append((offset, timestamp, snapshot))
+            next_checkpoint = offset + interval
+        offset += 8 + length
+    return checkpoints, offset
+
 class Analyzer(object):
     """A trace file analyzer which processes trace records.
 
@@ -150,8 +462,21 @@ class Analyzer(object):
 
       def runstate_set(self, timestamp, pid, new_state):
           ...
+
+    Analyzers that aggregate over all records can instead define a
+    process_batch() method, which is invoked with each list of record
+    tuples as returned by read_trace_records_batched() and replaces the
+    per-record method lookup and dispatch::
+
+      def process_batch(self, records):
+          for name, timestamp, pid, *args in records:
+              ...
     """
 
+    #: Whether merge() is implemented, so that process_parallel() can split
+    #: the trace between copies of the analyzer
+    mergeable = False
+
     def begin(self):
         """Called at the start of the trace."""
         pass
@@ -164,14 +489,283 @@ class Analyzer(object):
         """Called at the end of the trace."""
         pass
 
-def process(events, log, analyzer, read_header=True):
-    """Invoke an analyzer on each event in a log."""
+    def merge(self, other):
+        """Merge the state of another analyzer into this one.
+
+        process_parallel() runs a copy of the analyzer on each chunk of the
+        trace in a separate process, and merges the copies back into the
+        original analyzer in trace order before calling end().  `other` has
+        processed the records immediately following the ones seen so far
+        by this analyzer.
+
+        Analyzers that implement this method must set `mergeable` to True;
+        others are run serially and this method is never called.
+        """
+        pass
+
+def build_trace_index(log, idtoname, events_file=None, read_header=True):
+    """Return the sparse index of a trace file, see index_trace_records().
+
+    The index starts at the current position of `log` and is cached in a
+    sidecar file named after the trace file with an ".idx" suffix.  The
+    cache is reused as long as the size and modification time of the trace
+    file, the trace-events file `events_file` and `read_header` are
+    unchanged; without a header, the event IDs come from the order of the
+    events, so the index is not cached if `events_file` is unknown.
+    Returns None if the file cannot be memory-mapped.
+    """
+
+    start = log.tell()
+    st = os.fstat(log.fileno())
+    key = {'version': index_version, 'start': start, 'size': st.st_size,
+           'mtime_ns': st.st_mtime_ns, 'interval': index_interval,
+           'header': read_header, 'events': None}
+    filename = getattr(log, 'name', None)
+    if events_file is not None:
+        try:
+            key['events'] = [os.path.realpath(events_file),
+                             os.stat(events_file).st_mtime_ns]
+        except OSError:
+            filename = None
+    if not isinstance(filename, str) or \
+       (not read_header and key['events'] is None):
+        filename = None
+    else:
+        filename += '.idx'
+        try:
+            with open(filename, 'r') as f:
+                cache = json.load(f)
+            if cache['key'] == key:
+                mappings = [dict((int(k), v) for k, v in m.items())
+                            for m in cache['mappings']]
+                checkpoints = [(offset, timestamp, mappings[m])
+                               for offset, timestamp, m in cache['checkpoints']]
+                return checkpoints, cache['end']
+        except (OSError, ValueError, KeyError, IndexError, TypeError):
+            pass
+
+    buf = map_trace_file(log)
+    if buf is None:
+        return None
+    try:
+        checkpoints, end = index_trace_records(buf, dict(idtoname), start,
+                                               interval=index_interval)
+    finally:
+        buf.close()
+
+    if filename is not None:
+        # Checkpoints share mapping dicts, store each of them only once
+        mappings = []
+        mapping_index = {}
+        entries = []
+        for offset, timestamp, mapping in checkpoints:
+            if id(mapping) not in mapping_index:
+                mapping_index[id(mapping)] = len(mappings)
+                mappings.append(mapping)
+            entries.append((offset, timestamp, mapping_index[id(mapping)]))
+        cache = {'key': key, 'end': end, 'mappings': mappings,
+                 'checkpoints': entries}
+        try:
+            with open(filename + '.tmp', 'w') as f:
+                json.dump(cache, f)
+            os.replace(filename + '.tmp', filename)
+        except OSError:
+            # Read-only directory; just don't cache the index
+            pass
+    return checkpoints, end
+
+def select_trace_window(checkpoints, end, start_ns=None, end_ns=None):
+    """Find the part of an indexed trace covering a time window.
+
+    Returns the index of the checkpoint to start decoding from and the
+    offset at which decoding can stop.  Records are only roughly ordered by
+    timestamp, since several threads write to the trace buffer, so one
+    extra checkpoint is included on each side.
+    """
+    timestamps = [timestamp for _, timestamp, _ in checkpoints]
+    first = 0
+    if start_ns is not None:
+        first = max(bisect.bisect_right(timestamps, start_ns) - 2, 0)
+    stop = end
+    if end_ns is not None:
+        last = bisect.bisect_right(timestamps, end_ns) + 1
+        if last < len(checkpoints):
+            stop = checkpoints[last][0]
+    return first, stop
+
+def read_trace_window(edict, idtoname, fobj, start_ns=None, end_ns=None,
+                      names=None, events_file=None, read_header=True):
+    """Deserialize the trace records with start_ns <= timestamp < end_ns,
+    yielding lists of record tuples.
+
+    A cached index (see build_trace_index(), which also takes
+    `events_file` and `read_header`) is used to seek directly to the
+    window instead of decoding the trace from the start.  Either bound
+    can be None.  If `names` is not None, records of other events are
+    skipped.
+    """
+    def in_window(records):
+        return [rec for rec in records
+                if (start_ns is None or rec[1] >= start_ns) and
+                   (end_ns is None or rec[1] < end_ns)]
+
+    index = build_trace_index(fobj, idtoname, events_file, read_header)
+    if index is None:
+        for records in read_trace_records_batched(edict, idtoname, fobj,
+                                                  names):
+            records = in_window(records)
+            if records:
+                yield records
+        return
+
+    checkpoints, end = index
+    if not checkpoints:
+        return
+    first, stop = select_trace_window(checkpoints, end, start_ns, end_ns)
+    offset, _, mapping = checkpoints[first]
+    idtoname.update(mapping)
+    decoder = RecordDecoder(edict, idtoname, names)
+    buf = map_trace_file(fobj)
+    try:
+        while offset < stop:
+            records, offset = decoder.decode(buf, offset, stop)
+            if not records:
+                break
+            records = in_window(records)
+            if records:
+                yield records
+    finally:
+        buf.close()
+
+class Histogram(object):
+    """Fixed-size log-linear histogram of non-negative integers.
+
+    Values below 2**precision are counted exactly; larger values fall into
+    2**(precision - 1) buckets per power of two, so percentiles have a
+    relative error below 2**(1 - precision).  No more than about
+    64 * 2**(precision - 1) buckets ever exist, whatever the number of
+    values recorded, which keeps memory bounded on very long traces.
+    Exact count, sum, minimum and maximum are kept as well.
+    """
+
+    def __init__(self, precision=5):
+        self.precision = precision
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        shift = value.bit_length() - self.precision
+        if shift <= 0:
+            return value
+        return (shift << (self.precision - 1)) + (value >> shift)
+
+    def _bounds(self, index):
+        """Return the lowest and highest value counted in a bucket."""
+        if index < 1 << self.precision:
+            return index, index
+        shift = (index >> (self.precision - 1)) - 1
+        low = (index - (shift << (self.precision - 1))) << shift
+        return low, low + (1 << shift) - 1
+
+    def add(self, value, count=1):
+        """Record `count` occurrences of `value`."""
+        index = self._index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def add_values(self, values):
+        """Record each value in the iterable `values`.
+
+        This is much faster than calling add() for each value: the values
+        are sorted and each bucket is then counted with a binary search, so
+        the Python code runs once per bucket rather than once per value."""
+        values = sorted(values)
+        if not values:
+            return
+        buckets = self.buckets
+        start = 0
+        end = len(values)
+        while start < end:
+            index = self._index(values[start])
+            low, high = self._bounds(index)
+            stop = bisect.bisect_right(values, high, start, end)
+            buckets[index] = buckets.get(index, 0) + stop - start
+            start = stop
+        self.count += end
+        self.total += sum(values)
+        if self.min is None or values[0] < self.min:
+            self.min = values[0]
+        if self.max is None or values[-1] > self.max:
+            self.max = values[-1]
+
+    def merge(self, other):
+        """Add the values recorded by another histogram to this one."""
+        assert self.precision == other.precision
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or
+                                      other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or
+                                      other.max > self.max):
+            self.max = other.max
+
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def percentile(self, pct):
+        """Return an estimate of the `pct` percentile (0-100), or None if
+        no values were recorded."""
+        if not self.count:
+            return None
+        rank = pct * self.count / 100.0
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                low, high = self._bounds(index)
+                value = (low + high) // 2
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def items(self):
+        """Yield (low, high, count) for each non-empty bucket, in order."""
+        for index in sorted(self.buckets):
+            low, high = self._bounds(index)
+            yield low, high, self.buckets[index]
+
+def open_trace(events, log, read_header=True, follow=False):
+    """Prepare a trace file for decoding.
+
+    `events` and `log` can be file names or already parsed events and an
+    open binary file, respectively.  If `follow` is true, wait for the
+    trace header to be written if the file is still empty.
+
+    Returns an (events, edict, idtoname, log) tuple, where `log` is
+    positioned at the first trace record.
+    """
     if isinstance(events, str):
         events = read_events(open(events, 'r'), events)
     if isinstance(log, str):
         log = open(log, 'rb')
 
     if read_header:
+        if follow:
+            header_len = struct.calcsize(log_header_fmt)
+            while os.fstat(log.fileno()).st_size < header_len:
+                time.sleep(poll_interval)
         read_trace_header(log)
 
     dropped_event = Event.build("Dropped_Event(uint64_t num_events_dropped)")
@@ -186,6 +780,10 @@ def process(events, log, analyzer, read_header=True):
         for event_id, event in enumerate(events):
             idtoname[event_id] = event.name
 
+    return events, edict, idtoname, log
+
+def process_records(analyzer, edict, batches):
+    """Invoke the analyzer callbacks for batches of record tuples."""
     def build_fn(analyzer, event):
         if isinstance(event, str):
             return analyzer.catchall
@@ -195,7 +793,7 @@ def process(events, log, analyzer, read_header=True):
             return analyzer.catchall
 
         event_argcount = len(event.args)
-        fn_argcount = len(inspect.getargspec(fn)[0]) - 1
+        fn_argcount = len(inspect.getfullargspec(fn)[0]) - 1
         if fn_argcount == event_argcount + 1:
             # Include timestamp as first argument
             return lambda _, rec: fn(*(rec[1:2] + rec[3:3 + event_argcount]))
@@ -206,34 +804,630 @@ def process(events, log, analyzer, read_header=True):
             # Just arguments, no timestamp or pid
             return lambda _, rec: fn(*rec[3:3 + event_argcount])
 
-    analyzer.begin()
+    process_batch = getattr(analyzer, 'process_batch', None)
+    if process_batch is not None:
+        for records in batches:
+            process_batch(records)
+        return
+
     fn_cache = {}
-    for rec in read_trace_records(edict, idtoname, log):
-        event_num = rec[0]
-        event = edict[event_num]
-        if event_num not in fn_cache:
-            fn_cache[event_num] = build_fn(analyzer, event)
-        fn_cache[event_num](event, rec)
+    for records in batches:
+        for rec in records:
+            event_num = rec[0]
+            event = edict[event_num]
+            if event_num not in fn_cache:
+                fn_cache[event_num] = build_fn(analyzer, event)
+            fn_cache[event_num](event, rec)
+
+def analyzer_events(analyzer, edict, filter_events=None):
+    """Return the names of the events that need to be decoded for an
+    analyzer, or None if all of them are needed.
+
+    An analyzer that does not override catchall() or define
+    process_batch() only needs the events it has a method for.  The result
+    is further restricted to `filter_events` if it is not None.
+    """
+    names = filter_events
+    if (type(analyzer).catchall is Analyzer.catchall and
+            not hasattr(analyzer, 'process_batch')):
+        handled = set(name for name in edict if hasattr(analyzer, name))
+        if names is None:
+            names = handled
+        else:
+            names = handled & set(names)
+    elif names is not None:
+        names = set(names)
+    return names
+
+def process(events, log, analyzer, read_header=True, follow=False,
+            start_ns=None, end_ns=None, filter_events=None, events_file=None):
+    """Invoke an analyzer on each event in a log.
+
+    If `filter_events` is a set of event names, only records of these
+    events are decoded and passed to the analyzer; the others are skipped
+    after looking at their header.  Analyzers without a catchall() method
+    implicitly filter on the events they have methods for.
+
+    If `follow` is true, keep decoding records as they are appended to the
+    log, like "tail -f", until interrupted with Ctrl-C; end() is then
+    invoked as usual.  Standard output is flushed after each batch of
+    records.
+
+    If `start_ns` or `end_ns` are given, only records with
+    start_ns <= timestamp < end_ns are processed, using an index of the
+    trace to skip the rest (see read_trace_window()).  If `events` is
+    already parsed, pass the file it was read from as `events_file` so
+    that the index can be cached.
+    """
+    if isinstance(events, str):
+        events_file = events
+    events, edict, idtoname, log = open_trace(events, log, read_header,
+                                              follow)
+    names = analyzer_events(analyzer, edict, filter_events)
+
+    analyzer.begin()
+    if follow:
+        def batches():
+            for records in follow_trace_records(edict, idtoname, log,
+                                                names=names):
+                yield records
+                sys.stdout.flush()
+        try:
+            process_records(analyzer, edict, batches())
+        except KeyboardInterrupt:
+            pass
+    elif start_ns is not None or end_ns is not None:
+        process_records(analyzer, edict,
+                        read_trace_window(edict, idtoname, log,
+                                          start_ns, end_ns, names,
+                                          events_file, read_header))
+    else:
+        process_records(analyzer, edict,
+                        read_trace_records_batched(edict, idtoname, log,
+                                                   names))
     analyzer.end()
 
-def run(analyzer):
-    """Execute an analyzer on a trace file given on the command-line.
+# Per-process state of process_parallel() workers
+_worker = {}
 
-    This function is useful as a driver for simple analysis scripts.  More
-    advanced scripts will want to call process() instead."""
-    import sys
-
-    read_header = True
-    if len(sys.argv) == 4 and sys.argv[1] == '--no-header':
-        read_header = False
-        del sys.argv[1]
-    elif len(sys.argv) != 3:
-        sys.stderr.write('usage: %s [--no-header] <trace-events> ' \
-                         '<trace-file>\n' % sys.argv[0])
+def _init_worker(edict, analyzer, filename, names):
+    _worker['edict'] = edict
+    _worker['analyzer'] = analyzer
+    _worker['filename'] = filename
+    _worker['names'] = names
+
+def _process_chunk(chunk):
+    """Run a fresh copy of the analyzer on one chunk of the trace.
+
+    Returns the text printed by the analyzer along with the analyzer, so
+    that the parent can replay the output in trace order."""
+    import contextlib
+    import io
+    import pickle
+
+    start, end, idtoname = chunk
+    edict = _worker['edict']
+    analyzer = pickle.loads(_worker['analyzer'])
+    decoder = RecordDecoder(edict, dict(idtoname), _worker['names'])
+
+    def batches(buf):
+        offset = start
+        while offset < end:
+            records, offset = decoder.decode(buf, offset, end)
+            if not records:
+                break
+            yield records
+
+    output = io.StringIO()
+    with open(_worker['filename'], 'rb') as fobj:
+        buf = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            with contextlib.redirect_stdout(output):
+                process_records(analyzer, edict, batches(buf))
+        finally:
+            buf.close()
+    return output.getvalue(), analyzer
+
+def process_parallel(events, log, analyzer, jobs=None, read_header=True,
+                     chunk_size=chunk_size, filter_events=None,
+                     events_file=None):
+    """Invoke an analyzer on each event in a log using worker processes.
+
+    The log is split into chunks of about `chunk_size` bytes at record
+    boundaries, using the cached sparse index of build_trace_index() which
+    also tracks the event ID mapping at the start of each chunk.  Each
+    chunk is processed by a copy of the analyzer in a pool of `jobs`
+    processes (default: one per CPU) and the copies are combined with
+    Analyzer.merge().  Anything printed by the analyzer callbacks is
+    replayed in trace order.  `filter_events` and `events_file` are as for
+    process().
+
+    The analyzer must be picklable.  If it is not `mergeable`, or the log
+    cannot be memory-mapped, the log is processed serially.
+    """
+    import multiprocessing
+    import pickle
+
+    if isinstance(events, str):
+        events_file = events
+    events, edict, idtoname, log = open_trace(events, log, read_header)
+    names = analyzer_events(analyzer, edict, filter_events)
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    index = None
+    if jobs > 1 and analyzer.mergeable:
+        index = build_trace_index(log, idtoname, events_file, read_header)
+    if index is None:
+        analyzer.begin()
+        process_records(analyzer, edict,
+                        read_trace_records_batched(edict, idtoname, log,
+                                                   names))
+        analyzer.end()
+        return
+
+    # Group the index checkpoints into chunks of at least chunk_size bytes
+    checkpoints, end = index
+    chunks = []
+    for offset, timestamp, snapshot in checkpoints:
+        if chunks and offset - chunks[-1][0] < chunk_size:
+            continue
+        if chunks:
+            chunks[-1] = (chunks[-1][0], offset, chunks[-1][2])
+        chunks.append((offset, end, snapshot))
+
+    analyzer.begin()
+    if len(chunks) > 0:
+        if 'fork' in multiprocessing.get_all_start_methods():
+            ctx = multiprocessing.get_context('fork')
+        else:
+            ctx = multiprocessing.get_context()
+        initargs = (edict, pickle.dumps(analyzer), log.name, names)
+        with ctx.Pool(min(jobs, len(chunks)), _init_worker, initargs) as pool:
+            for output, chunk_analyzer in pool.imap(_process_chunk, chunks):
+                sys.stdout.write(output)
+                analyzer.merge(chunk_analyzer)
+    analyzer.end()
+
+def columnar_schema(edict):
+    """Return the column layout used by write_columns() for each event.
+
+    The result maps event names to a list of (column, kind) pairs, where
+    kind is 'u64' for integer columns and 'str' for interned strings.
+    """
+    schema = {}
+    for name, event in edict.items():
+        columns = [('timestamp', 'u64'), ('pid', 'u64')]
+        for type, arg in event.args:
+            columns.append((arg, 'str' if is_string(type) else 'u64'))
+        schema[name] = columns
+    return schema
+
+def read_columns(events, log, read_header=True, start_ns=None, end_ns=None,
+                 filter_events=None, events_file=None):
+    """Decode a trace into per-event columns.
+
+    Returns a (schema, columns, strings) tuple.  `columns` maps event names
+    to a list of array.array objects laid out as described by `schema` (see
+    columnar_schema()); integer columns hold uint64 values while string
+    columns hold indexes into the `strings` list, so each distinct string
+    is stored only once.
+
+    `start_ns`, `end_ns`, `filter_events` and `events_file` select the
+    records as for process().
+    """
+    import array
+
+    if isinstance(events, str):
+        events_file = events
+    events, edict, idtoname, log = open_trace(events, log, read_header)
+    schema = columnar_schema(edict)
+    names = None if filter_events is None else set(filter_events)
+    if start_ns is not None or end_ns is not None:
+        batches = read_trace_window(edict, idtoname, log, start_ns, end_ns,
+                                    names, events_file, read_header)
+    else:
+        batches = read_trace_records_batched(edict, idtoname, log, names)
+    string_index = {}
+
+    def intern(s):
+        index = string_index.get(s)
+        if index is None:
+            index = string_index[s] = len(string_index)
+        return index
+
+    columns = {}
+    for records in batches:
+        by_event = {}
+        for rec in records:
+            rows = by_event.get(rec[0])
+            if rows is None:
+                rows = by_event[rec[0]] = []
+            rows.append(rec)
+        for name, rows in by_event.items():
+            arrays = columns.get(name)
+            if arrays is None:
+                arrays = columns[name] = [array.array('Q')
+                                          for _ in schema[name]]
+            # Transpose the rows; the event name itself is not a column
+            for (column, kind), values, dst in zip(schema[name],
+                                                   list(zip(*rows))[1:],
+                                                   arrays):
+                if kind == 'str':
+                    dst.extend(map(intern, map(bytes, values)))
+                else:
+                    dst.extend(values)
+
+    schema = dict((name, schema[name]) for name in columns)
+    return schema, columns, list(string_index)
+
+def write_columns(events, log, output, read_header=True, start_ns=None,
+                  end_ns=None, filter_events=None, events_file=None):
+    """Convert a trace into a NumPy .npz file with one array per column.
+
+    Array names are "<event>/<column>", holding uint64 values (see
+    columnar_schema()).  String columns hold indexes into a string table
+    stored as the concatenated "strings/data" bytes and the
+    "strings/offsets" array, which has one more entry than there are
+    strings.  The "schema" array is the JSON-encoded event schema, so the
+    file can be interpreted without the trace events file.  The other
+    arguments select the records as for read_columns().
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        sys.stderr.write('columnar output requires NumPy\n')
         sys.exit(1)
 
-    events = read_events(open(sys.argv[1], 'r'), sys.argv[1])
-    process(events, sys.argv[2], analyzer, read_header=read_header)
+    schema, columns, strings = read_columns(events, log, read_header,
+                                            start_ns, end_ns, filter_events,
+                                            events_file)
+
+    arrays = {}
+    for name, arrs in columns.items():
+        for (column, kind), values in zip(schema[name], arrs):
+            arrays['%s/%s' % (name, column)] = np.frombuffer(values,
+                                                             dtype=np.uint64)
+    offsets = [0]
+    for s in strings:
+        offsets.append(offsets[-1] + len(s))
+    arrays['strings/data'] = np.frombuffer(b''.join(strings), dtype=np.uint8)
+    arrays['strings/offsets'] = np.array(offsets, dtype=np.uint64)
+    arrays['schema'] = np.frombuffer(json.dumps(schema).encode(),
+                                     dtype=np.uint8)
+    np.savez(output, **arrays)
+
+class ChromeTraceFormatter(Analyzer):
+    """Write trace records in the Chrome trace event JSON format.
+
+    The output can be loaded in chrome://tracing or the Perfetto UI.  Pairs
+    of events become duration slices:
+
+    - a request event NAME and its NAME_return event, keyed by their first
+      argument (e.g. the 9p tag); *_rerror and *_rcancel events also
+      terminate the pending request with the same key
+    - NAME_lock and NAME_unlock, keyed by their first argument (e.g. the
+      mutex)
+    - NAME_enter and NAME_exit, keyed by their first argument if both
+      events share it
+
+    Slices are emitted as async begin/end events, since the simple backend
+    only records the process ID and slices from different threads may
+    overlap.  All other events become instant events.  Output is written
+    as records are processed; only unterminated slices are kept in memory.
+    """
+
+    def __init__(self, fobj, events):
+        self.fobj = fobj
+        self.events = dict((event.name, event) for event in events)
+        self.pending = {}
+        self.next_id = 0
+        self.pids = set()
+        self._rules = {}
+        self._separator = '\n'
+
+    def _shares_key(self, begin, end):
+        begin = self.events[begin].args
+        end = self.events[end].args
+        return (len(begin) > 0 and len(end) > 0 and
+                begin.names()[0] == end.names()[0] and
+                not is_string(begin.types()[0]))
+
+    def _rule(self, name):
+        """Return (category, base name, is begin, keyed) for paired events,
+        or None for instant events."""
+        if name in self._rules:
+            return self._rules[name]
+        rule = None
+        events = self.events
+        if name + '_return' in events:
+            rule = ('request', name, True, True)
+        elif name.endswith('_return') and name[:-7] in events:
+            rule = ('request', name[:-7], False, True)
+        elif name.endswith(('_rerror', '_rcancel')):
+            rule = ('request', None, False, True)
+        else:
+            for category, begin, end in (('lock', '_lock', '_unlock'),
+                                         ('call', '_enter', '_exit')):
+                if name.endswith(begin):
+                    base = name[:-len(begin)]
+                    if base + end in events:
+                        rule = (category, base, True,
+                                self._shares_key(name, base + end))
+                elif name.endswith(end):
+                    base = name[:-len(end)]
+                    if base + begin in events:
+                        rule = (category, base, False,
+                                self._shares_key(base + begin, name))
+        self._rules[name] = rule
+        return rule
+
+    def _write(self, entry):
+        self.fobj.write(self._separator)
+        self.fobj.write(json.dumps(entry, separators=(',', ':')))
+        self._separator = ',\n'
+
+    def _args(self, event, rec):
+        args = {}
+        for (type, name), value in zip(event.args, rec[3:]):
+            if is_string(type):
+                value = bytes(value).decode(errors='replace')
+            args[name] = value
+        return args
+
+    def begin(self):
+        self.fobj.write('[')
+
+    def catchall(self, event, rec):
+        name, timestamp, pid = rec[:3]
+        if pid not in self.pids:
+            self.pids.add(pid)
+            self._write({'ph': 'M', 'name': 'process_name', 'pid': pid,
+                         'args': {'name': 'qemu %d' % pid}})
+        entry = {'name': name, 'ts': timestamp / 1000.0, 'pid': pid,
+                 'tid': pid, 'args': self._args(event, rec)}
+
+        rule = self._rule(name)
+        if rule is not None:
+            category, base, is_begin, keyed = rule
+            key = (pid, category, base if category != 'request' else None,
+                   rec[3] if keyed else None)
+            if is_begin:
+                self.next_id += 1
+                self.pending.setdefault(key, []).append((base,
+                                                         self.next_id))
+                entry.update(ph='b', cat=category, id=self.next_id, name=base)
+                self._write(entry)
+                return
+            slices = self.pending.get(key)
+            if slices:
+                base, slice_id = slices.pop(0)
+                if not slices:
+                    del self.pending[key]
+                entry.update(ph='e', cat=category, id=slice_id, name=base)
+                self._write(entry)
+                return
+
+        # Instant event, or the end of a slice that began before the trace
+        entry.update(ph='i', s='t', cat='event')
+        self._write(entry)
+
+    def end(self):
+        self.fobj.write('\n]\n')
+
+class EventStats(object):
+    "Aggregated statistics for one trace event."
+
+    def __init__(self):
+        self.count = 0
+        self.first = None
+        self.last = None
+        self.interarrival = Histogram()
+        # time bucket number -> number of records
+        self.buckets = {}
+        # argument name -> Histogram
+        self.args = {}
+
+class TraceStats(Analyzer):
+    """Compute per-event statistics of a trace.
+
+    For each event, count the records and the records in each time bucket
+    of `bucket_ns` nanoseconds, and keep a histogram of the time between
+    consecutive records of the event.  `args` is a list of integer argument
+    names, optionally qualified with the event name as in "EVENT.ARG", whose
+    values are recorded in histograms too.
+
+    Records are aggregated a batch at a time with process_batch(), grouping
+    them by event and then updating each event's statistics from columns of
+    values, rather than with a method call per record.
+    """
+
+    mergeable = True
+
+    def __init__(self, events, args=(), bucket_ns=1000 * 1000 * 1000):
+        self.bucket_ns = bucket_ns
+        self.stats = {}
+        self.first = None
+        self.last = None
+        # event name -> list of (argument name, record tuple index)
+        self.columns = {}
+        for event in events:
+            columns = []
+            for i, (type, name) in enumerate(event.args):
+                if is_string(type):
+                    continue
+                if name in args or '%s.%s' % (event.name, name) in args:
+                    columns.append((name, 3 + i))
+            self.columns[event.name] = columns
+
+    def _get_stats(self, name):
+        if not name in self.stats:
+            stats = self.stats[name] = EventStats()
+            for arg, index in self.columns.get(name, ()):
+                stats.args[arg] = Histogram()
+        return self.stats[name]
+
+    def process_batch(self, records):
+        if self.first is None:
+            self.first = records[0][1]
+        self.last = records[-1][1]
+
+        bucket_ns = self.bucket_ns
+        # The sort is stable, so each group stays in trace order
+        records = sorted(records, key=operator.itemgetter(0))
+        for name, rows in itertools.groupby(records, operator.itemgetter(0)):
+            rows = list(rows)
+            stats = self._get_stats(name)
+            timestamps = list(map(operator.itemgetter(1), rows))
+            stats.count += len(rows)
+
+            if stats.last is None:
+                stats.first = timestamps[0]
+                deltas = list(map(operator.sub, timestamps[1:],
+                                  timestamps[:-1]))
+            else:
+                deltas = list(map(operator.sub, timestamps,
+                                  [stats.last] + timestamps[:-1]))
+            stats.last = timestamps[-1]
+            if deltas and min(deltas) < 0:
+                # Records from different threads can be slightly out of order
+                deltas = [max(delta, 0) for delta in deltas]
+            stats.interarrival.add_values(deltas)
+
+            buckets = stats.buckets
+            for index, count in collections.Counter(
+                    map(bucket_ns.__rfloordiv__, timestamps)).items():
+                buckets[index] = buckets.get(index, 0) + count
+
+            for arg, index in self.columns.get(name, ()):
+                stats.args[arg].add_values(list(map(operator.itemgetter(index),
+                                                    rows)))
+
+    def merge(self, other):
+        if self.first is None:
+            self.first = other.first
+        if other.last is not None:
+            self.last = other.last
+        for name, ostats in other.stats.items():
+            stats = self._get_stats(name)
+            if stats.last is not None:
+                stats.interarrival.add(max(ostats.first - stats.last, 0))
+            else:
+                stats.first = ostats.first
+            stats.last = ostats.last
+            stats.count += ostats.count
+            stats.interarrival.merge(ostats.interarrival)
+            for index, count in ostats.buckets.items():
+                stats.buckets[index] = stats.buckets.get(index, 0) + count
+            for arg, hist in ostats.args.items():
+                stats.args[arg].merge(hist)
+
+    def report(self, fobj=sys.stdout):
+        """Write the statistics as text, most frequent events first."""
+        def format_hist(hist):
+            return ('min:%d p50:%d p99:%d max:%d avg:%.1f' %
+                    (hist.min, hist.percentile(50), hist.percentile(99),
+                     hist.max, hist.mean()))
+
+        if self.first is None:
+            fobj.write('No records\n')
+            return
+        bucket_s = self.bucket_ns / 1e9
+        duration_s = (self.last - self.first) / 1e9
+        total = sum(stats.count for stats in self.stats.values())
+        fobj.write('Records: %d  duration: %.3f s  buckets: %g s\n' %
+                   (total, duration_s, bucket_s))
+
+        for name, stats in sorted(self.stats.items(),
+                                  key=lambda k_v: k_v[1].count, reverse=True):
+            peak, peak_count = max(stats.buckets.items(),
+                                   key=lambda k_v: k_v[1])
+            fobj.write('%s count:%d rate:%.1f/s peak:%.1f/s at %.3f s\n' %
+                       (name, stats.count,
+                        stats.count / duration_s if duration_s else 0,
+                        peak_count / bucket_s,
+                        (peak - self.first // self.bucket_ns) * bucket_s))
+            if stats.interarrival.count > 0:
+                fobj.write('  interarrival ns: %s\n' %
+                           format_hist(stats.interarrival))
+            for arg, hist in sorted(stats.args.items()):
+                if hist.count > 0:
+                    fobj.write('  %s: %s\n' % (arg, format_hist(hist)))
+
+        fobj.write('\nRecords per second, in %g s buckets:\n' % bucket_s)
+        first_bucket = self.first // self.bucket_ns
+        last_bucket = self.last // self.bucket_ns
+        for index in range(first_bucket, last_bucket + 1):
+            counts = [(stats.buckets.get(index, 0), name)
+                      for name, stats in self.stats.items()]
+            count = sum(c for c, name in counts)
+            line = '  %10.3f s %12.1f' % ((index - first_bucket) * bucket_s,
+                                         count / bucket_s)
+            if count:
+                top_count, top_name = max(counts)
+                line += '  (%s %.0f%%)' % (top_name, 100.0 * top_count / count)
+            fobj.write(line + '\n')
+
+def positive_int(arg):
+    """argparse type for options such as --bucket-ms."""
+    import argparse
+
+    value = int(arg)
+    if value <= 0:
+        raise argparse.ArgumentTypeError('must be positive: %s' % arg)
+    return value
+
+def get_args(description=None, jobs=None):
+    """Return an argument parser for the common simpletrace options.
+
+    `jobs` is the default of --jobs, None for one worker per CPU.  Scripts
+    whose analyzer prints as it goes should default to 1, so that output
+    is streamed instead of being buffered for each chunk."""
+    import argparse
+
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--no-header', action='store_true',
+                        help='trace file has no header; assume the event ID '
+                             'mapping matches the trace events file')
+    parser.add_argument('--jobs', '-j', type=int, default=jobs,
+                        help='number of worker processes for analyzers '
+                             'that support parallel processing '
+                             '(default: %s)' % ('one per CPU' if jobs is None
+                                                else jobs))
+    parser.add_argument('--follow', '-f', action='store_true',
+                        help='keep decoding records as they are appended to '
+                             'the trace file, until interrupted')
+    parser.add_argument('--filter-events', metavar='NAME[,NAME...]',
+                        type=lambda arg: set(arg.split(',')), default=None,
+                        help='only decode records of the given events')
+    parser.add_argument('--start-ns', type=int, default=None,
+                        help='skip records with an earlier timestamp')
+    parser.add_argument('--end-ns', type=int, default=None,
+                        help='skip records with this or a later timestamp')
+    parser.add_argument('events', help='trace events file')
+    parser.add_argument('tracefile', help='binary trace file')
+    return parser
+
+def run(analyzer, args=None):
+    """Execute an analyzer on a trace file given on the command-line.
+
+    This function is useful as a driver for simple analysis scripts.  More
+    advanced scripts will want to call process() instead.  Scripts with
+    extra options can pass the result of parsing them with a get_args()
+    parser as `args`."""
+    if args is None:
+        args = get_args().parse_args()
+    events = read_events(open(args.events, 'r'), args.events)
+    if args.follow or args.start_ns is not None or args.end_ns is not None:
+        process(events, args.tracefile, analyzer,
+                read_header=not args.no_header, follow=args.follow,
+                start_ns=args.start_ns, end_ns=args.end_ns,
+                filter_events=args.filter_events, events_file=args.events)
+    else:
+        process_parallel(events, args.tracefile, analyzer, jobs=args.jobs,
+                         read_header=not args.no_header,
+                         filter_events=args.filter_events,
+                         events_file=args.events)
 
 if __name__ == '__main__':
     class Formatter(Analyzer):
@@ -258,4 +1452,48 @@ if __name__ == '__main__':
                 i += 1
             print(' '.join(fields))
 
-    run(Formatter())
+    parser = get_args('Pretty-print or convert a simpletrace binary trace.')
+    parser.add_argument('--columnar', metavar='FILE',
+                        help='write per-event columns to a NumPy .npz file '
+                             'instead of printing records')
+    parser.add_argument('--chrome', metavar='FILE',
+                        help='write Chrome trace event JSON, for '
+                             'chrome://tracing or the Perfetto UI, instead '
+                             'of printing records')
+    parser.add_argument('--stats', action='store_true',
+                        help='print per-event counts, rates and histograms '
+                             'instead of printing records')
+    parser.add_argument('--stats-args', metavar='[EVENT.]ARG[,...]',
+                        type=lambda arg: arg.split(','), default=[],
+                        help='integer arguments to compute histograms of '
+                             'with --stats')
+    parser.add_argument('--bucket-ms', type=positive_int, default=1000,
+                        help='width of the --stats time buckets in ms')
+    args = parser.parse_args()
+    if args.columnar and args.follow:
+        parser.error('--follow cannot be used with --columnar')
+
+    events = read_events(open(args.events, 'r'), args.events)
+    if args.columnar:
+        write_columns(events, args.tracefile, args.columnar,
+                      read_header=not args.no_header,
+                      start_ns=args.start_ns, end_ns=args.end_ns,
+                      filter_events=args.filter_events,
+                      events_file=args.events)
+    elif args.stats:
+        stats = TraceStats(events, args.stats_args,
+                           bucket_ns=args.bucket_ms * 1000 * 1000)
+        run(stats, args)
+        stats.report()
+    elif args.chrome:
+        with open(args.chrome, 'w') as out:
+            process(events, args.tracefile, ChromeTraceFormatter(out, events),
+                    read_header=not args.no_header, follow=args.follow,
+                    start_ns=args.start_ns, end_ns=args.end_ns,
+                    filter_events=args.filter_events,
+                    events_file=args.events)
+    else:
+        process(events, args.tracefile, Formatter(),
+                read_header=not args.no_header, follow=args.follow,
+                start_ns=args.start_ns, end_ns=args.end_ns,
+                filter_events=args.filter_events, events_file=args.events)
@@ -32,6 +32,7 @@ else:
 
 sys.path.append(os.path.join(SOURCE_DIR, 'python'))
 
+from qemu.console_socket import ConsoleMatcher
 from qemu.machine import QEMUMachine
 
 def is_readable_executable_file(path):
@@ -72,23 +73,15 @@ def _console_interaction(test, success_message, failure_message,
     assert not keep_sending or send_string
     if vm is None:
         vm = test.vm
-    console = vm.console_socket.makefile()
     console_logger = logging.getLogger('console')
-    while True:
-        if send_string:
-            vm.console_socket.sendall(send_string.encode())
-            if not keep_sending:
-                send_string = None # send only once
-        msg = console.readline().strip()
-        if not msg:
-            continue
-        console_logger.debug(msg)
-        if success_message in msg:
-            break
-        if failure_message and failure_message in msg:
-            console.close()
-            fail = 'Failure message found in console: %s' % failure_message
-            test.fail(fail)
+    matcher = ConsoleMatcher(vm.console_socket, log=console_logger.debug)
+    patterns = [success_message]
+    if failure_message:
+        patterns.append(failure_message)
+    if matcher.wait(patterns, send=send_string,
+                    resend_interval=0.2 if keep_sending else None):
+        fail = 'Failure message found in console: %s' % failure_message
+        test.fail(fail)
 
 def interrupt_interactive_console_until_pattern(test, success_message,
                                                 failure_message=None,
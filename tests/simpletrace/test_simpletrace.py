@@ -0,0 +1,237 @@
+"""
+Unit tests for scripts/simpletrace.py, using a synthetic trace.  The bulk
+decoder, the time window and the parallel driver are checked against the
+record-by-record read_trace_records().
+
+Run with "python3 -m pytest tests/simpletrace" from the top of the tree.
+"""
+
+# This work is licensed under the terms of the GNU GPL, version 2.  See
+# the COPYING file in the top-level directory.
+
+import io
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..',
+                             'scripts'))
+# pylint: disable=wrong-import-position
+import simpletrace
+
+
+EVENTS = '''
+foo(int a, uint64_t b) "a %d b %" PRIu64
+bar(const char *s, int x) "s %s x %d"
+baz(void) ""
+'''
+
+
+class TraceWriter:
+    """Write a trace file in the format of trace/simple.c."""
+
+    def __init__(self, fobj, header=True):
+        self.fobj = fobj
+        if header:
+            fobj.write(struct.pack(simpletrace.log_header_fmt,
+                                   simpletrace.header_event_id,
+                                   simpletrace.header_magic, 4))
+
+    def mapping(self, event_id, name):
+        name = name.encode()
+        self.fobj.write(struct.pack('=QQL', simpletrace.record_type_mapping,
+                                    event_id, len(name)) + name)
+
+    def event(self, event_id, timestamp, pid, *args):
+        data = b''
+        for arg in args:
+            if isinstance(arg, bytes):
+                data += struct.pack('=L', len(arg)) + arg
+            else:
+                data += struct.pack('=Q', arg)
+        self.fobj.write(struct.pack('=QQQII', simpletrace.record_type_event,
+                                    event_id, timestamp,
+                                    simpletrace.rec_header_len + len(data),
+                                    pid) + data)
+
+
+class CountAnalyzer(simpletrace.Analyzer):
+    """Keep every record, in order, and count them per event."""
+
+    mergeable = True
+
+    def __init__(self):
+        self.records = []
+        self.counts = {}
+
+    def catchall(self, event, rec):
+        self.records.append(rec)
+        self.counts[rec[0]] = self.counts.get(rec[0], 0) + 1
+
+    def merge(self, other):
+        for rec in other.records:
+            self.catchall(None, rec)
+
+
+class TraceTestCase(unittest.TestCase):
+    count = 5000
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.events_file = os.path.join(self.tmpdir, 'trace-events')
+        with open(self.events_file, 'w') as f:
+            f.write(EVENTS)
+        self.trace_file = os.path.join(self.tmpdir, 'trace.bin')
+        with open(self.trace_file, 'wb') as f:
+            self.write_trace(TraceWriter(f))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_trace(self, writer):
+        rand = random.Random(1)
+        writer.mapping(0, 'foo')
+        writer.mapping(1, 'bar')
+        timestamp = 1000
+        for i in range(self.count):
+            if i == self.count // 2:
+                # Events can be mapped to IDs at any time
+                writer.mapping(7, 'baz')
+            # Several threads write to the trace buffer, so timestamps are
+            # only roughly ordered
+            timestamp += rand.randrange(100)
+            pid = rand.choice((100, 101))
+            kind = rand.randrange(10)
+            if kind < 5:
+                writer.event(0, timestamp, pid, rand.randrange(1 << 32),
+                             rand.randrange(1 << 64))
+            elif kind < 8:
+                name = b'x' * rand.randrange(20)
+                writer.event(1, timestamp - rand.randrange(50), pid, name, i)
+            elif kind < 9 and i >= self.count // 2:
+                writer.event(7, timestamp, pid)
+            else:
+                writer.event(simpletrace.dropped_event_id, timestamp, pid,
+                             rand.randrange(10))
+
+    def open_trace(self):
+        """Return (edict, idtoname, log) like the simpletrace drivers."""
+        with open(self.events_file, 'r') as f:
+            events = simpletrace.read_events(f, self.events_file)
+        edict = {'dropped': simpletrace.Event.build(
+            'Dropped_Event(uint64_t num_events_dropped)')}
+        edict.update((event.name, event) for event in events)
+        idtoname = {simpletrace.dropped_event_id: 'dropped'}
+        log = open(self.trace_file, 'rb')
+        self.addCleanup(log.close)
+        simpletrace.read_trace_header(log)
+        return edict, idtoname, log
+
+    def expected(self, names=None):
+        edict, idtoname, log = self.open_trace()
+        return list(simpletrace.read_trace_records(edict, idtoname, log,
+                                                   names=names))
+
+
+class TestRecordDecoder(TraceTestCase):
+    def decode(self, names=None):
+        edict, idtoname, log = self.open_trace()
+        records = []
+        for batch in simpletrace.read_trace_records_batched(edict, idtoname,
+                                                            log, names=names):
+            records.extend(batch)
+        return records
+
+    def test_records(self):
+        records = self.decode()
+        self.assertEqual(records, self.expected())
+        self.assertEqual(set(rec[0] for rec in records),
+                         set(('foo', 'bar', 'baz', 'dropped')))
+
+    def test_names(self):
+        for names in ({'bar'}, {'baz', 'dropped'}, set()):
+            with self.subTest(names=names):
+                self.assertEqual(self.decode(names), self.expected(names))
+
+    def test_chunks(self):
+        # Decoding can stop at any record boundary and resume there
+        edict, idtoname, log = self.open_trace()
+        buf = log.read()
+        decoder = simpletrace.RecordDecoder(edict, idtoname)
+        records = []
+        offset = 0
+        while True:
+            batch, offset = decoder.decode(buf, offset,
+                                           min(len(buf), offset + 1000))
+            if not batch:
+                break
+            records.extend(batch)
+        self.assertEqual(offset, len(buf))
+        self.assertEqual(records, self.expected())
+
+    def test_unmappable(self):
+        # Files that cannot be memory-mapped are read record by record
+        edict, idtoname, log = self.open_trace()
+        stream = io.BytesIO(log.read())
+        records = []
+        for batch in simpletrace.read_trace_records_batched(edict, idtoname,
+                                                            stream):
+            records.extend(batch)
+        self.assertEqual(records, self.expected())
+
+
+@mock.patch.object(simpletrace, 'index_interval', 2048)
+class TestWindow(TraceTestCase):
+    def window(self, start_ns, end_ns):
+        edict, idtoname, log = self.open_trace()
+        records = []
+        for batch in simpletrace.read_trace_window(
+                edict, idtoname, log, start_ns=start_ns, end_ns=end_ns,
+                events_file=self.events_file):
+            records.extend(batch)
+        return records
+
+    def test_window(self):
+        expected = self.expected()
+        timestamps = sorted(rec[1] for rec in expected)
+        bounds = [(None, None), (None, timestamps[100]),
+                  (timestamps[-100], None),
+                  (timestamps[1000], timestamps[1300]),
+                  (timestamps[-1] + 1, None)]
+        for start_ns, end_ns in bounds:
+            with self.subTest(start_ns=start_ns, end_ns=end_ns):
+                self.assertEqual(
+                    self.window(start_ns, end_ns),
+                    [rec for rec in expected
+                     if (start_ns is None or rec[1] >= start_ns) and
+                        (end_ns is None or rec[1] < end_ns)])
+
+    def test_cached_index(self):
+        # The second call reads the index back from the sidecar file
+        expected = self.window(3000, 90000)
+        self.assertTrue(os.path.exists(self.trace_file + '.idx'))
+        self.assertEqual(self.window(3000, 90000), expected)
+        self.assertEqual(expected, [rec for rec in self.expected()
+                                    if 3000 <= rec[1] < 90000])
+
+
+@mock.patch.object(simpletrace, 'index_interval', 2048)
+class TestParallel(TraceTestCase):
+    def test_merge(self):
+        serial = CountAnalyzer()
+        simpletrace.process(self.events_file, self.trace_file, serial)
+        parallel = CountAnalyzer()
+        simpletrace.process_parallel(self.events_file, self.trace_file,
+                                     parallel, jobs=2, chunk_size=8192)
+        self.assertEqual(parallel.records, serial.records)
+        self.assertEqual(parallel.counts, serial.counts)
+        self.assertEqual(serial.records, self.expected())
+
+
+if __name__ == '__main__':
+    unittest.main()
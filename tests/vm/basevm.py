@@ -20,6 +20,7 @@ import time
 import datetime
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', 'python'))
 from qemu.accel import kvm_available
+from qemu.console_socket import ConsoleMatcher, clean_console_line
 from qemu.machine import QEMUMachine
 import subprocess
 import hashlib
@@ -323,74 +324,42 @@ class BaseVM(object):
         self.console_raw_path = os.path.join(vm._temp_dir,
                                              vm._name + "-console.raw")
         self.console_raw_file = open(self.console_raw_path, 'wb')
+        self.console_matcher = ConsoleMatcher(
+            vm.console_socket,
+            log=self.console_log_line if self.debug else None,
+            raw_file=self.console_raw_file)
+
+    def console_log_line(self, line):
+        sys.stderr.write("con recv: %s\n" % line)
 
     def console_log(self, text):
         for line in re.split("[\r\n]", text):
-            # filter out terminal escape sequences
-            line = re.sub("\x1b\[[0-9;?]*[a-zA-Z]", "", line)
-            line = re.sub("\x1b\([0-9;?]*[a-zA-Z]", "", line)
-            # replace unprintable chars
-            line = re.sub("\x1b", "<esc>", line)
-            line = re.sub("[\x00-\x1f]", ".", line)
-            line = re.sub("[\x80-\xff]", ".", line)
+            line = clean_console_line(line.encode("utf-8"))
             if line == "":
                 continue
-            # log console line
-            sys.stderr.write("con recv: %s\n" % line)
+            self.console_log_line(line)
 
     def console_wait(self, expect, expectalt = None):
         vm = self._guest
-        output = ""
-        while True:
-            try:
-                chars = vm.console_socket.recv(1)
-                if self.console_raw_file:
-                    self.console_raw_file.write(chars)
-                    self.console_raw_file.flush()
-            except socket.timeout:
-                sys.stderr.write("console: *** read timeout ***\n")
-                sys.stderr.write("console: waiting for: '%s'\n" % expect)
-                if not expectalt is None:
-                    sys.stderr.write("console: waiting for: '%s' (alt)\n" % expectalt)
-                sys.stderr.write("console: line buffer:\n")
-                sys.stderr.write("\n")
-                self.console_log(output.rstrip())
-                sys.stderr.write("\n")
-                raise
-            output += chars.decode("latin1")
-            if expect in output:
-                break
-            if not expectalt is None and expectalt in output:
-                break
-            if "\r" in output or "\n" in output:
-                lines = re.split("[\r\n]", output)
-                output = lines.pop()
-                if self.debug:
-                    self.console_log("\n".join(lines))
-        if self.debug:
-            self.console_log(output)
-        if not expectalt is None and expectalt in output:
-            return False
-        return True
+        patterns = [expect]
+        if not expectalt is None:
+            patterns.append(expectalt)
+        try:
+            return self.console_matcher.wait(patterns) == 0
+        except socket.timeout:
+            sys.stderr.write("console: *** read timeout ***\n")
+            sys.stderr.write("console: waiting for: '%s'\n" % expect)
+            if not expectalt is None:
+                sys.stderr.write("console: waiting for: '%s' (alt)\n" % expectalt)
+            sys.stderr.write("console: line buffer:\n")
+            sys.stderr.write("\n")
+            self.console_log(vm.console_socket.peek().decode("utf-8",
+                                                             "replace"))
+            sys.stderr.write("\n")
+            raise
 
     def console_consume(self):
-        vm = self._guest
-        output = ""
-        vm.console_socket.setblocking(0)
-        while True:
-            try:
-                chars = vm.console_socket.recv(1)
-            except:
-                break
-            output += chars.decode("latin1")
-            if "\r" in output or "\n" in output:
-                lines = re.split("[\r\n]", output)
-                output = lines.pop()
-                if self.debug:
-                    self.console_log("\n".join(lines))
-        if self.debug:
-            self.console_log(output)
-        vm.console_socket.setblocking(1)
+        self.console_matcher.consume()
 
     def console_send(self, command):
         vm = self._guest